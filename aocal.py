@@ -10,17 +10,24 @@ with couple of tweaks to use it for ASVO calibration database by Marcin Sokolows
 """
 # import pdb
 
-import sys, os, struct, logging, glob, errno
+import sys, os, struct, logging, glob, errno, warnings, copy, zlib
+import multiprocessing
 from collections import namedtuple
 import numpy as np
 import cmath
 import math
-import pyfits
+import metafits_tiles
 
 from optparse import OptionParser,OptionGroup
 
-# should be optional :
-import matplotlib.pyplot as pyplot
+# matplotlib and fits modules are only imported by the functions which need them (import aocal must stay fast,
+# see aocal_bench.py --check_imports)
+
+# optional, only needed for blosc compressed compact files :
+try :
+    import blosc
+except ImportError :
+    blosc = None
 
 # MWA global variables :
 N_FINE_CHANNELS_PER_COARSE=32 # assuming processing always 24*32 = 762 fine channels 
@@ -28,10 +35,19 @@ N_FINE_CHANNELS=768
 COARSE_CHANNEL_WIDTH=1.28
 FINE_CHANNEL=0.04 # in MHz 
 
+POL_NAMES = ["XX", "XY", "YX", "YY"]
+
 HEADER_FORMAT = "8s6I2d"
 HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
 HEADER_INTRO = "MWAOCAL\0"
 
+# compact file (see write_compact) : COMPACT_HEADER_FORMAT + MWAOCAL header + compressed size of every antenna block + blocks
+COMPACT_HEADER_FORMAT = "8s2I"
+COMPACT_HEADER_SIZE = struct.calcsize(COMPACT_HEADER_FORMAT)
+COMPACT_INTRO = "MWAOCALZ"
+COMPACT_VERSION = 1
+COMPACT_CODECS = {None: 0, 'none': 0, 'zlib': 1, 'blosc': 2}
+
 Header = namedtuple("header",
                     "intro fileType structureType intervalCount antennaCount channelCount polarizationCount timeStart timeEnd")
 Header.__new__.__defaults__ = (HEADER_INTRO, 0, 0, 0, 0, 0, 0, 0.0, 0.0)
@@ -53,39 +69,31 @@ def mkdir_p(path):
          pass
       else: raise
 
-def list_tile_name( table, out_file, flagged_only=False ) :
+def list_tile_name( tiles_table, out_file, flagged_only=False ) :
+   """
+   write tile name, id, flag and antenna index of every tile in tiles_table (metafits_tiles.tile_table) to out_file,
+   returns dictionary antenna index -> tile name
+   """
    f = open(out_file, 'w')
 
    tiles_out={}
-   for i in range(0,256):
-     idx=table[i][0]
-     tile_idx=table[i][1]
-     tile_id=table[i][2]
-     tile_name=table[i][3]
-     tile_pol=table[i][4]
-     delays=table[i][12]
-     flag=table[i][7]
-     
-     tile_out_name="T%03d%s" % (tile_idx,tile_pol)
-
-     # print "DEBUG : %s %s %d" % (tile_name,tile_pol,tile_idx)
-
-     if tile_pol == "X" :
-        # print "flagged_only = %s , flag = %d" % (flagged_only,flag)
-        if not flagged_only or flag > 0  :
-           outline = str(tile_name) + " " + str(tile_id) + " " + str(flag) + " " + str(tile_idx) + "\n"
-           f.write(outline)
-           
-           tiles_out[tile_idx] = tile_name
-        #else :
-        #   print "Skipped tile %s" % tile_name
-
+   for tile in tiles_table :
+     tile_idx=int(tile['antenna'])
+     tile_name=tile['tile_name']
+     flag=int(tile['flag'])
+
+     # print "flagged_only = %s , flag = %d" % (flagged_only,flag)
+     if not flagged_only or flag > 0  :
+        outline = str(tile_name) + " " + str(tile['tile']) + " " + str(flag) + " " + str(tile_idx) + "\n"
+        f.write(outline)
+        
+        tiles_out[tile_idx] = tile_name
 
    f.close()
 
    return tiles_out
 
-def fit_complex_gains(v, mode='model', amp_order=5, fft_pad_factor=8):
+def fit_complex_gains(v, mode='model', amp_order=5, fft_pad_factor=8, refine_peak=False):
     """
     Fit amplitude & phases of a 1D array of complex values (v).
 
@@ -99,56 +107,291 @@ def fit_complex_gains(v, mode='model', amp_order=5, fft_pad_factor=8):
 
     A Coarse solution for the phases is determined via a padded FFT and average
     offset. This is then refined with a two-parameter least squares
+    (see phase_gradients for fft_pad_factor and refine_peak).
 
     Amplitudes are fit using a polynomial, unless amp_order is set to <1, in
     which case amplitudes are preserved.
+
+    This is a thin wrapper around fit_complex_gains_batch.
     """
-    good = ~np.isnan(v)  # mask matching non-NaN values
-    if sum(good) == 0:
-        return v
-    v_fft = np.fft.fft(np.nan_to_num(v * np.abs(v) ** -3), n=fft_pad_factor * len(v))
-    v_index = np.arange(len(v), dtype=np.float)
-    gradient = float(
-        np.abs(v_fft).argmax()) / fft_pad_factor / 768.  # change in phase per increment of v due to phase wrap
-    wrap = np.array(np.cos(2 * np.pi * v_index * gradient), dtype=np.complex128)
-    wrap.imag = np.sin(2 * np.pi * v_index * gradient)
-
-    # unwrap v, keeping only valid values
-    u = v[good] / wrap[good]
-    u_index = np.arange(len(v), dtype=np.float)[good]
-    # centre on 0
-    u_mean = np.average(u)
-    u_mean /= np.abs(u_mean)
-    u0 = u / u_mean
-    if np.var(np.angle(u0)) > 1:
-        logging.warn("high variance detected in phases, check output model!")
-    # finally do least squares
-    m, c = np.polyfit(u_index, np.angle(u0), 1, w=np.abs(u) ** -2)
-    fit_complex = np.array(np.cos(v_index * m + c), dtype=np.complex128)
-    fit_complex.imag = np.sin(v_index * m + c)
-    # fit poly to amplitudes
-    if amp_order > 0:
-        amp_model_coeffs = np.polyfit(v_index[good], np.abs(v[good]), amp_order)
-        amp_model = np.poly1d(amp_model_coeffs)(v_index)
-    else:
-        amp_model = np.abs(v)
-    if mode == "model":
-        return np.where(good, amp_model * fit_complex * wrap * u_mean, np.nan)
-    elif mode == "clip":
+    return fit_complex_gains_batch(np.asarray(v)[np.newaxis, :], mode=mode, amp_order=amp_order,
+                                   fft_pad_factor=fft_pad_factor, refine_peak=refine_peak)[0]
+
+
+def fast_fft_length(n):
+    """
+    smallest length >= n which has only factors 2, 3 and 5 (fast for np.fft)
+    """
+    best = 2 ** int(np.ceil(np.log2(max(n, 1))))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            # smallest power of 2 such that p35 * 2^k >= n :
+            length = p35
+            while length < n:
+                length *= 2
+            best = min(best, length)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+def phase_gradients(v, fft_pad_factor=8, refine_peak=False):
+    """
+    Phase gradient (phase wrap per channel in turns) of every row of the 2D array v of complex gains
+    (NaN = flagged) from the peak of a single zero-padded FFT over all rows.
+
+    The FFT length is the fast length (fast_fft_length) of at least fft_pad_factor x number of channels.
+    If refine_peak is True the peak position is refined by parabolic interpolation of the
+    neighbouring FFT amplitudes, so that a smaller fft_pad_factor (e.g. 2) gives a similar accuracy.
+    """
+    n_fft = fast_fft_length(fft_pad_factor * v.shape[1])
+    v_fft = np.abs(np.fft.fft(np.nan_to_num(v * np.abs(v) ** -3), n=n_fft, axis=1))
+    rows = np.arange(v.shape[0])
+    peak = v_fft.argmax(axis=1)
+    gradient = peak.astype(np.float)
+    if refine_peak:
+        left = v_fft[rows, peak - 1]
+        centre = v_fft[rows, peak]
+        right = v_fft[rows, (peak + 1) % n_fft]
+        curvature = left - 2 * centre + right
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gradient += np.where(curvature < 0, 0.5 * (left - right) / curvature, 0.)
+    return gradient / n_fft
+
+
+def polyfit_rows(x, y, deg, w):
+    """
+    Weighted least squares fit of a polynomial of degree deg to every row of the
+    2D array y (all rows sampled at the same 1D abscissa x).
+
+    w has the same shape as y and follows the np.polyfit convention (weights
+    multiply the residuals). Zero weight excludes a sample, so per-row flags are
+    applied by setting w (and y) to zero there.
+
+    Returns the fitted models evaluated at x (same shape as y).
+    """
+    # scale abscissa to [-1,1] to keep the stacked Vandermonde matrix well conditioned :
+    x_mid = 0.5 * (x[-1] + x[0])
+    x_half = 0.5 * (x[-1] - x[0])
+    if x_half == 0:
+        x_half = 1.0
+    vander = np.vander((x - x_mid) / x_half, deg + 1)  # (n_x, deg+1)
+    n_coeff = vander.shape[1]
+    w2 = w * w
+    # normal equations for all rows at once : (V^T W^2 V) c = V^T W^2 y
+    # (einsum rather than BLAS dot so that the result for a row does not depend on how many rows are fitted together)
+    lhs = np.einsum('ri,ij,ik->rjk', w2, vander, vander)
+    rhs = np.einsum('ri,ij->rj', w2 * y, vander)
+    # pinv rather than solve so that rows with too few good samples do not raise :
+    coeffs = np.einsum('rjk,rk->rj', np.linalg.pinv(lhs), rhs)
+    return np.einsum('rj,ij->ri', coeffs, vander)
+
+
+def fit_complex_gains_batch(v, mode='model', amp_order=5, fft_pad_factor=8, chunk_size=256, refine_peak=False):
+    """
+    Same fit as fit_complex_gains, but for every row of the 2D array v at once
+    (rows are e.g. all interval, antenna, pol vectors of an AOCal).
+
+    Returns 2D array of complex values corresponding to the model. Rows which
+    are entirely NaN are returned unchanged.
+
+    Rows are processed in blocks of chunk_size to limit the memory used by the
+    padded FFT.
+    """
+    if mode == "clip":
         # check np.angle(u0) statistics
         # set "good" array to False where statistics are bad
         # return original array where not newly flagged
         # return np.where(good, v, np.nan)
         raise RuntimeError, "clip not implemented"
-    else:
+    elif mode != "model":
         raise RuntimeError, "mode %s not implemented" % mode
 
+    v = np.asarray(v, dtype=np.complex128)
+    model = v.copy()
+    n_chan = v.shape[1]
+    v_index = np.arange(n_chan, dtype=np.float)
+    # only rows with at least one non-NaN value are fitted :
+    rows = np.flatnonzero((~np.isnan(v)).any(axis=1))
+    high_var_cnt = 0
+
+    for start in xrange(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        vc = v[chunk]
+        good = ~np.isnan(vc)  # mask matching non-NaN values
+        n_good = good.sum(axis=1)
+
+        # change in phase per increment of v due to phase wrap
+        gradient = phase_gradients(vc, fft_pad_factor=fft_pad_factor, refine_peak=refine_peak)
+        wrap = np.exp(2j * np.pi * gradient[:, np.newaxis] * v_index)
+
+        # unwrap v, keeping only valid values
+        u = np.where(good, vc / wrap, 0)
+        # centre on 0
+        u_mean = u.sum(axis=1) / n_good
+        u_mean /= np.abs(u_mean)
+        u0_phase = np.where(good, np.angle(u / u_mean[:, np.newaxis]), 0.)
+        phase_mean = u0_phase.sum(axis=1) / n_good
+        phase_var = np.where(good, (u0_phase - phase_mean[:, np.newaxis]) ** 2, 0.).sum(axis=1) / n_good
+        high_var_cnt += np.count_nonzero(phase_var > 1)
+
+        # finally do least squares
+        w = np.zeros(u.shape)
+        w[good] = np.abs(u[good]) ** -2
+        fit_complex = np.exp(1j * polyfit_rows(v_index, u0_phase, 1, w))
+        # fit poly to amplitudes
+        amp = np.where(good, np.abs(vc), 0.)
+        if amp_order > 0:
+            amp_model = polyfit_rows(v_index, amp, amp_order, good.astype(np.float))
+        else:
+            amp_model = amp
+        model[chunk] = np.where(good, amp_model * fit_complex * wrap * u_mean[:, np.newaxis], np.nan)
+
+    if high_var_cnt > 0:
+        logging.warn("high variance detected in phases of %d vectors, check output model!" % high_var_cnt)
+
+    return model
+
+
+# arrays shared with the worker processes of run_sharded (name -> numpy array in shared memory) :
+shared_arrays = {}
+
+
+def shared_empty(shape, dtype=np.complex128):
+    """
+    Allocate an array in shared memory.
+
+    Returns (raw, array) where raw is the multiprocessing.RawArray backing the
+    numpy array. Pass raw (not the array) to run_sharded so that the workers
+    map the same memory instead of receiving a pickled copy.
+    """
+    n_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    raw = multiprocessing.RawArray('b', max(n_bytes, 1))
+    return raw, np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def init_shared_worker(raw_arrays):
+    """
+    Pool initializer : re-create the numpy views of the shared memory blocks in the worker.
+    """
+    for name, (raw, shape, dtype) in raw_arrays.items():
+        shared_arrays[name] = np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def run_sharded(func, n_items, n_workers, raw_arrays, args=()):
+    """
+    Split range(n_items) (e.g. antennas) into n_workers contiguous shards and
+    call func((start, end) + args) for every shard in a process pool.
+
+    raw_arrays is a dictionary name -> (raw, shape, dtype) of shared memory
+    blocks (see shared_empty), available in the workers as shared_arrays[name].
+
+    Returns list of results in shard order.
+    """
+    n_shards = max(1, min(n_workers, n_items))
+    bounds = np.linspace(0, n_items, n_shards + 1).astype(int)
+    tasks = [(bounds[i], bounds[i + 1]) + tuple(args) for i in xrange(n_shards)]
+    pool = multiprocessing.Pool(n_shards, initializer=init_shared_worker, initargs=(raw_arrays,))
+    try:
+        results = pool.map(func, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def pool_map(func, items, n_workers=1):
+    """
+    map(func, items) in a pool of n_workers processes (plain serial map if n_workers <= 1).
+
+    func must be a module level function (so that it can be pickled).
+    """
+    items = list(items)
+    if n_workers <= 1 or len(items) <= 1:
+        return map(func, items)
+    pool = multiprocessing.Pool(min(n_workers, len(items)))
+    try:
+        results = pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def fit_antennas(args):
+    """
+    run_sharded worker : fit antennas [start, end) of shared_arrays['solutions'] in place.
+    """
+    ant_start, ant_end, pols, mode, amp_order, fft_pad_factor, refine_peak = args
+    AOCal(shared_arrays['solutions'][:, ant_start:ant_end]).fit(pols=pols, mode=mode, amp_order=amp_order,
+                                                                fft_pad_factor=fft_pad_factor, refine_peak=refine_peak)
+
+
+
+# Jones matrices are stored along the last axis of the arrays in POL_NAMES order (XX, XY, YX, YY),
+# all other axes are broadcast. Results are calculated with closed-form 2x2 arithmetic in a single pass.
+def jones_inverse(j, out=None):
+    """
+    inverse of the 2x2 Jones matrices j (singular matrices give inf / NaN), out may be j for an in-place inverse
+    """
+    j = np.asarray(j)
+    if out is None:
+        out = np.empty_like(j)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        det = j[..., 0] * j[..., 3] - j[..., 1] * j[..., 2]
+        yy = j[..., 0] / det
+        np.divide(j[..., 3], det, out=out[..., 0])
+        out[..., 3] = yy
+        np.divide(j[..., 1:3], -det[..., np.newaxis], out=out[..., 1:3])
+    return out
+
+
+def jones_product(j1, j2, out=None):
+    """
+    matrix product j1 j2 of 2x2 Jones matrices, out may be j1 or j2 for an in-place product
+    """
+    j1 = np.asarray(j1)
+    j2 = np.asarray(j2)
+    if out is None:
+        out = np.empty(np.broadcast(j1, j2).shape, dtype=np.result_type(j1, j2))
+    if np.may_share_memory(out, j1) and np.may_share_memory(out, j2):
+        out[...] = jones_product(j1, j2)
+    elif np.may_share_memory(out, j2):
+        # column by column : column k of the product only uses column k of j2
+        for k in (0, 1):
+            top = j1[..., 0] * j2[..., k] + j1[..., 1] * j2[..., k + 2]
+            out[..., k + 2] = j1[..., 2] * j2[..., k] + j1[..., 3] * j2[..., k + 2]
+            out[..., k] = top
+    else:
+        # row by row : row k of the product only uses row k of j1
+        for k in (0, 2):
+            left = j1[..., k] * j2[..., 0] + j1[..., k + 1] * j2[..., 2]
+            out[..., k + 1] = j1[..., k] * j2[..., 1] + j1[..., k + 1] * j2[..., 3]
+            out[..., k] = left
+    return out
+
+
+def jones_hermitian(j, out=None):
+    """
+    Hermitian conjugate (conjugate transpose) of the 2x2 Jones matrices j, out may be j for an in-place conjugate
+    """
+    j = np.asarray(j)
+    if out is None:
+        out = np.empty_like(j)
+    np.conjugate(j, out=out)
+    xy = out[..., 1].copy()
+    out[..., 1] = out[..., 2]
+    out[..., 2] = xy
+    return out
+
 
 class AOCal(np.ndarray):
     """
     AOCAl stored as a numpy array (with start and stop time stored as floats)
 
-    Array is of dtype complex128 with the following dimensions:
+    Array is of dtype complex128 (or complex64 if requested when reading, see fromfile) with the following dimensions:
 
     - calibration interval
     - antenna
@@ -181,6 +424,7 @@ class AOCal(np.ndarray):
             return
         self.time_start = getattr(obj, 'time_start', None)
         self.time_end = getattr(obj, 'time_end', None)
+        self.header_string = getattr(obj, 'header_string', None)
 
     def __getattr__(self, name):
         if name == 'n_int':
@@ -209,8 +453,11 @@ class AOCal(np.ndarray):
         return self[:, :, n_chan:-n_chan, :]
 
     def tofile(self, cal_filename):
-        if not (np.iscomplexobj(self) and self.itemsize == 16 and len(self.shape) == 4):
-            raise TypeError, "array must have 4 dimensions and be of type complex128"
+        """
+        write in MWAOCAL format (complex64 solutions are converted to complex128)
+        """
+        if not (np.iscomplexobj(self) and self.itemsize in (8, 16) and len(self.shape) == 4):
+            raise TypeError, "array must have 4 dimensions and be of type complex128 or complex64"
         header = Header(intervalCount=self.shape[0], antennaCount=self.shape[1], channelCount=self.shape[2],
                         polarizationCount=self.shape[3], timeStart=self.time_start, timeEnd=self.time_end)
         with open(cal_filename, "wb") as cal_file:
@@ -218,19 +465,24 @@ class AOCal(np.ndarray):
             cal_file.write(header_string)
             logging.debug("header written")
             cal_file.seek(HEADER_SIZE, os.SEEK_SET)  # skip header. os.SEEK_SET means seek relative to start of file
-            np.ndarray.tofile(self, cal_file)
+            if self.dtype == np.complex128:
+                np.ndarray.tofile(self, cal_file)
+            else:
+                # converted one interval at a time to avoid a complex128 copy of all solutions :
+                for interval in xrange(self.shape[0]):
+                    np.ndarray.tofile(np.asarray(self[interval], dtype=np.complex128), cal_file)
             logging.debug("binary file written")
 
     def tostring(self):
-        if not (np.iscomplexobj(self) and self.itemsize == 16 and len(self.shape) == 4):
-            raise TypeError, "array must have 4 dimensions and be of type complex128"
+        if not (np.iscomplexobj(self) and self.itemsize in (8, 16) and len(self.shape) == 4):
+            raise TypeError, "array must have 4 dimensions and be of type complex128 or complex64"
         header = Header(intervalCount=self.shape[0], antennaCount=self.shape[1], channelCount=self.shape[2],
                         polarizationCount=self.shape[3], timeStart=self.time_start, timeEnd=self.time_end)
 
         header_string = struct.pack(HEADER_FORMAT, *header)
         logging.debug("header written")
 
-        aocal_string = np.ndarray.tobytes(self)
+        aocal_string = np.ndarray.tobytes(np.asarray(self, dtype=np.complex128))
         logging.debug("binary file written")
 
         return (header_string + aocal_string)
@@ -243,17 +495,106 @@ class AOCal(np.ndarray):
         return header_string
     
 
-    def fit(self, pols=(0, 3), mode='model', amp_order=5):
-        if not (np.iscomplexobj(self) and self.itemsize == 16 and len(self.shape) == 4):
-            raise TypeError, "array must have 4 dimensions and be of type complex128"
-        fit_array = np.zeros(self.shape, dtype=np.complex128)
-        for interval in xrange(self.shape[0]):
-            for antenna in xrange(self.shape[1]):
-                logging.debug("fitting antenna %d" % antenna)
-                for pol in pols:
-                    v = self[interval, antenna, :, pol]
-                    if sum(~np.isnan(self[interval, antenna, :, pol])) > 0:
-                        self[interval, antenna, :, pol] = fit_complex_gains(self[interval, antenna, :, pol],amp_order=amp_order)
+    def average(self, n, axis='chan', nan_policy='propagate'):
+        """
+        return a new AOCal with every n channels (axis='chan') or calibration intervals (axis='int') averaged
+
+        nan_policy='propagate' : average of a block containing NaN is NaN
+        nan_policy='omit'      : NaNs are ignored (result is NaN only if the whole block is NaN)
+        """
+        axes = {'int': 0, 'chan': 2}
+        if axis not in axes:
+            raise ValueError, "axis %s not recognised, use one of %s" % (axis, sorted(axes.keys()))
+        ax = axes[axis]
+        if n < 1 or self.shape[ax] % n != 0:
+            raise ValueError, "cannot average %d values along axis %s in blocks of %d" % (self.shape[ax], axis, n)
+        # split the averaged axis into (n_blocks, n) and average over the second one :
+        shape = list(self.shape)
+        shape[ax:ax + 1] = [self.shape[ax] // n, n]
+        blocks = np.asarray(self).reshape(shape)
+        if nan_policy == 'propagate':
+            avg = blocks.mean(axis=ax + 1)
+        elif nan_policy == 'omit':
+            with warnings.catch_warnings():
+                # all-NaN blocks -> NaN
+                warnings.simplefilter("ignore", RuntimeWarning)
+                avg = np.nanmean(blocks, axis=ax + 1)
+        else:
+            raise ValueError, "nan_policy %s not recognised, use propagate or omit" % nan_policy
+        return AOCal(avg, self.time_start, self.time_end)
+
+    def fit(self, pols=(0, 3), mode='model', amp_order=5, n_workers=1, fft_pad_factor=8, refine_peak=False):
+        """
+        Replace solutions of the requested polarisations with the model from fit_complex_gains.
+
+        If n_workers > 1 the antennas are fitted in a pool of n_workers processes
+        (solutions passed to the workers in shared memory). The result is
+        identical to the serial fit.
+        The fit is always calculated in double precision (also for complex64 solutions).
+        """
+        if not (np.iscomplexobj(self) and self.itemsize in (8, 16) and len(self.shape) == 4):
+            raise TypeError, "array must have 4 dimensions and be of type complex128 or complex64"
+        pols = list(pols)
+        n_int, n_ant, n_chan = self.shape[0:3]
+        if n_workers > 1 and n_ant > 1:
+            raw, solutions = shared_empty(self.shape)
+            solutions[:] = self
+            run_sharded(fit_antennas, n_ant, n_workers, {'solutions': (raw, self.shape, np.complex128)},
+                        args=(pols, mode, amp_order, fft_pad_factor, refine_peak))
+            self[:] = solutions
+            return
+        # stack all (interval, antenna, pol) vectors as rows and fit them in one go :
+        vectors = np.asarray(self)[:, :, :, pols].transpose(0, 1, 3, 2).reshape(-1, n_chan)
+        logging.debug("fitting %d vectors" % vectors.shape[0])
+        model = fit_complex_gains_batch(vectors, mode=mode, amp_order=amp_order, fft_pad_factor=fft_pad_factor, refine_peak=refine_peak)
+        self[:, :, :, pols] = model.reshape(n_int, n_ant, len(pols), n_chan).transpose(0, 1, 3, 2)
+
+    def jones_out(self, other=None):
+        """
+        new AOCal (same times and header) for the result of a Jones operation with the broadcast shape of self and other
+        """
+        shape = self.shape
+        dtype = self.dtype
+        if other is not None:
+            shape = np.broadcast(self, other).shape
+            dtype = np.result_type(self, other)
+        return AOCal(np.empty(shape, dtype=dtype), self.time_start, self.time_end, self.header_string)
+
+    def inverse(self, out=None):
+        """
+        Jones inverse of all solutions (e.g. gains <-> aocal convention), ao.inverse(out=ao) inverts in place
+        """
+        if out is None:
+            out = self.jones_out()
+        jones_inverse(np.asarray(self), out=np.asarray(out))
+        return out
+
+    def product(self, other, out=None):
+        """
+        Jones product self x other (e.g. DI solutions x bandpass), other is broadcast against self
+        (e.g. shape (n_ant, 1, 4) for one matrix per antenna), ao.product(other, out=ao) multiplies in place
+        """
+        if out is None:
+            out = self.jones_out(other)
+        jones_product(np.asarray(self), np.asarray(other), out=np.asarray(out))
+        return out
+
+    def hermitian(self, out=None):
+        """
+        Hermitian conjugate of all solutions, ao.hermitian(out=ao) conjugates in place
+        """
+        if out is None:
+            out = self.jones_out()
+        jones_hermitian(np.asarray(self), out=np.asarray(out))
+        return out
+
+    def normalise_refant(self, refant, out=None):
+        """
+        solutions of every antenna multiplied by the inverse of the reference antenna solutions (J_ant x J_refant^-1),
+        so that the reference antenna becomes the identity matrix, ao.normalise_refant(refant, out=ao) works in place
+        """
+        ref_inv = jones_inverse(np.asarray(self)[:, refant:refant + 1])
+        return self.product(ref_inv, out=out)
 
     # def toJSON(self):
     #     return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
@@ -273,91 +614,308 @@ def zeros(n_interval=1, n_antennas=128, n_channel=3072, n_pol=4, time_start=0.0,
     return AOCal(np.zeros((n_interval, n_antennas, n_channel, n_pol), dtype=np.complex128), time_start, time_end)
 
 
-def fromfile(cal_filename,debug=0):
+def read_header(cal_filename,debug=0,allow_partial=False):
     """
-    Read AOCal from file.
+    Read and validate the header of AOCal file (without reading the solutions).
+    The file size has to match the header, allow_partial=True also accepts data after
+    the declared intervals (interval being appended by a running AOCalWriter).
+
+    returns (header, header_string)
     """
-    header_string = None
     with open(cal_filename, "rb") as cal_file:
         header_string = cal_file.read(struct.calcsize(HEADER_FORMAT))
-        header = Header._make(struct.unpack(HEADER_FORMAT, header_string))
-        logging.debug(header)
-        if debug > 0 :
-            print "header = %s / header_string = %s" % (header,header_string)
-        assert header.intro == HEADER_INTRO, "File is not a calibrator file"
-        assert header.fileType == 0, "fileType not recognised. Only 0 (complex Jones solutions) is recognised in mwatools/solutionfile.h as of 2013-08-30"
-        assert header.structureType == 0, "structureType not recognised. Only 0 (ordered real/imag, polarization, channel, antenna, time) is recognised in mwatools/solutionfile.h as of 2013-08-30"
-        logging.debug("header OK")
-
-        count = header.intervalCount * header.antennaCount * header.channelCount * header.polarizationCount
-        assert os.path.getsize(cal_filename) == HEADER_SIZE + 2 * count * struct.calcsize(
-            "d"), "File is the wrong size."
-        logging.debug("file correct size")
-        cal_file.seek(HEADER_SIZE, os.SEEK_SET)  # skip header. os.SEEK_SET means seek relative to start of file
-        
-        if debug > 0 :
-            print "count = %d" % (count)
+    header = Header._make(struct.unpack(HEADER_FORMAT, header_string))
+    logging.debug(header)
+    if debug > 0 :
+        print "header = %s / header_string = %s" % (header,header_string)
+    assert header.intro == HEADER_INTRO, "File is not a calibrator file"
+    assert header.fileType == 0, "fileType not recognised. Only 0 (complex Jones solutions) is recognised in mwatools/solutionfile.h as of 2013-08-30"
+    assert header.structureType == 0, "structureType not recognised. Only 0 (ordered real/imag, polarization, channel, antenna, time) is recognised in mwatools/solutionfile.h as of 2013-08-30"
+    logging.debug("header OK")
+
+    count = header.intervalCount * header.antennaCount * header.channelCount * header.polarizationCount
+    expected_size = HEADER_SIZE + 2 * count * struct.calcsize("d")
+    if allow_partial :
+        # data after the declared intervals is an interval being appended by AOCalWriter (ignored) :
+        assert os.path.getsize(cal_filename) >= expected_size, "File is the wrong size."
+    else :
+        assert os.path.getsize(cal_filename) == expected_size, "File is the wrong size."
+    logging.debug("file correct size")
+
+    return (header, header_string)
+
+
+def fromfile(cal_filename,debug=0,mmap_mode=None,dtype=np.complex128,allow_partial=False):
+    """
+    Read AOCal from file (MWAOCAL or compact file written by write_compact).
+
+    dtype=np.complex64 gives solutions in single precision (half the memory),
+    they are converted while reading one interval at a time.
+
+    If mmap_mode is set ('r', 'r+' or 'c', as for numpy.memmap) the solutions are
+    not read into memory, instead the returned AOCal is a view of the file and
+    only the slices which are actually used (e.g. a single antenna or interval)
+    are read from disk. Use 'c' (copy-on-write) if the solutions are going to be
+    modified in memory (e.g. fit) without changing the file.
+    Memory-mapping is only possible for complex128 MWAOCAL files.
+
+    allow_partial=True reads the completed intervals of a file which is still
+    being written by AOCalWriter (see read_header).
+    """
+    if is_compact(cal_filename) :
+        return read_compact(cal_filename, dtype=dtype)
+
+    (header, header_string) = read_header(cal_filename, debug=debug, allow_partial=allow_partial)
+    count = header.intervalCount * header.antennaCount * header.channelCount * header.polarizationCount
+    if debug > 0 :
+        print "count = %d" % (count)
 
-        data = np.fromfile(cal_file, dtype=np.complex128, count=count)
-    # print "ORIGINAL data.shape   = %d" % (data.shape[0])        
     shape = [header.intervalCount, header.antennaCount, header.channelCount, header.polarizationCount]
+    if mmap_mode is not None and np.dtype(dtype) == np.complex128 :
+        # memory-mapped view, slices are only read from disk when accessed :
+        data = np.memmap(cal_filename, dtype=np.complex128, mode=mmap_mode, offset=HEADER_SIZE, shape=tuple(shape))
+        logging.debug("file memory-mapped (mode=%s)" % (mmap_mode))
+    elif np.dtype(dtype) == np.complex128 :
+        with open(cal_filename, "rb") as cal_file:
+            cal_file.seek(HEADER_SIZE, os.SEEK_SET)  # skip header. os.SEEK_SET means seek relative to start of file
+            data = np.fromfile(cal_file, dtype=np.complex128, count=count)
+    else :
+        data = np.empty(count, dtype=dtype)
+        interval_count = count // max(header.intervalCount, 1)
+        with open(cal_filename, "rb") as cal_file:
+            cal_file.seek(HEADER_SIZE, os.SEEK_SET)
+            for interval in xrange(header.intervalCount) :
+                data[interval * interval_count:(interval + 1) * interval_count] = np.fromfile(cal_file, dtype=np.complex128, count=interval_count)
+    # print "ORIGINAL data.shape   = %d" % (data.shape[0])
     data = data.reshape(shape)
     # print "RE-SHAPED data.shape  = %d" % (data.shape[0])
     new_aocal = AOCal(data, header.timeStart, header.timeEnd, header_string)
     
     return new_aocal
 
+class AOCalWriter(object):
+    """
+    Write AOCal file one calibration interval (or block of intervals) at a time.
+
+    The header is rewritten after every appended block with the number of intervals
+    written so far, so readers (fromfile with allow_partial=True) see all completed
+    intervals while the writer is still running. Only the appended block is kept in memory.
 
-def merge_bin_files( bin_file_list, outfile ) :
-    ao_list=[]
-    
-    intervalCount = 1
-    antennaCount  = 128
-    channelCount  = 0
-    polarizationCount = 4
-    for bin_file in bin_file_list :
-        ao = fromfile( bin_file )
-        ao_list.append( ao.copy() )
-        
-        if ao.n_int != intervalCount :
-            intervalCount = ao.n_int
-        if ao.n_pol != polarizationCount :
-            polarizationCount = ao.n_pol
-        if ao.n_ant != antennaCount :
-            antennaCount = ao.n_ant;  
+    with AOCalWriter("solutions.bin", n_ant=128, n_chan=768, time_start=t0) as writer:
+        for interval in intervals:
+            writer.write(interval, time_end=t)   # array (n_ant, n_chan, n_pol) or (n, n_ant, n_chan, n_pol)
 
-        # sum channels from picket fence :
-        channelCount += ao.n_chan
+    append=True continues an existing file (its shape and time_start are taken from the file).
+    """
 
-    print "Read %d ao files" % (len(ao_list))
-    
-    out_ao_data = np.dstack( (ao_list) )
-    
-    # def header_tostring( intervalCount, antennaCount, channelCount, polarizationCount ):
-    header_string = ao_list[0].header_tostring( intervalCount, antennaCount, channelCount, polarizationCount )
-    out_ao = AOCal( out_ao_data, ao_list[0].time_start, ao_list[0].time_end, header_string )
-    
-    out_ao.tofile( outfile )
-    
-    return out_ao
+    def __init__(self, cal_filename, n_ant=128, n_chan=N_FINE_CHANNELS, n_pol=4, time_start=0.0, time_end=0.0, append=False):
+        self.cal_filename = cal_filename
+        if append and os.path.exists(cal_filename):
+            (header, header_string) = read_header(cal_filename, allow_partial=True)
+            self.header = header
+            self.cal_file = open(cal_filename, "r+b")
+            # drop a partially written interval (if any) :
+            self.cal_file.truncate(HEADER_SIZE + header.intervalCount * self.interval_size())
+        else:
+            self.header = Header(intervalCount=0, antennaCount=n_ant, channelCount=n_chan, polarizationCount=n_pol,
+                                 timeStart=time_start, timeEnd=time_end)
+            self.cal_file = open(cal_filename, "wb")
+            self.write_header()
+        self.cal_file.seek(0, os.SEEK_END)
 
-def average_channels( binfile, avg_n_channels, outfile ) :
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def interval_size(self):
+        return self.header.antennaCount * self.header.channelCount * self.header.polarizationCount * np.dtype(np.complex128).itemsize
+
+    def write_header(self):
+        self.cal_file.seek(0, os.SEEK_SET)
+        self.cal_file.write(struct.pack(HEADER_FORMAT, *self.header))
+        self.cal_file.flush()
+
+    def write(self, data, time_end=None):
+        """
+        append interval(s) to the file, time_end (if given) becomes the end time in the header
+        """
+        data = np.asarray(data)
+        shape = (self.header.antennaCount, self.header.channelCount, self.header.polarizationCount)
+        if data.shape == shape:
+            data = data[np.newaxis]
+        if not (np.iscomplexobj(data) and len(data.shape) == 4 and data.shape[1:] == shape):
+            raise TypeError, "interval must be complex array of shape %s or (n_int,) + %s, got %s" % (shape, shape, data.shape)
+
+        # data first, then header -> header never declares intervals which are not completely written
+        self.cal_file.seek(HEADER_SIZE + self.header.intervalCount * self.interval_size(), os.SEEK_SET)
+        np.ndarray.tofile(np.ascontiguousarray(data, dtype=np.complex128), self.cal_file)
+        self.cal_file.flush()
+        self.header = self.header._replace(intervalCount=self.header.intervalCount + data.shape[0])
+        if time_end is not None:
+            self.header = self.header._replace(timeEnd=float(time_end))
+        self.write_header()
+        logging.debug("%d intervals written to %s" % (self.header.intervalCount, self.cal_filename))
+
+    def close(self):
+        if not self.cal_file.closed:
+            self.write_header()
+            self.cal_file.close()
+
+
+def is_compact(cal_filename):
+    """
+    True if cal_filename is a compact file (see write_compact)
+    """
+    with open(cal_filename, "rb") as cal_file:
+        return cal_file.read(len(COMPACT_INTRO)) == COMPACT_INTRO
+
+
+def write_compact(ao, compact_filename, compression=None, level=5):
+    """
+    Write AOCal in compact format : complex64 solutions stored in one block per antenna
+    (intervals x channels x polarisations), optionally compressed with zlib or blosc.
+
+    The MWAOCAL header is stored unchanged so that compact_to_bin restores it exactly.
+    Blocks can be read independently (see read_compact ants=).
+    """
+    if compression not in COMPACT_CODECS:
+        raise ValueError, "compression %s not recognised, use one of none, zlib, blosc" % compression
+    codec = COMPACT_CODECS[compression]
+    if codec == COMPACT_CODECS['blosc'] and blosc is None:
+        raise ImportError, "blosc compression requested, but python-blosc is not installed"
+
+    header = Header(intervalCount=ao.shape[0], antennaCount=ao.shape[1], channelCount=ao.shape[2],
+                    polarizationCount=ao.shape[3], timeStart=ao.time_start, timeEnd=ao.time_end)
+    n_ant = ao.shape[1]
+    block_sizes = np.zeros(n_ant, dtype=np.uint64)
+    with open(compact_filename, "wb") as compact_file:
+        compact_file.write(struct.pack(COMPACT_HEADER_FORMAT, COMPACT_INTRO, COMPACT_VERSION, codec))
+        compact_file.write(struct.pack(HEADER_FORMAT, *header))
+        # block sizes are known after compression -> written at the end
+        sizes_offset = compact_file.tell()
+        compact_file.write(block_sizes.tobytes())
+        for ant in xrange(n_ant):
+            block = np.ascontiguousarray(ao[:, ant], dtype=np.complex64).tobytes()
+            if codec == COMPACT_CODECS['zlib']:
+                block = zlib.compress(block, level)
+            elif codec == COMPACT_CODECS['blosc']:
+                block = blosc.compress(block, typesize=8, clevel=level)
+            block_sizes[ant] = len(block)
+            compact_file.write(block)
+        compact_file.seek(sizes_offset, os.SEEK_SET)
+        compact_file.write(block_sizes.tobytes())
+    logging.debug("compact file %s written (codec %d)" % (compact_filename, codec))
+
+
+def read_compact(compact_filename, ants=None, dtype=np.complex64):
+    """
+    Read AOCal from compact file (see write_compact).
+
+    ants : list of antenna indices to read (default all), the other blocks are not read.
+    """
+    with open(compact_filename, "rb") as compact_file:
+        (intro, version, codec) = struct.unpack(COMPACT_HEADER_FORMAT, compact_file.read(COMPACT_HEADER_SIZE))
+        assert intro == COMPACT_INTRO, "File is not a compact calibrator file"
+        assert version == COMPACT_VERSION, "Compact file version %d not supported" % version
+        header_string = compact_file.read(HEADER_SIZE)
+        header = Header._make(struct.unpack(HEADER_FORMAT, header_string))
+        assert header.intro == HEADER_INTRO, "Compact file does not contain MWAOCAL header"
+        if codec == COMPACT_CODECS['blosc'] and blosc is None:
+            raise ImportError, "file %s is blosc compressed, but python-blosc is not installed" % compact_filename
+
+        block_sizes = np.fromfile(compact_file, dtype=np.uint64, count=header.antennaCount)
+        block_offsets = compact_file.tell() + np.concatenate(([0], np.cumsum(block_sizes)[:-1]))
+
+        if ants is None:
+            ants = range(header.antennaCount)
+        else:
+            # subset of antennas -> header of the file does not describe the array
+            header_string = None
+        block_shape = (header.intervalCount, header.channelCount, header.polarizationCount)
+        data = np.empty((header.intervalCount, len(ants), header.channelCount, header.polarizationCount), dtype=dtype)
+        for i, ant in enumerate(ants):
+            compact_file.seek(int(block_offsets[ant]), os.SEEK_SET)
+            block = compact_file.read(int(block_sizes[ant]))
+            if codec == COMPACT_CODECS['zlib']:
+                block = zlib.decompress(block)
+            elif codec == COMPACT_CODECS['blosc']:
+                block = blosc.decompress(block)
+            data[:, i] = np.frombuffer(block, dtype=np.complex64).reshape(block_shape)
+
+    return AOCal(data, header.timeStart, header.timeEnd, header_string)
+
+
+def bin_to_compact(binfile, compact_filename, compression=None):
+    """
+    convert MWAOCAL file to compact file, solutions are read antenna by antenna from the memory-mapped file
+    """
+    write_compact(fromfile(binfile, mmap_mode='r'), compact_filename, compression=compression)
+    print "Saved compact file %s (%d -> %d bytes)" % (compact_filename, os.path.getsize(binfile), os.path.getsize(compact_filename))
+
+
+def compact_to_bin(compact_filename, binfile):
+    """
+    convert compact file back to MWAOCAL file (as used by calibrate/applysolutions)
+    """
+    read_compact(compact_filename).tofile(binfile)
+    print "Saved MWAOCAL file %s" % (binfile)
+
+
+def merge_bin_files( bin_file_list, outfile ) :
+    """
+    Merge AOCal files (e.g. from picket fence observations) along the channel axis into outfile.
+
+    Only headers are read first (to check that all files have the same number of
+    intervals, antennas and polarisations and to size the output), then the
+    channels of every input file are copied directly into their place in the
+    output file, so that at most one input file is mapped at a time.
+
+    returns merged AOCal (memory-mapped view of outfile)
+    """
+    headers = []
+    for bin_file in bin_file_list :
+        (header, header_string) = read_header( bin_file )
+        headers.append( header )
+
+    first = headers[0]
+    for bin_file, header in zip( bin_file_list, headers ) :
+        if (header.intervalCount, header.antennaCount, header.polarizationCount) != (first.intervalCount, first.antennaCount, first.polarizationCount) :
+            raise ValueError, "File %s has %d intervals, %d antennas and %d polarisations, expected %d, %d and %d (as in %s)" % (
+                  bin_file, header.intervalCount, header.antennaCount, header.polarizationCount,
+                  first.intervalCount, first.antennaCount, first.polarizationCount, bin_file_list[0])
+
+    # sum channels from picket fence :
+    channelCount = sum( header.channelCount for header in headers )
+    print "Read %d ao file headers -> %d channels in total" % (len(headers),channelCount)
+
+    out_header = Header(intervalCount=first.intervalCount, antennaCount=first.antennaCount, channelCount=channelCount,
+                        polarizationCount=first.polarizationCount, timeStart=first.timeStart, timeEnd=first.timeEnd)
+    out_shape = (first.intervalCount, first.antennaCount, channelCount, first.polarizationCount)
+    with open( outfile, "wb" ) as out_file :
+        out_file.write( struct.pack(HEADER_FORMAT, *out_header) )
+        # preallocate output file :
+        out_file.truncate( HEADER_SIZE + int(np.prod(out_shape)) * np.dtype(np.complex128).itemsize )
+
+    out_data = np.memmap( outfile, dtype=np.complex128, mode='r+', offset=HEADER_SIZE, shape=out_shape )
+    start_channel = 0
+    for bin_file, header in zip( bin_file_list, headers ) :
+        in_data = fromfile( bin_file, mmap_mode='r' )
+        out_data[:,:,start_channel:start_channel+header.channelCount,:] = in_data
+        start_channel += header.channelCount
+        del in_data
+    out_data.flush()
+    del out_data
+
+    return fromfile( outfile, mmap_mode='r' )
+
+def average_channels( binfile, avg_n_channels, outfile, nan_policy='propagate' ) :
    ao = fromfile( binfile )
    rest = ( ao.n_chan % avg_n_channels )
 
-   if avg_n_channels >= 0 and avg_n_channels < ao.n_chan and rest==0 :
-      ao_out = ao.copy()
-      ao_out_shape = np.copy(ao.shape)
-      ao_out_shape[2] = ao_out_shape[2] / avg_n_channels
-      ao_out = AOCal( np.zeros( ao_out_shape, dtype=ao.dtype ) , ao.time_start, ao.time_end, ao.header_tostring )
-      ao_out.n_chan = ao.n_chan / avg_n_channels
-
-      
-      for out_ch in range(0,ao_out.n_chan) :
-         for offset in range(0,avg_n_channels) :
-            ao_out[:,:,out_ch,:] += ao[:,:,out_ch*avg_n_channels + offset,:]
-            
-         ao_out[:,:,out_ch,:] = ao_out[:,:,out_ch,:] / avg_n_channels
+   if avg_n_channels > 0 and avg_n_channels < ao.n_chan and rest==0 :
+      ao_out = ao.average( avg_n_channels, axis='chan', nan_policy=nan_policy )
 
       if outfile.find(".bin") < 0 :
          outfile += ".bin"
@@ -370,34 +928,61 @@ def average_channels( binfile, avg_n_channels, outfile ) :
  
    return False
    
-def split_bin_file( binfile, split_by_n_channels, outfilebase ):
-   ao = fromfile( binfile )
-   rest = ( ao.n_chan % split_by_n_channels )
-
-   if split_by_n_channels >= 0 and split_by_n_channels < ao.n_chan and rest==0:
-      n_chunks = ao.n_chan / split_by_n_channels
-         
+def write_channel_range( args ) :
+    """
+    pool worker of split_bin_file : args = (binfile, outfile, start_channel, end_channel),
+    copies the channel range from the memory-mapped input file into a new (preallocated, memory-mapped) file
+    """
+    (binfile, outfile, start_channel, end_channel) = args
+    (header, header_string) = read_header( binfile )
+    in_shape = (header.intervalCount, header.antennaCount, header.channelCount, header.polarizationCount)
+    in_data = np.memmap( binfile, dtype=np.complex128, mode='r', offset=HEADER_SIZE, shape=in_shape )
+
+    out_header = header._replace( channelCount=(end_channel-start_channel) )
+    out_shape = (header.intervalCount, header.antennaCount, end_channel-start_channel, header.polarizationCount)
+    with open( outfile, "wb" ) as out_file :
+        out_file.write( struct.pack(HEADER_FORMAT, *out_header) )
+        # preallocate output file :
+        out_file.truncate( HEADER_SIZE + int(np.prod(out_shape)) * np.dtype(np.complex128).itemsize )
+
+    out_data = np.memmap( outfile, dtype=np.complex128, mode='r+', offset=HEADER_SIZE, shape=out_shape )
+    out_data[:] = in_data[:,:,start_channel:end_channel,:]
+    out_data.flush()
+    del out_data, in_data
+
+    return outfile
+
+def split_bin_file( binfile, split_by_n_channels, outfilebase, n_workers=1 ):
+   """
+   split binfile into files of split_by_n_channels channels (outfilebase_000.bin, outfilebase_001.bin, ...),
+   the output files are written by n_workers processes directly from the memory-mapped input file
+   """
+   (header, header_string) = read_header( binfile )
+   n_chan = header.channelCount
+
+   if split_by_n_channels > 0 and split_by_n_channels < n_chan and ( n_chan % split_by_n_channels )==0:
+      n_chunks = n_chan / split_by_n_channels
+      chunks = []
       for i in range(0,n_chunks) :
          outfile = ( "%s_%03d.bin" % (outfilebase,i))
-         ao_out = ao.copy()
-         ao_out = ao[:,:,i*split_by_n_channels:(i+1)*split_by_n_channels,:]
-         ao_out.n_chan = split_by_n_channels
-         
-         ao_out.tofile( outfile )
+         chunks.append( (binfile, outfile, i*split_by_n_channels, (i+1)*split_by_n_channels) )
+
+      pool_map( write_channel_range, chunks, n_workers )
+      for i in range(0,n_chunks) :
+         print "%d : channels %d - %d saved to file %s" % (i,chunks[i][2],chunks[i][3],chunks[i][1])
 
-         print "%d : channels %d - %d saved to file %s" % (i,i*split_by_n_channels,(i+1)*split_by_n_channels,outfile)
-      
       return True
    else :
-      print "ERROR : split_by_n_channels = %d (either <0 or >= %d or rest = %d != 0)" % (split_by_n_channels,ao.n_chan,rest)
-      
-   return False   
-    
+      rest = -1
+      if split_by_n_channels > 0 :
+         rest = ( n_chan % split_by_n_channels )
+      print "ERROR : split_by_n_channels = %d (either <0 or >= %d or rest = %d != 0)" % (split_by_n_channels,n_chan,rest)
+
+   return False
+
 
 # rts_filename_pattern has to contain "node" otherwise it will not work as it will not find coarse channel correctly 
 def rtsfile(metafitsfile, rts_filename_pattern="DI_JonesMatrices_node[0-9]*.dat", aocal_format=True):
-    import astropy.io.fits as fits
-
     """
     Read DI Jones matrices from RTS output files and convert to "aocal" format.
     Assumes RTS solutions are one per coarse channel.
@@ -409,9 +994,7 @@ def rtsfile(metafitsfile, rts_filename_pattern="DI_JonesMatrices_node[0-9]*.dat"
     pol_map = [3, 2, 1, 0]
 
     # Antenna reording:
-    hdu = fits.open(metafitsfile)
-    ant_map = hdu['TILEDATA'].data['Antenna'][::2]  # only want each tile once
-    hdu.close()
+    ant_map = metafits_tiles.tile_table(metafitsfile)['antenna']  # only want each tile once
 
     # Assumptions:
     nintervals = 1
@@ -435,179 +1018,137 @@ def rtsfile(metafitsfile, rts_filename_pattern="DI_JonesMatrices_node[0-9]*.dat"
             Jref = float(
                 rts_file.readline())  # Common factor of all gains is a single number in the first line of the file
             rts_file.readline()  # The second line contains the model primary beam Jones matrix (in the direction of the calibrator)
-            lines = rts_file.readlines()
-
-            # If first time through, get number of antennas and set up data array for solution
-            if chan == 0:
-                nantennas = len(lines)
-                # Create numpy array structure
-                data = np.empty((nintervals, nantennas, nchannels, npols,), dtype=np.complex128)
-                data_out = np.empty((nintervals, nantennas, 768, npols,), dtype=np.complex128)
-                data[:] = np.nan
-                data_out[:] = np.nan
-            else:
-                assert len(lines) == nantennas, "Files contain different numbers of antennas"
-
-            # Parse each line
-            for ant in range(len(lines)):
-                line = lines[ant]
-                jones_str = line.split(",")
-                assert len(jones_str) == 2 * npols, "Incorrect number of elements in Jones matrix"
-                ant_idx = ant_map[ant]
-                for pol in range(len(pol_map)):
-                    p = pol_map[pol]
-                    data[0, ant_idx, coarse_channel, pol] = float(jones_str[2 * p]) + float(jones_str[2 * p + 1]) * 1j
-
-                    for finech in range(0, 32):
-                        data_out[0, ant_idx, finech + coarse_channel * 32, pol] = data[0, ant_idx, coarse_channel, pol]
+            lines = [line for line in rts_file.readlines() if len(line.strip()) > 0]
+
+        # parse all antenna lines at once -> (antenna, 8) array of re,im pairs :
+        jones_re_im = np.fromstring(",".join(lines), sep=",")
+        assert jones_re_im.size == len(lines) * 2 * npols, "Incorrect number of elements in Jones matrix"
+        jones_re_im = jones_re_im.reshape(len(lines), 2 * npols)
+        jones = jones_re_im[:, 0::2] + 1j * jones_re_im[:, 1::2]  # (antenna, RTS pol)
+
+        # If first time through, get number of antennas and set up data array for solution
+        if chan == 0:
+            nantennas = len(lines)
+            # Create numpy array structure
+            data = np.empty((nintervals, nantennas, nchannels, npols,), dtype=np.complex128)
+            data_out = np.empty((nintervals, nantennas, N_FINE_CHANNELS, npols,), dtype=np.complex128)
+            data[:] = np.nan
+            data_out[:] = np.nan
+        else:
+            assert len(lines) == nantennas, "Files contain different numbers of antennas"
 
-                        if aocal_format:
-                            data_out[0, ant_idx, finech + coarse_channel * 32, pol] = 1.00 / data_out[ 0, ant_idx, finech + coarse_channel * 32, pol]
+        # re-order antennas and polarisations, then copy to all fine channels of the coarse channel :
+        ant_idx = ant_map[0:nantennas]
+        ant_jones = jones[:, pol_map]
+        data[0, ant_idx, coarse_channel, :] = ant_jones
+        if aocal_format:
+            ant_jones = 1.00 / ant_jones
+        fine_channels = slice(coarse_channel * N_FINE_CHANNELS_PER_COARSE, (coarse_channel + 1) * N_FINE_CHANNELS_PER_COARSE)
+        data_out[0, ant_idx, fine_channels, :] = ant_jones[:, np.newaxis, :]
 
-                    if ant == 2 and pol == 0:
-                        print "%d %.4f" % (coarse_channel, abs(data_out[0, ant_idx, coarse_channel, pol]))
+        if nantennas > 2:
+            print "%d %.4f" % (coarse_channel, abs(data_out[0, ant_map[2], coarse_channel, 0]))
 
     new_aocal = AOCal(data_out, 0, 0)
     return new_aocal
 
 
+def read_rts_bandpass_node(args):
+    """
+    Read a single RTS BandpassCalibration node file.
+
+    args = (rts_filename, use_fit, debug)
+
+    returns (coarse_channel, nantennas, ants, finech, gains) where ants are the
+    (1-based) antenna numbers found in the file, finech the fine channel of every
+    frequency and gains a complex array (ant, frequency, jones)
+    """
+    rts_filename, use_fit, debug = args
+    npols = 4
+    offset = 0
+    if use_fit:
+        offset = 1
+
+    # get coarse channel from the file name chan is not good as the order might be reversed !!! as it happen in my tests 
+    idx=rts_filename.find("node")
+    coarse_channel = int( rts_filename[idx+4:idx+4+3] ) - 1 
+
+    with open(rts_filename, "r") as rts_file:
+        freq_list = rts_file.readline()  # list of frequencies
+        freq_list_float = np.fromstring(freq_list, sep=",")
+        lines = [line for line in rts_file.readlines() if len(line.strip()) > 0]
+
+    # nantennas = len(lines)/8 
+    nantennas = int(lines[len(lines) - 1].split(",")[0])
+    print "File %s : nantennas = %d , lines = %d" % (rts_filename, nantennas, len(lines))
+
+    # single pass over the file : antenna number -> first line of its block (8 lines per antenna)
+    ant_line_idx = {}
+    for k in range(0, len(lines)):
+        ant = int(lines[k].split(",", 1)[0])
+        if ant not in ant_line_idx:
+            ant_line_idx[ant] = k
+    if debug > 0 :
+        print "DEBUG : antenna -> line index = %s" % (ant_line_idx)
+
+    ants = []
+    for ant in range(1, nantennas + 1):
+        if ant not in ant_line_idx:
+            print "WARNING : antenna = %d not found -> skipped" % (ant)
+            continue
+        ants.append(ant)
+
+    # lines of the 4 Jones terms of every antenna :
+    jones_lines = [lines[ant_line_idx[ant] + 2 * j + offset].strip().rstrip(",") for ant in ants for j in range(0, npols)]
+    # 1, +1.000000,+0.000000, +4.353953,+0.600645, +3.444445,-1.117209, +0.863041,+0.023113, +0.881922,-0.081904, +0.964471,-0.189353, +0.912126,-0.240132, +0.878874,-0.009400,
+    values = np.fromstring(",".join(jones_lines), sep=",")
+    values = values.reshape(len(ants), npols, 1 + 2 * len(freq_list_float))
+    wrong_ant = np.any(values[:, :, 0] != values[:, 0:1, 0], axis=1)
+    assert not np.any(wrong_ant), "Wrong antenna numbers %s" % (values[wrong_ant, :, 0])
+
+    # amplitude, phase pairs -> complex gain (ant, frequency, jones) :
+    gains = (values[:, :, 1::2] * np.exp(1j * values[:, :, 2::2])).transpose(0, 2, 1)
+    finech = (freq_list_float / 0.04).astype(int)
+
+    return (coarse_channel, nantennas, np.array(ants, dtype=int), finech, gains)
+
+
 # rts_filename_pattern has to contain "node" otherwise it will not work as it will not find coarse channel correctly 
 def rtsfile_bandpass(metafitsfile, rts_filename_pattern="BandpassCalibration_node[0-9]*.dat", aocal_format=True,
-                     use_fit=False,debug=-1):
+                     use_fit=False,debug=-1,n_workers=1):
     # def rtsfile_bandpass(metafitsfile, rts_filename_pattern="BandpassCalibration_node001.dat", aocal_format=True,use_fit=False):
-    import astropy.io.fits as fits
-
     """
-    Read DI Jones matrices from RTS output files and convert to "aocal" format.
-    Assumes RTS solutions are one per coarse channel.
+    Read bandpass solutions from RTS output files and convert to "aocal" format.
     Needs the associated metafits file to get the antenna ordering right.
+    Node files are read by n_workers processes.
     """
-    # (Relative) comparison of RTS and OFFRINGA polarisation ordering:
-    # OFFRINGA:  XX-R  XX-I  XY-R  XY-I  YX-R  YX-I  YY-R  YY-I
-    # RTS:       YY-R  YY-I  YX-R  YX-I  XY-R  XY-I  XX-R  XX-R
-    pol_map = [3, 2, 1, 0]
-
     # Antenna reording:
-    hdu = fits.open(metafitsfile)
-    ant_map = hdu['TILEDATA'].data['Antenna'][::2]  # only want each tile once
-    hdu.close()
+    ant_map = metafits_tiles.tile_table(metafitsfile)['antenna']  # only want each tile once
 
     # Assumptions:
     nintervals = 1
     npols = 4
-    offset = 0
-    if use_fit:
-        offset = 1
 
-        # Get file names
+    # Get file names
     rts_filenames = sorted(
         glob.glob(rts_filename_pattern))  # <-- Assumes file names are appropriately ordered by channel
     rts_filenames.reverse()
-    nchannels = len(rts_filenames)
 
-    for chan in range(len(rts_filenames)):
-        rts_filename = rts_filenames[chan]
-        
-        # get coarse channel from the file name chan is not good as the order might be reversed !!! as it happen in my tests 
-        idx=rts_filename.find("node")
-        coarse_channel = int( rts_filename[idx+4:idx+4+3] ) - 1 
-        
-        with open(rts_filename, "r") as rts_file:
-            freq_list = rts_file.readline()  # list of frequencies
-            freq_list_str = freq_list.split(",")
-            freq_list_float = np.fromstring(freq_list, sep=",")
-            lines = rts_file.readlines()
-
-            # If first time through, get number of antennas and set up data array for solution
-            if chan == 0:
-                # nantennas = len(lines)/8 
-                nantennas = int(lines[len(lines) - 1].split(",")[0])
-                # print "File %s : number of antennas = %d" % (rts_filename,nantennas)
-                # Create numpy array structure
-                data = np.empty((nintervals, nantennas, nchannels, npols,), dtype=np.complex128)
-                data_out = np.empty((nintervals, nantennas, 768, npols,), dtype=np.complex128)
-                data[:] = np.nan
-                data_out[:] = np.nan
-            else:
-                nantennas_new = int(lines[len(lines) - 1].split(",")[0])
-                assert nantennas_new == nantennas, "Files contain different numbers of antennas"
-
-            print "File %s : nantennas = %d , lines = %d" % (rts_filename, nantennas, len(lines))
-            # print lines[0]
-            # print lines[1]
-            # print lines[2]
-            # print lines[3]
-            # print "----------------------------------------"
-
-            # Parse each line
-            for ant in range(1, nantennas + 1):
-                # ant_line_idx = ant*8 # 8 lines per antenna
-                ant_line_idx = -1
-                for k in range(0, len(lines)):
-                    aaa = int(lines[k].split(",")[0])
-                    if aaa == ant:
-                        ant_line_idx = k
-                        break
-
-                if ant_line_idx < 0:
-                    print "WARNING : antenna = %d not found -> skipped" % (ant)
-                    continue
-
-                print "antenna = %d" % (ant)
-                line_j0 = lines[ant_line_idx + offset]
-                line_j1 = lines[ant_line_idx + 2 + offset]
-                line_j2 = lines[ant_line_idx + 4 + offset]
-                line_j3 = lines[ant_line_idx + 6 + offset]
-                
-                if debug > 0 : 
-                    print "DEBUG : lines %d , %d , %d , %d" % (ant_line_idx+offset,ant_line_idx+2+offset,ant_line_idx+4+offset,ant_line_idx+6+offset)
-                    print lines[ant_line_idx+offset]
-                    print lines[ant_line_idx+2+offset]
-                    print lines[ant_line_idx+4+offset]
-                    print lines[ant_line_idx+6+offset]
-                    print "----------------------------------------------------------------------"
-
-                j0 = np.fromstring(line_j0, sep=",")
-                j1 = np.fromstring(line_j1, sep=",")
-                j2 = np.fromstring(line_j2, sep=",")
-                j3 = np.fromstring(line_j3, sep=",")
-
-                # print "DEBUG : idx = %d , antenna=%d starts at line = %d [%d,%d,%d,%d]" % (ant_line_idx+offset,ant,ant_line_idx,j0[0],j1[0],j2[0],j3[0])
-                # print "%s" % (line_j0)
-                # print "%s" % (line_j1)
-                # print "%s" % (line_j2)
-                # print "%s" % (line_j3)
-
-                ant_idx = ant_map[ant - 1]
-                # for pol in range(len(pol_map)):
-                #    p = pol_map[pol]
-                # data[0,ant_idx,coarse_channel,pol] = float(jones_str[2*p]) + float(jones_str[2*p+1])*1j
-
-                assert j0[0] == j1[0] and j1[0] == j2[0] and j2[0] == j3[
-                    0], "Wrong antenna number %d vs. %d vs. %d vs. %d" % (j0[0], j1[0], j2[0], j3[0])
-
-                # print "size(freq_list) = %d vs. len(j0) = %d" % (len(freq_list_float),len(j0))
-                # 1, +1.000000,+0.000000, +4.353953,+0.600645, +3.444445,-1.117209, +0.863041,+0.023113, +0.881922,-0.081904, +0.964471,-0.189353, +0.912126,-0.240132, +0.878874,-0.009400,
-                ant_idx_file = j0[0]
-                for i in range(0, len(freq_list_float)):
-                    finech = int(freq_list_float[i] / 0.04)
-                    
-                    if debug > 0 :
-                       print "ANTIDX_%d : %.6f %.6f" % (ant_idx,j0[1 + 2 * i],j0[1 + 2 * i + 1])
-                       
-                    data_out[0, ant_idx, finech + coarse_channel * 32, 0] = j0[1 + 2 * i] * cmath.exp(j0[1 + 2 * i + 1] * 1j)
-                    data_out[0, ant_idx, finech + coarse_channel * 32, 1] = j1[1 + 2 * i] * cmath.exp(j1[1 + 2 * i + 1] * 1j)
-                    data_out[0, ant_idx, finech + coarse_channel * 32, 2] = j2[1 + 2 * i] * cmath.exp(j2[1 + 2 * i + 1] * 1j)
-                    data_out[0, ant_idx, finech + coarse_channel * 32, 3] = j3[1 + 2 * i] * cmath.exp(j3[1 + 2 * i + 1] * 1j)
-
-                    # for finech in range(0,32) :
-                    #   data_out[0,ant_idx,finech+coarse_channel*32,pol] = data[0,ant_idx,coarse_channel,pol]
-
-                    if aocal_format :
-                        data_out[0,ant_idx,finech+coarse_channel*32,pol] = 1.00 / data_out[0,ant_idx,finech+coarse_channel*32,pol]
-
-                    # if ant == 2 and pol==0 :
-                    #   print "%d %.4f" % (coarse_channel,abs(data_out[0,ant_idx,coarse_channel,pol]))
+    data_out = None
+    for (coarse_channel, nantennas_file, ants, finech, gains) in pool_map(read_rts_bandpass_node, [(rts_filename, use_fit, debug) for rts_filename in rts_filenames], n_workers):
+        # If first time through, get number of antennas and set up data array for solution
+        if data_out is None:
+            nantennas = nantennas_file
+            data_out = np.empty((nintervals, nantennas, N_FINE_CHANNELS, npols,), dtype=np.complex128)
+            data_out[:] = np.nan
+        else:
+            assert nantennas_file == nantennas, "Files contain different numbers of antennas"
+
+        if aocal_format :
+            gains = 1.00 / gains
+
+        ant_idx = ant_map[ants - 1]
+        data_out[0, ant_idx[:, np.newaxis], (finech + coarse_channel * N_FINE_CHANNELS_PER_COARSE)[np.newaxis, :], :] = gains
 
     new_aocal = AOCal(data_out, 0, 0)
     return new_aocal
@@ -629,13 +1170,10 @@ def dump_ao_calsolutions( calfile, options, ant=-1, do_phase=0, do_fit=0, do_rei
               sys.exit(-1)
           else :
               if os.path.exists(options.metafits) :
-                  fits = pyfits.open(options.metafits)
-                  header = fits[0].header   
-                  try : 
-                      channels_str=header['CHANNELS']
-                  except :
-                      print "ERROR : keyword CHANNELS not found in metafits file %s" % (options.metafits)                            
-                  fits.close()
+                  channels_str = metafits_tiles.coarse_channels( options.metafits )
+                  if channels_str is None :
+                      print "ERROR : keyword CHANNELS not found in metafits file %s -> cannot continue with option --ch2freq" % (options.metafits)
+                      sys.exit(-1)
               else :
                   print "ERROR : metafits file %s does not exist -> cannot continue with option --ch2freq" % (options.metafits)    
                   sys.exit(-1)
@@ -649,10 +1187,14 @@ def dump_ao_calsolutions( calfile, options, ant=-1, do_phase=0, do_fit=0, do_rei
       print "start_cc = %d -> start_freq = %.4f MHz" % (start_cc,start_freq)
           
    
-   caldata = fromfile( calfile )
+   mmap_mode = None
+   if ant >= 0 :
+      # single antenna -> only read the required part of the file (copy-on-write so that fit does not modify the file) :
+      mmap_mode = 'c'
+   caldata = fromfile( calfile, mmap_mode=mmap_mode )
    if do_fit > 0 :
       print "Fitting polynomial to amplitudes of calibration solutions"
-      caldata.fit()
+      caldata.fit( n_workers=getattr(options,"n_workers",1) )
       calfile_fitted=calfile.replace('.bin', '_fit.bin')
       caldata.tofile( calfile_fitted )
       print "Saved fitted calibration solutions to file %s" % (calfile_fitted)
@@ -665,6 +1207,14 @@ def dump_ao_calsolutions( calfile, options, ant=-1, do_phase=0, do_fit=0, do_rei
    print "\tNumber of polarisations = %d" % (caldata.n_pol)
    print "\tHeader string           = ||||%s||||" % (caldata.header_string)
 
+   if caldata.n_chan != out_channels :
+       avg_channels = 1
+       if caldata.n_chan > out_channels :
+           avg_channels = ( caldata.n_chan / out_channels )
+
+       print "WARNING : averaging of different number of channels (%d) than required %d -> averaging every %d channels" % (caldata.n_chan,out_channels,avg_channels)
+       caldata = caldata[:,:,0:out_channels*avg_channels,:].average( avg_channels, axis='chan' )
+
    # if just one antenna specified ant>0 -> loop over just 1 ant :
    ant_low_range = ant
    ant_up_range  = ant+1 
@@ -674,277 +1224,277 @@ def dump_ao_calsolutions( calfile, options, ant=-1, do_phase=0, do_fit=0, do_rei
       ant_low_range = 0
       ant_up_range  = caldata.n_ant
 
+   ant_low_range = max( ant_low_range, 0 )
+   ant_up_range  = min( ant_up_range, caldata.n_ant )
+   if ant_up_range <= ant_low_range :
+      print "ERROR : antenna %d not in range 0 - %d -> nothing to dump" % (ant_param,caldata.n_ant-1)
+      return
+
+   # all values are calculated for all dumped antennas / channels / polarisations at once :
+   channels = np.arange(0,caldata.n_chan)
+   ch_freq  = channels.astype(float)
+   if options.channels2freq :
+      ch_freq = channel_frequencies( caldata.n_chan, channels_list )
+      print "Channels converted to frequencies %.4f - %.4f MHz" % (ch_freq[0],ch_freq[-1])
+
+   # all intervals at once, files of interval i get suffix _tNNNN if there is more than one interval :
+   all_solutions = np.asarray( caldata[:,ant_low_range:ant_up_range,:,:] ) # (interval, antenna, channel, pol)
+   all_is_nan = np.zeros( all_solutions.shape[0:3], dtype=bool )
+   if options.swap_nans is not None :
+      all_is_nan = np.isnan( all_solutions[:,:,:,0] )
+
+   if getattr(options,"dump_format","txt") == "npz" :
+      npz_file = out_basename_param + ".npz"
+      if out_basename_param.find("%")>=0 :
+         npz_file = calfile.replace(".bin","_calsolutions.npz")
+      for interval in range(0,caldata.n_int) :
+         interval_npz_file = interval_filename( npz_file, interval, caldata.n_int )
+         save_ao_calsolutions_npz( interval_npz_file, all_solutions[interval], np.arange(ant_low_range,ant_up_range), ch_freq )
+         print "Saved %d antennas to file %s" % (all_solutions.shape[1],interval_npz_file)
+      return
+
+   all_values = None
+   if do_reim <= 0 :
+      # skip values = 1000 which are flagged channels due to RFI :
+      if do_phase > 0 :
+         all_values = np.angle( all_solutions, deg=True )
+      else :
+         all_values = np.abs( all_solutions )
+      # if NaN -> change to -10000.00000000 so that it works the same way as my CASA based script :
+      all_values[all_is_nan] = -10000.00000000
+
+   for interval in range(0,caldata.n_int) :
+     (solutions,is_nan) = (all_solutions[interval],all_is_nan[interval])
+     if all_values is not None :
+        values = all_values[interval]
+     if caldata.n_int > 1 :
+        print "Dumping interval %d / %d" % (interval,caldata.n_int)
+
+     for ant in range(ant_low_range,ant_up_range) :
+       i = ant - ant_low_range
+       # print "DEBUG : ant=%d , ant_param=%d, (ant_up_range-ant_low_range) = %d, find = %d" % (ant,ant_param,(ant_up_range-ant_up_range),out_basename_param.find("%"))
+       if ant_param < 0 and (ant_up_range-ant_low_range)>=2 and out_basename_param.find("%")>=0 :
+           out_basename = out_basename_param % (ant)
+           print "Dumping antenna = %d from range %d - %d -> out_basename = %s" % (ant,ant_low_range,ant_up_range,out_basename)
+
+       keep = np.ones( caldata.n_chan, dtype=bool )
+       if options.skip_nans :
+           keep = ~is_nan[i]
+           if not keep.all() :
+               print "INFO : %d nan values skipped in antenna %d" % (np.count_nonzero(~keep),ant)
+
+       for pol in range(0,4) :
+           filename = interval_filename( out_basename + "_" + POL_NAMES[pol].lower() + ".txt", interval, caldata.n_int )
+           if do_reim > 0 :
+               write_columns( filename, (ch_freq[keep],solutions[i,keep,pol].real,solutions[i,keep,pol].imag), "%.4f %.4f %.4f" )
+           else :
+               write_columns( filename, (ch_freq[keep],values[i,keep,pol],channels[keep]), "%.4f %.4f %d" )
+
+
+def interval_filename( filename, interval, n_int ) :
+   """
+   name of the output file of calibration interval : suffix _tNNNN before the extension, filename unchanged if there is only one interval
+   """
+   if n_int <= 1 :
+      return filename
+   (base,ext) = os.path.splitext( filename )
+   return "%s_t%04d%s" % (base,interval,ext)
+
+
+def write_columns( filename, columns, fmt ) :
+   """
+   write columns (1D arrays of equal length) to text file filename, one row per line formatted with fmt
+
+   the whole file is formatted with a single % operation (no python loop over rows)
+   """
+   rows = np.column_stack( columns )
+   with open( filename, "w" ) as out_f :
+      if rows.shape[0] > 0 :
+         out_f.write( ((fmt + "\n") * rows.shape[0]) % tuple( rows.ravel().tolist() ) )
+
+
+def channel_frequencies( n_chan, channels_list ) :
+   """
+   centre frequencies [MHz] of n_chan fine channels, channels_list is the list of (absolute) coarse channels (as in CHANNELS keyword of metafits)
+   """
+   band      = COARSE_CHANNEL_WIDTH
+   half_band = COARSE_CHANNEL_WIDTH / 2.00
+   ch = np.arange(0,n_chan)
+   cc_absolute = np.array( [int(cc) for cc in channels_list] )[ch / N_FINE_CHANNELS_PER_COARSE]
+   ch_in_cc = ( ch % N_FINE_CHANNELS_PER_COARSE )
+   return ( cc_absolute )*band -  half_band + FINE_CHANNEL/2 + ch_in_cc*FINE_CHANNEL
+
+
+def save_ao_calsolutions_npz( npz_file, solutions, ants, ch_freq ) :
+   """
+   save solutions (antenna, channel, pol) of antennas ants as a single .npz file with amplitude, phase [deg], real and imaginary parts
+   """
+   np.savez( npz_file, ant=ants, freq=ch_freq, channel=np.arange(0,solutions.shape[1]), pol=np.array(POL_NAMES),
+             amp=np.abs(solutions), phase=np.angle(solutions,deg=True), real=solutions.real, imag=solutions.imag )
 
-   for ant in range(ant_low_range,ant_up_range) :
-       if ant >= 0 and ant<128 :
-          # print "DEBUG : ant=%d , ant_param=%d, (ant_up_range-ant_low_range) = %d, find = %d" % (ant,ant_param,(ant_up_range-ant_up_range),out_basename_param.find("%"))
-          if ant_param < 0 and (ant_up_range-ant_low_range)>=2 and out_basename_param.find("%")>=0 :
-              out_basename = out_basename_param % (ant)
-              print "Dumping antenna = %d from range %d - %d -> out_basename = %s" % (ant,ant_low_range,ant_up_range,out_basename)
-              
-       
-          filename_xx = out_basename + "_xx.txt"
-          filename_xy = out_basename + "_xy.txt"
-          filename_yx = out_basename + "_yx.txt"
-          filename_yy = out_basename + "_yy.txt"
-
-          file_xx = open( filename_xx , "w")
-          file_xy = open( filename_xy , "w")
-          file_yx = open( filename_yx , "w")
-          file_yy = open( filename_yy , "w")
-
-          if caldata.n_chan != out_channels :
-              caldata_new = zeros(n_interval=caldata.n_int, n_antennas=caldata.n_ant, n_channel=out_channels, n_pol=caldata.n_pol)
-              avg_channels = 1
-              if caldata.n_chan > out_channels :
-                  avg_channels = ( caldata.n_chan / out_channels )
-
-              print "WARNING : averaging of different number of channels (%d) than required %d -> averaging every %d channels" % (caldata.n_chan,out_channels,avg_channels)
-
-              for integr_idx in range(0,caldata.n_int) :
-                  for ant_idx in range(0,caldata.n_ant) :
-                      for pol_idx in range(0,caldata.n_pol) :
-                          for ch in range(0,out_channels) :
-
-                              sum=0
-                              cnt=0
-                              for ch_fine in range(0,avg_channels):
-                                  ch_idx = avg_channels*ch+ch_fine
-                                  sum += caldata[integr_idx,ant_idx,ch_idx,pol_idx]
-                                  cnt += 1
-
-                              caldata_new[integr_idx,ant_idx,ch,pol_idx] = sum / cnt
-
-
-              caldata = caldata_new.copy()
-              caldata.n_chan = caldata_new.n_chan
-
-
-          for ch in range(0,caldata.n_chan) :
-             is_nan=False
-             if options.swap_nans is not None :
-                 if cmath.isnan( caldata[0,ant,ch,0] ) :
-                     # caldata[0,ant,ch,0] = -10000
-                     is_nan=True
-
-             ch_freq = ch
-             if options.channels2freq :
-#                 ch_freq = start_freq + ch*FINE_CHANNEL
-                  cc = ( ch  / N_FINE_CHANNELS_PER_COARSE ) 
-                  ch_in_cc = ( ch % N_FINE_CHANNELS_PER_COARSE )
-                  cc_absolute = int(channels_list[cc])
-                  ch_freq = ( cc_absolute )*band -  half_band + FINE_CHANNEL/2 + ch_in_cc*FINE_CHANNEL
-                  print "DEBUG : ch=%d -> cc = %d , ch_in_cc = %d -> (cc_absolute) = %d -> ch_freq = %.2f" % (ch,cc,ch_in_cc,cc_absolute,ch_freq)
-
-             if is_nan and options.skip_nans :
-                 print "INFO : nan value skipped in channel = %.4f (channel = %d)" % (ch_freq,ch)
-                 continue
-
-             # if gain_mag > 900 :
-             # set nans :
-             # caldata[0,ant,ch,0].real = math.nan
-             # ...
-             # ...
-             # etc ...
-
-             if do_reim > 0 :
-                out_line_xx = "%.4f %.4f %.4f\n" % (ch_freq,caldata[0,ant,ch,0].real,caldata[0,ant,ch,0].imag)
-                out_line_xy = "%.4f %.4f %.4f\n" % (ch_freq,caldata[0,ant,ch,1].real,caldata[0,ant,ch,1].imag)
-                out_line_yx = "%.4f %.4f %.4f\n" % (ch_freq,caldata[0,ant,ch,2].real,caldata[0,ant,ch,2].imag)
-                out_line_yy = "%.4f %.4f %.4f\n" % (ch_freq,caldata[0,ant,ch,3].real,caldata[0,ant,ch,3].imag)
-             else :
-                # skip values = 1000 which are flagged channels due to RFI :
-    #            if gain_mag < 900 :
-                if do_phase > 0 :
-                   if is_nan :
-                       # if NaN -> change to -10000.00000000 so that it works the same way as my CASA based script :
-                       out_line_xx = "%.4f %.4f %d\n" % (ch_freq,-10000.00000000,ch)
-                       out_line_xy = "%.4f %.4f %d\n" % (ch_freq,-10000.00000000,ch)
-                       out_line_yx = "%.4f %.4f %d\n" % (ch_freq,-10000.00000000,ch)
-                       out_line_yy = "%.4f %.4f %d\n" % (ch_freq,-10000.00000000,ch)
-                   else :
-                       out_line_xx = "%.4f %.4f %d\n" % (ch_freq,cmath.phase(caldata[0,ant,ch,0])*(180.0/math.pi),ch)
-                       out_line_xy = "%.4f %.4f %d\n" % (ch_freq,cmath.phase(caldata[0,ant,ch,1])*(180.0/math.pi),ch)
-                       out_line_yx = "%.4f %.4f %d\n" % (ch_freq,cmath.phase(caldata[0,ant,ch,2])*(180.0/math.pi),ch)
-                       out_line_yy = "%.4f %.4f %d\n" % (ch_freq,cmath.phase(caldata[0,ant,ch,3])*(180.0/math.pi),ch)
-
-                else :
-                   if is_nan :
-                       out_line_xx = "%.4f %.4f %d\n" % (ch_freq,-10000.00000000,ch)
-                       out_line_xy = "%.4f %.4f %d\n" % (ch_freq,-10000.00000000,ch)
-                       out_line_yx = "%.4f %.4f %d\n" % (ch_freq,-10000.00000000,ch)
-                       out_line_yy = "%.4f %.4f %d\n" % (ch_freq,-10000.00000000,ch)
-                   else :
-                       out_line_xx = "%.4f %.4f %d\n" % (ch_freq,abs(caldata[0,ant,ch,0]),ch)
-                       out_line_xy = "%.4f %.4f %d\n" % (ch_freq,abs(caldata[0,ant,ch,1]),ch)
-                       out_line_yx = "%.4f %.4f %d\n" % (ch_freq,abs(caldata[0,ant,ch,2]),ch)
-                       out_line_yy = "%.4f %.4f %d\n" % (ch_freq,abs(caldata[0,ant,ch,3]),ch)
-
-             file_xx.write( out_line_xx )
-             file_xy.write( out_line_xy )
-             file_yx.write( out_line_yx )
-             file_yy.write( out_line_yy )
-
-          file_xx.close()
-          file_xy.close()
-          file_yx.close()
-          file_yy.close()
 
 # 20181020 - changed to make it safe and use MEDIAN, otherwise a single outlier may completely spoil the mean :
 #            alternatively remove all >2 ?
-def mean_not_nan( array ) :
-#   sum  = 0
-#   sum2 = 0
-#   cnt  = 0
-#   
-#   for i in range(0,array.size) :
-#       if not np.isnan(array[i]) and abs(array[i])<1000000.00 :
-#           sum  += array[i]
-#           sum2 += (array[i]*array[i])
-#           cnt  += 1
-#      
-#   mean = np.nan
-#   rms  = np.nan        
-#   if cnt > 0 :        
-#      mean = sum / cnt
-#      rms = math.sqrt( sum2/cnt - (mean*mean) )
-
-   array_sorted = array.copy()
-   array_sorted.sort()
-   mean = array_sorted[array_sorted.size/2]
-   
-   # use interquarile range :
-   q1 = int( array_sorted.size*0.25 ) 
-   q3 = int( array_sorted.size*0.75 )
-   rms  =  (array_sorted[q3] - array_sorted[q1]) / 1.349
-   cnt = array_sorted.size  
-   
-   return (cnt,mean,rms)
+def robust_stats( values, axis=-1 ) :
+   """
+   NaN-aware median, sigma from the interquartile range (IQR/1.349) and number of non-NaN values along axis,
+   calculated for all the other axes at once (e.g. axis=1 of a (4,n_ant) array -> statistics of 4 columns).
+   Percentiles use np.nanpercentile (partition, no full sort), columns which are all NaN give NaN.
+
+   Complex values : median and sigma of the real and imaginary parts are returned as complex numbers.
+
+   returns (cnt, median, sigma)
+   """
+   values = np.asarray( values )
+   if np.iscomplexobj( values ) :
+      bad = np.isnan( values )
+      (cnt, median_re, sigma_re) = robust_stats( np.where( bad, np.nan, values.real ), axis=axis )
+      (cnt, median_im, sigma_im) = robust_stats( np.where( bad, np.nan, values.imag ), axis=axis )
+      return (cnt, median_re + 1j*median_im, sigma_re + 1j*sigma_im)
+
+   cnt = (~np.isnan(values)).sum( axis=axis )
+   with warnings.catch_warnings() :
+      # all-NaN columns -> NaN
+      warnings.simplefilter("ignore", RuntimeWarning)
+      (q1, median, q3) = np.nanpercentile( values, [25, 50, 75], axis=axis )
+
+   return (cnt, median, (q3 - q1) / 1.349)
 
                      
-# max_rms - maximum allowed value of RMS                      
-def calc_mean_rms( calfile, do_fit=0, verb=0, do_phase=False, max_rms=1.00, outfile=None ) :
-   caldata_original = fromfile( calfile )     # to store original calibration solutions
-   caldata          = caldata_original.copy() # to store fit
-   residuals        = caldata_original.copy() # data to test quality 
+# per-antenna statistics of calibration solutions (one row per antenna) :
+CALSTATS_DTYPE = [('ant', 'i4'), ('cnt_x', 'i4'), ('cnt_y', 'i4'), ('nan_cnt_x', 'i4'), ('nan_cnt_y', 'i4'),
+                  ('mean_x', 'f8'), ('mean_y', 'f8'), ('rms_x', 'f8'), ('rms_y', 'f8')]
+
+CalStats = namedtuple("CalStats",
+                      "table ok_cnt_x mean_mean_x rms_mean_x mean_rms_x rms_rms_x ok_cnt_y mean_mean_y rms_mean_y mean_rms_y rms_rms_y "
+                      "cnt_mean_x cnt_rms_x cnt_mean_y cnt_rms_y")
+
+# summary statistics of an interval in batch summary and archive (cnt_* - number of antennas with non-NaN mean / rms) :
+CALSTATS_SUMMARY = ["ok_cnt_x", "mean_mean_x", "rms_mean_x", "mean_rms_x", "rms_rms_x",
+                    "ok_cnt_y", "mean_mean_y", "rms_mean_y", "mean_rms_y", "rms_rms_y"]
+
+
+def mean_rms_stats( residuals, do_phase=False, max_rms=1.00, interval=0 ) :
+   """
+   mean and rms of amplitude (or phase in degrees) of X and Y residuals of every antenna in calibration interval
+   (interval=None : all intervals at once)
+
+   NaN values and values >1e6 are not included (they are counted in nan_cnt_x/nan_cnt_y).
+
+   returns CalStats with table - structured array (dtype CALSTATS_DTYPE) with one row per antenna,
+   and summary statistics over antennas. For interval=None the table has shape (interval, antenna) and
+   the summary statistics are arrays with one value per interval (see interval_stats).
+   cnt_mean_x, cnt_rms_x, ... are the numbers of antennas with non-NaN mean and rms included in the summary statistics.
+   """
+   res = np.asarray(residuals)
+   if interval is not None :
+      res = res[interval:interval+1]
+   res = res[:, :, :, [0,3]] # (interval, antenna, channel, X/Y)
+   if do_phase :
+      vals = np.angle( res, deg=True )
+   else :
+      vals = np.abs( res )
+
+   bad = np.isnan(vals)
+   bad[~bad] = np.abs(vals[~bad]) > 1000000.00
+   vals[bad] = np.nan
+
+   with warnings.catch_warnings() :
+      # antennas with all values flagged -> NaN mean/rms
+      warnings.simplefilter("ignore", RuntimeWarning)
+      mean = np.nanmean( vals, axis=2 )
+      rms  = np.nanstd( vals, axis=2 )
+   cnt = (~bad).sum(axis=2)
+   nan_cnt = bad.sum(axis=2)
+
+   table = np.zeros( res.shape[0:2], dtype=CALSTATS_DTYPE )
+   table['ant'] = np.arange( res.shape[1] )[np.newaxis,:]
+   table['cnt_x'] = cnt[:,:,0]
+   table['cnt_y'] = cnt[:,:,1]
+   table['nan_cnt_x'] = nan_cnt[:,:,0]
+   table['nan_cnt_y'] = nan_cnt[:,:,1]
+   table['mean_x'] = mean[:,:,0]
+   table['mean_y'] = mean[:,:,1]
+   table['rms_x'] = rms[:,:,0]
+   table['rms_y'] = rms[:,:,1]
+
+   with np.errstate(invalid='ignore') :
+      (ok_cnt_x,ok_cnt_y) = (rms < max_rms).sum(axis=1).T
+
+   # median and IQR-sigma over antennas of the mean and rms columns :
+   (counts,medians,sigmas) = robust_stats( np.array( (table['mean_x'],table['rms_x'],table['mean_y'],table['rms_y']) ), axis=2 )
+   (cnt_mean_x,cnt_rms_x,cnt_mean_y,cnt_rms_y) = counts
+   (mean_mean_x,mean_rms_x,mean_mean_y,mean_rms_y) = medians
+   (rms_mean_x,rms_rms_x,rms_mean_y,rms_rms_y) = sigmas
+
+   stats = CalStats(table,ok_cnt_x,mean_mean_x,rms_mean_x,mean_rms_x,rms_rms_x,ok_cnt_y,mean_mean_y,rms_mean_y,mean_rms_y,rms_rms_y,
+                    cnt_mean_x,cnt_rms_x,cnt_mean_y,cnt_rms_y)
+   if interval is not None :
+      return interval_stats( stats, 0 )
+   return stats
+
+
+def interval_stats( stats, interval ) :
+   """
+   CalStats of a single interval from the CalStats of all intervals (mean_rms_stats with interval=None)
+   """
+   return CalStats( *[ field[interval] for field in stats ] )
+
+
+# max_rms - maximum allowed value of RMS
+# n_workers - number of processes used for fitting (antennas are split between processes)
+# caldata, calfit - already read solutions and their fit (if available), to avoid reading / fitting again
+def calc_mean_rms( calfile, do_fit=0, verb=0, do_phase=False, max_rms=1.00, outfile=None, n_workers=1, caldata=None, calfit=None ) :
+   """
+   calculate statistics of calibration solutions (or residuals from the fit if do_fit>0), print and save them to outfile
+
+   (one file per calibration interval, see interval_filename)
+
+   returns CalStats of all intervals (see mean_rms_stats with interval=None and interval_stats)
+   """
+   caldata_original = caldata                 # to store original calibration solutions
+   if caldata_original is None :
+      caldata_original = fromfile( calfile )
+   residuals        = caldata_original        # data to test quality
    if outfile is None :
       outfile = calfile.replace(".bin","_stat.txt")
 
    if do_fit > 0 :
-      print "Fitting polynomial to amplitudes of calibration solutions"
-      caldata.fit( amp_order=do_fit )
-      residuals = caldata_original - caldata
-
-   rms_x = np.zeros( caldata_original.n_ant )
-   rms_y = np.zeros( caldata_original.n_ant )
-   mean_x = np.zeros( caldata_original.n_ant, dtype=complex )
-   mean_y = np.zeros( caldata_original.n_ant, dtype=complex )
-   out_cnt_x = np.zeros( caldata_original.n_ant )
-   out_cnt_y = np.zeros( caldata_original.n_ant )
-   out_nan_cnt_x = np.zeros( caldata_original.n_ant )
-   out_nan_cnt_y = np.zeros( caldata_original.n_ant )
-  
-   ok_cnt_x = 0
-   ok_cnt_y = 0
-   
-   for ant in range(0,residuals.n_ant) :
-      # rms_x[ant] = residuals[0,ant,:,0].std()
-      # rms_y[ant] = residuals[0,ant,:,3].std()
-      # mean_x[ant] = residuals[0,ant,:,0].mean()
-      # mean_y[ant] = residuals[0,ant,:,3].mean()
-      
-      print
-      print "ANTENNA = %d" % (ant)
-      
-      # just a test :
-      sum_x=0
-      sum2_x=0
-      sum_y=0
-      sum2_y=0
-      cnt_x=0
-      cnt_y=0
-      nan_cnt_x=0
-      nan_cnt_y=0
-      for ch in range(0,residuals.n_chan) :
-         val_x = abs(residuals[0,ant,ch,0])
-         val_y = abs(residuals[0,ant,ch,3])
-         
-         if do_phase :
-             val_x = cmath.phase(residuals[0,ant,ch,0]) * (180.00/math.pi)
-             val_y = cmath.phase(residuals[0,ant,ch,3]) * (180.00/math.pi)
-
-        
-         if verb > 0 : 
-             print "\tDEBUG %d : %.8f %.8f" % (ch,val_x,val_y)
-
-         if cmath.isnan(val_x) or abs(val_x)>1000000.00 :
-             nan_cnt_x += 1
-         else :
-             sum_x  += val_x
-             sum2_x += (val_x*val_x)
-             cnt_x  += 1 
-
-         if cmath.isnan(val_y) or abs(val_y)>1000000.00 :
-             nan_cnt_y += 1
-         else :
-             sum_y  += val_y
-             sum2_y += (val_y*val_y)
-             cnt_y  += 1 
-
-      
-      test_mean_x = np.nan
-      test_rms_x = np.nan      
-      if cnt_x > 0 :
-          test_mean_x = sum_x / cnt_x
-          
-          test_rms_x = np.nan
-          sqrt_arg_x = sum2_x / cnt_x - test_mean_x*test_mean_x
-          if sqrt_arg_x > 0 :
-              test_rms_x = math.sqrt( sqrt_arg_x )
-          else :
-              print "\tERROR (X): negative value in SQRT( %.4f ) = SQRT( %.4f - %.4f)" % (sqrt_arg_x,(sum2_x / cnt_x),(test_mean_x*test_mean_x))
-      else :
-          print "\tERROR (X): no not-NaN values"
-
-      
-      test_mean_y = np.nan
-      test_rms_y = np.nan      
-      if cnt_y > 0 :
-          test_mean_y = sum_y / cnt_y      
-          
-          sqrt_arg_y = sum2_y / cnt_y - test_mean_y*test_mean_y
-          if sqrt_arg_y > 0 :      
-              test_rms_y = math.sqrt( sum2_y / cnt_y - test_mean_y*test_mean_y )
-          else :
-              print "\tERROR (Y): negative value in SQRT( %.4f ) = SQRT( %.4f - %.4f)" % (sqrt_arg_y,(sum2_y / cnt_y),(test_mean_y*test_mean_y))
-      else :
-           print "\tERROR (Y): no not-NaN values"
-      
-      rms_x[ant] = test_rms_x
-      rms_y[ant] = test_rms_y
-      mean_x[ant] = test_mean_x
-      mean_y[ant] = test_mean_y
-      out_cnt_x[ant] = cnt_x
-      out_cnt_y[ant] = cnt_y
-      out_nan_cnt_x[ant] = nan_cnt_x
-      out_nan_cnt_y[ant] = nan_cnt_y
-      
-      if not np.isnan(rms_x[ant]) and rms_x[ant] < max_rms :
-         ok_cnt_x += 1
-
-      if not np.isnan(rms_y[ant]) and rms_y[ant] < max_rms :
-         ok_cnt_y += 1
-       
-      
-      # print "ANT %03d : RMS X / Y = %.3f / %.3f ( test %.3f / %.3f ) , MEAN X / Y = %.3f / %.3f ( test %.3f / %.3f ) , non-NaN = %d / %d , NaN = %d / %d" % (ant,rms_x[ant],rms_y[ant],test_rms_x,test_rms_y,mean_x[ant],mean_y[ant],test_mean_x,test_mean_y,cnt_x,cnt_y,nan_cnt_x,nan_cnt_y)
-      print "\tANT %03d : MEAN +/- RMS (X) = %.3f +/- %.3f , MEAN +/- RMS (Y) = %.3f +/- %.3f , non-NaN = %d / %d , NaN = %d / %d" % (ant,mean_x[ant],rms_x[ant],mean_y[ant],rms_y[ant],cnt_x,cnt_y,nan_cnt_x,nan_cnt_y)
-
-
-   (cnt_ok_test_x,mean_mean_x,rms_mean_x) = mean_not_nan( mean_x )
-   (cnt_ok_test2_x,mean_rms_x,rms_rms_x) = mean_not_nan( rms_x )           
-
-   (cnt_ok_test_y,mean_mean_y,rms_mean_y) = mean_not_nan( mean_y )
-   (cnt_ok_test2_y,mean_rms_y,rms_rms_y) = mean_not_nan( rms_y )           
+      if calfit is None :
+         print "Fitting polynomial to amplitudes of calibration solutions"
+         calfit = caldata_original.copy() # to store fit
+         calfit.fit( amp_order=do_fit, n_workers=n_workers )
+      residuals = caldata_original - calfit
+
+   # all intervals at once :
+   all_stats = mean_rms_stats( residuals, do_phase=do_phase, max_rms=max_rms, interval=None )
+
+   for interval in range(0,residuals.n_int) :
+      stats = interval_stats( all_stats, interval )
+      if residuals.n_int > 1 :
+         print "Calibration interval %d / %d :" % (interval,residuals.n_int)
+      write_stats_file( interval_filename( outfile, interval, residuals.n_int ), stats, residuals[interval], do_phase=do_phase, verb=verb )
+
+   return all_stats
+
+
+def write_stats_file( outfile, stats, residuals, do_phase=False, verb=0 ) :
+   """
+   print statistics (CalStats) of a single calibration interval and save them to outfile,
+   residuals (antenna, channel, pol) are only used for debug output (verb>0)
+   """
+   table = stats.table
+
+   if verb > 0 :
+      for ant in range(0,residuals.shape[0]) :
+         for ch in range(0,residuals.shape[1]) :
+            if do_phase :
+               print "\tDEBUG %d %d : %.8f %.8f" % (ant,ch,np.angle(residuals[ant,ch,0],deg=True),np.angle(residuals[ant,ch,3],deg=True))
+            else :
+               print "\tDEBUG %d %d : %.8f %.8f" % (ant,ch,abs(residuals[ant,ch,0]),abs(residuals[ant,ch,3]))
+
+   for row in table :
+      print "\tANT %03d : MEAN +/- RMS (X) = %.3f +/- %.3f , MEAN +/- RMS (Y) = %.3f +/- %.3f , non-NaN = %d / %d , NaN = %d / %d" % (row['ant'],row['mean_x'],row['rms_x'],row['mean_y'],row['rms_y'],row['cnt_x'],row['cnt_y'],row['nan_cnt_x'],row['nan_cnt_y'])
 
    out_f = open( outfile , "w" )
    print
@@ -956,15 +1506,15 @@ def calc_mean_rms( calfile, do_fit=0, verb=0, do_phase=False, max_rms=1.00, outf
    print line
    out_f.write( line + "\n" )
    
-   line =  "# \t# ok tiles = %d ( %d / %d )" % (ok_cnt_x,cnt_ok_test_x,cnt_ok_test2_x)
+   line =  "# \t# ok tiles = %d ( %d / %d )" % (stats.ok_cnt_x,stats.cnt_mean_x,stats.cnt_rms_x)
    print line
    out_f.write( line + "\n" )
 
-   line = "# \t<MEAN>     = %.4f +/- %.4f" %  (mean_mean_x,rms_mean_x)
+   line = "# \t<MEAN>     = %.4f +/- %.4f" %  (stats.mean_mean_x,stats.rms_mean_x)
    print line
    out_f.write( line + "\n" )
 
-   line =  "# \t<RMS>      = %.4f +/- %.4f" %  (mean_rms_x,rms_rms_x)
+   line =  "# \t<RMS>      = %.4f +/- %.4f" %  (stats.mean_rms_x,stats.rms_rms_x)
    print line
    out_f.write( line + "\n\n" )
 
@@ -973,188 +1523,185 @@ def calc_mean_rms( calfile, do_fit=0, verb=0, do_phase=False, max_rms=1.00, outf
    print line
    out_f.write( line + "\n" )
 
-   line =  "# \t# ok tiles = %d ( %d / %d )" % (ok_cnt_y,cnt_ok_test_y,cnt_ok_test2_y)
+   line =  "# \t# ok tiles = %d ( %d / %d )" % (stats.ok_cnt_y,stats.cnt_mean_y,stats.cnt_rms_y)
    print line
    out_f.write( line + "\n" )
 
-   line =  "# \t<MEAN>     = %.4f +/- %.4f" %  (mean_mean_y,rms_mean_y)
+   line =  "# \t<MEAN>     = %.4f +/- %.4f" %  (stats.mean_mean_y,stats.rms_mean_y)
    print line
    out_f.write( line + "\n" )
 
-   line =  "# \t<RMS>      = %.4f +/- %.4f" %  (mean_rms_y,rms_rms_y)
+   line =  "# \t<RMS>      = %.4f +/- %.4f" %  (stats.mean_rms_y,stats.rms_rms_y)
    print line
    out_f.write( line + "\n" )
 
    print
    
    out_f.write( "# ANT  CNT_OK_X   CNT_OK_Y   MEAN_X    MEAN_Y    RMS_X    RMS_X    NAN_CNT_X    NAN_CNT_Y\n")
-   for ant in range(0,residuals.n_ant) : 
+   for row in table :
       line =    "%03d      %d        %d      %.4f    %.4f    %.4f   %.4f      %d           %d\n" % (
-                ant,out_cnt_x[ant],out_cnt_y[ant],mean_x[ant],mean_y[ant],rms_x[ant],rms_y[ant],out_nan_cnt_x[ant],out_nan_cnt_y[ant])
+                row['ant'],row['cnt_x'],row['cnt_y'],row['mean_x'],row['mean_y'],row['rms_x'],row['rms_y'],row['nan_cnt_x'],row['nan_cnt_y'])
       out_f.write( line )                                                                            
    
    out_f.close()
 
-   return (ok_cnt_x,mean_x,rms_x,out_cnt_x,out_nan_cnt_x,mean_mean_x,rms_mean_x,mean_rms_x,rms_rms_x,
-           ok_cnt_y,mean_y,rms_y,out_cnt_y,out_nan_cnt_y,mean_mean_y,rms_mean_y,mean_rms_y,rms_rms_y)
-              
-   
-def plotcal( calfile, caldata=None, nx=16, ny=8, outdir="images/", do_show=True, min_y=0, max_y=1, do_fit=0, metafits=None, plotall=True, phase=0, obsid=-1, block_image=False, wrong_channels=0 ) :
-   basename = calfile.replace(".bin","")
-   if obsid <= 0 : 
-       obsid = int(basename)
-   outdir = "%s/%s/" % (outdir,basename)   
-   mkdir_p( outdir )
-   
-   if phase > 0 :
-      min_y = -190.0
-      max_y = +190.0
-   
-   if metafits is None :
-       metafits = "%s.metafits" % (basename)
-      
-   if not os.path.exists(metafits):
-      # download if metafits does not exist :
-      wget_string = "wget http://mwa-metadata01.pawsey.org.au/metadata/fits/?obs_id=%d -O %d.metafits" % (obsid,obsid)
-      print "%s" % wget_string
-      os.system(wget_string)
-      
-      
-   tiles=None    
-   if os.path.exists(metafits):
-      out_tile_list="%s.tile_list" % (basename)
-   
-      fits = pyfits.open(metafits)
-      table = fits[1].data
-      tiles = list_tile_name( table, out_tile_list )
-      fits.close()
-
-
-   if caldata is None :
-      caldata = fromfile( calfile )
-
-   calfit = None 
-   if do_fit > 0 :       
-      calfit = caldata.copy()   
-      print "Fitting polynomial to amplitudes of calibration solutions"
-      calfit.fit( amp_order=do_fit )
-      
-   fig  = pyplot.figure(0,figsize=(20,10))
-#   pyplot.title( calfile )
-   
-   channels = np.arange(0,caldata.n_chan)
-
-   if plotall :   
-       drawn=0
-       page=1
-       images_per_page = nx*ny
-       image_on_page   = 0
-   
-       print "Drawing %d x %d = %d antennas per page (%d ants in %s)" % (nx,ny,images_per_page,caldata.n_ant,calfile)
-   
-       for ant in range(0,caldata.n_ant) :
-           ant_str = "%03d" % (ant)
-           if tiles is not None :
-               ant_str = "%03d / %s" % (ant,tiles[ant])
-           # if image_on_page == 0 :
-           #     title = calfile + (" page %02d" % page )
-           #     pyplot.text( caldata.n_chan, max_y*1.2, title )
-           #    pyplot.title( calfile + (" page %02d" % page ) )
-       
-           ax = fig.add_subplot( nx, ny , (image_on_page+1) ) # create axes within the figure : we have 1 plot in X direction, 1 plot in Y direction and we select plot 1
-#           ax = fig.add_subplot( 1, 1 , ant+1)
-       #    ax.set_xlim(0,caldata.n_chan)
-           ax.set_ylim(bottom=min_y,top=max_y)
-
-
-           if ( image_on_page % nx ) == 0 :
-              # ax.set_xlabel('Channel')
-              if phase > 0 :
-                  ax.set_ylabel('Phase [deg]')
-              else :
-                  ax.set_ylabel('Amplitude')
-           if ( image_on_page / nx ) == (ny-1) :
-              ax.set_xlabel('Channel')
-       
-           val_x = abs(caldata[0,ant,:,0])
-           val_y = abs(caldata[0,ant,:,3])
-           
-           if phase > 0 :
-               val_x =  np.angle(caldata[0,ant,:,0],deg=True) 
-               val_y =  np.angle(caldata[0,ant,:,3],deg=True) 
-
-       
-#           print "DEBUG : ant = %d -> size = %d / %d -> min/max = %.4f / %.4f" % (ant,val_x.size,val_y.size,np.nanmin(val_x),np.nanmax(val_x))
-           if val_x.size <= 0 or ( np.isnan( np.min(val_x) ) and np.isnan( np.max(val_x) ) ):
-               ax.set_xlim(0,caldata.n_chan)
-       
-
-           ax.plot( channels, val_x , color="blue" , marker="x", markersize=1 ) # green=Y
-           ax.plot( channels, val_y , color="green", marker="x", markersize=1 ) # green=Y
-#           ax.scatter( channels, val_x , color="blue", marker="+", markersize=1 )  # blue =X
-#           ax.scatter( channels, val_y , color="green", marker="+", markersize=1 ) # green=Y
-           pyplot.text( caldata.n_chan*0.4 , max_y*0.8, ant_str )
-       
-           if image_on_page == 0 :
-               title = calfile + (" page %02d" % page )
-               pyplot.text( caldata.n_chan, max_y*1.2, title )
-          #    pyplot.title( calfile + (" page %02d" % page ) )
-
-       
-           if calfit is not None :
-               fit_x = abs(calfit[0,ant,:,0])
-               fit_y = abs(calfit[0,ant,:,3])
-               
-               if phase > 0 :
-                   fit_x = np.angle(calfit[0,ant,:,0],deg=True)
-                   fit_y = np.angle(calfit[0,ant,:,3],deg=True)
-          
-               ax.plot( channels, fit_x , color="black", linewidth=1 )
-               ax.plot( channels, fit_y , color="yellow", linewidth=1 )
-       
-           drawn += 1
-           image_on_page += 1
-       
-           if image_on_page == images_per_page and image_on_page < caldata.n_ant:
-               # save page 
-               pngfile = "%s/%s_amp_%.02d.png" % (outdir,basename,page)
-               if phase > 0 :
-                   pngfile = "%s/%s_phase_%.02d.png" % (outdir,basename,page)
-
-               print "Saved plot of %d antennas to file %s" % (image_on_page,pngfile)
-
-               pyplot.savefig(pngfile)               
-               page += 1 
-               image_on_page = 0
-               if do_show :
-                   pyplot.show(block=False)
-
-               pyplot.pause(1)
-               pyplot.clf()
-
-           # pyplot.title( calfile + (" page %02d" % page ) )
-           
-#       if ant > 10 :       
-#          break
-
-       # plot with all tiles in 1 image :
-       if (nx*ny) >= 128 :
-           pngfile = "%s/%s_amp.png" % (outdir,basename)
-           if phase > 0 :
-              pngfile = "%s/%s_phase.png" % (outdir,basename)
-
-           pyplot.savefig(pngfile)
-           print "Saved file %s" % (pngfile)
-   
-           if do_show :
-               pyplot.show(block=block_image)
 
-#  calc_statistics and show :
-   (ok_cnt_x,mean_x,rms_x,out_cnt_x,out_nan_cnt_x,mean_mean_x,rms_mean_x,mean_rms_x,rms_rms_x,
-    ok_cnt_y,mean_y,rms_y,out_cnt_y,out_nan_cnt_y,mean_mean_y,rms_mean_y,mean_rms_y,rms_rms_y) = calc_mean_rms( calfile, do_fit=options.do_fit, do_phase=0 )
+# thresholds of the bad antenna classification (see classify_antennas) :
+MAX_MEAN_MEAN = 2.00       # bad observation if median over antennas of the mean amplitude is larger
+MAX_MEAN_RMS  = 1.00       # bad observation if median over antennas of the rms is larger
+MIN_OK_FRACTION  = 0.75    # minimum fraction of good channels with non-NaN solutions
+MAX_NAN_FRACTION = 0.25    # maximum fraction of good channels with NaN solutions (not counting wrong_channels)
+
+def classify_antennas( stats, n_chan=None, wrong_channels=0 ) :
+   """
+   bad antennas (drawn red by plotcal) from statistics (CalStats of a single interval or of all intervals, see mean_rms_stats),
+   n_chan - number of channels (default cnt + nan_cnt of every antenna), wrong_channels - channels known to be flagged (edges of coarse channels)
+
+   returns (bad, bad_channels) boolean arrays of the shape of stats.table :
+      bad_channels - too few non-NaN or too many NaN channels in X or Y
+      bad          - bad_channels, NaN mean or rms, or the whole interval is bad (median mean > MAX_MEAN_MEAN or median rms > MAX_MEAN_RMS)
+   """
+   table = stats.table
+   if n_chan is None :
+      n_chan = table['cnt_x'] + table['nan_cnt_x']
+   good_channels = n_chan - wrong_channels
+
+   bad_channels = np.zeros( table.shape, dtype=bool )
+   bad = np.zeros( table.shape, dtype=bool )
+   with np.errstate(invalid='ignore') :
+      for pol in ('x','y') :
+         bad_channels |= ( table['cnt_'+pol] < MIN_OK_FRACTION*good_channels ) | ( (table['nan_cnt_'+pol] - wrong_channels) > MAX_NAN_FRACTION*good_channels )
+         # summary statistics are per interval -> broadcast over antennas :
+         mean_mean = np.asarray( getattr(stats,'mean_mean_'+pol) )[...,np.newaxis]
+         mean_rms  = np.asarray( getattr(stats,'mean_rms_'+pol) )[...,np.newaxis]
+         bad |= np.isnan( table['mean_'+pol] ) | np.isnan( table['rms_'+pol] ) | (mean_mean > MAX_MEAN_MEAN) | (mean_rms > MAX_MEAN_RMS)
+
+   return (bad | bad_channels, bad_channels)
+
+def bad_antennas( stats, n_chan=None, wrong_channels=0 ) :
+   """
+   indices of bad antennas (see classify_antennas), an antenna is bad if it is bad in any interval
+   """
+   bad = classify_antennas( stats, n_chan, wrong_channels )[0]
+   if bad.ndim > 1 :
+      bad = bad.any( axis=0 )
+   return np.nonzero( bad )[0]
+
+def flag_list_line( obsid, ants ) :
+   """
+   line of the obsid list used by cal_transfer.sh and image_S300V3.sh : obsid and comma separated antennas to flag (or none)
+   """
+   ants_str = ",".join( [ "%d" % ant for ant in ants ] )
+   if len(ants_str) == 0 :
+      ants_str = "none"
+   return "%s %s" % (obsid,ants_str)
+
+def write_flag_list( outfile, lines ) :
+   out_f = open( outfile , "w" )
+   for line in lines :
+      out_f.write( line + "\n" )
+   out_f.close()
+   print "Saved flag list of %d observations to file %s" % (len(lines),outfile)
+
+
+def reference_antenna( ao, refant=-1 ) :
+   """
+   reference solutions (interval, channel, pol) : copy of the solutions of antenna refant, or for refant<0 the average antenna
+   with weights |g|^-2 (phase of sum g/|g|^2 and amplitude sum |g|^-1 / sum |g|^-2 over antennas, NaN ignored)
+
+   The average is calculated one interval at a time from 1/g (g/|g|^2 = conj(1/g), |g| |g|^-2 = |1/g|),
+   so that only work buffers of a single interval are needed.
+   """
+   ao = np.asarray( ao )
+   if refant >= 0 :
+      return ao[:, refant].astype( np.complex128 )
+
+   reference = np.empty( (ao.shape[0],) + ao.shape[2:], dtype=np.complex128 )
+   inv = np.empty( ao.shape[1:], dtype=np.complex128 )
+   inv_amp = np.empty( ao.shape[1:], dtype=np.float64 )
+   with np.errstate(divide='ignore', invalid='ignore') :
+      for interval in xrange( ao.shape[0] ) :
+         np.reciprocal( ao[interval], out=inv )
+         inv[~np.isfinite(inv)] = 0.00
+         np.abs( inv, out=inv_amp )
+         sum_inv_amp = inv_amp.sum( axis=0 )
+         np.square( inv_amp, out=inv_amp )
+         sum_inv_amp2 = inv_amp.sum( axis=0 )
+         sum_inv = inv.sum( axis=0 )
+         reference[interval] = np.conj( sum_inv ) / np.abs( sum_inv ) * ( sum_inv_amp / sum_inv_amp2 )
+
+   return reference
+
+def divide_by_refant( ao, refant=-1, out=None ) :
+   """
+   solutions of every antenna divided (per polarisation) by the reference solutions (see reference_antenna),
+   out - output array, may be ao itself for in-place division (default new array)
+   """
+   reference = reference_antenna( ao, refant )
+   if out is None :
+      out = np.empty_like( ao )
+   np.divide( ao, reference[:, np.newaxis], out=out )
+   return out
+
+
+def plot_values( caldata, kind, interval=0 ) :
+   """
+   X and Y amplitudes (kind='amp') or phases in degrees (kind='phase') of calibration interval -> array (antenna, channel, X/Y)
+   """
+   xy = np.asarray( caldata[interval][:,:,[0,3]] )
+   if kind == 'phase' :
+      return np.angle( xy, deg=True )
+   return np.abs( xy )
+
+
+def draw_gain_page( fig, values, fit_values, ant_labels, nx, ny, min_y, max_y, kind, title ) :
+   """
+   draw amplitudes or phases (values from plot_values) of one page of antennas as nx x ny subplots of fig
+   """
+   from matplotlib.collections import LineCollection
+
+   n_chan = values.shape[1]
+   channels = np.arange(0,n_chan)
+   colors = ["blue","green"] # green=Y
+   if fit_values is not None :
+      colors += ["black","yellow"]
+
+   for image_on_page in range(0,len(ant_labels)) :
+      ax = fig.add_subplot( nx, ny , (image_on_page+1) ) # create axes within the figure : we have 1 plot in X direction, 1 plot in Y direction and we select plot 1
+      ax.set_xlim(0,n_chan)
+      ax.set_ylim(bottom=min_y,top=max_y)
+
+      if ( image_on_page % nx ) == 0 :
+         if kind == 'phase' :
+            ax.set_ylabel('Phase [deg]')
+         else :
+            ax.set_ylabel('Amplitude')
+      if ( image_on_page / nx ) == (ny-1) :
+         ax.set_xlabel('Channel')
+
+      # all lines of the antenna in a single collection (NaNs leave gaps) :
+      lines = [ values[image_on_page,:,0], values[image_on_page,:,1] ]
+      if fit_values is not None :
+         lines += [ fit_values[image_on_page,:,0], fit_values[image_on_page,:,1] ]
+      segments = [ np.column_stack( (channels,line) ) for line in lines ]
+      ax.add_collection( LineCollection( segments, colors=colors, linewidths=1 ) )
+
+      ax.text( n_chan*0.4 , max_y*0.8, ant_labels[image_on_page] )
+      if image_on_page == 0 :
+         ax.text( n_chan, max_y*1.2, title )
+
+
+def draw_stats_page( fig, stats, n_chan, ant_labels, basename, wrong_channels ) :
+   """
+   draw per-antenna statistics (CalStats from mean_rms_stats) as a grid of text panels, antennas considered bad are red
+   """
+   (ok_cnt_x,mean_mean_x,rms_mean_x,mean_rms_x,rms_rms_x) = stats[1:6]
+   (ok_cnt_y,mean_mean_y,rms_mean_y,mean_rms_y,rms_rms_y) = stats[6:11]
+   (mean_x,rms_x,out_cnt_x,out_nan_cnt_x) = (stats.table['mean_x'],stats.table['rms_x'],stats.table['cnt_x'],stats.table['nan_cnt_x'])
+   (mean_y,rms_y,out_cnt_y,out_nan_cnt_y) = (stats.table['mean_y'],stats.table['rms_y'],stats.table['cnt_y'],stats.table['nan_cnt_y'])
+   n_ant = len(stats.table)
+   (bad,bad_channels) = classify_antennas( stats, n_chan, wrong_channels )
 
-   pyplot.clf()  
-   
    mean_mean_x_str = "%.3f" % (mean_mean_x)
    if len(mean_mean_x_str) > 20 :
        mean_mean_x_str = "NaN (too long)"
@@ -1171,24 +1718,24 @@ def plotcal( calfile, caldata=None, nx=16, ny=8, outdir="images/", do_show=True,
    
    title_color = 'black'
    quality_str = "OK"   
-   if ok_cnt_x < 0.75*caldata.n_ant or ok_cnt_y < 0.75*caldata.n_ant :
+   if ok_cnt_x < 0.75*n_ant or ok_cnt_y < 0.75*n_ant :
       title_color = 'red'
       quality_str = "BAD"
       
    title = "%s , %s ANT = X : %d / %s / %s , Y : %d / %s / %s" % (basename, quality_str, ok_cnt_x, mean_mean_x_str, mean_rms_x_str, ok_cnt_y, mean_mean_y_str, mean_rms_y_str )      
-                                                                                     
-   pyplot.title( title, color=title_color, fontsize=1, y=1.05 )
-   pyplot.axis('off')
-   for ant in range(0,caldata.n_ant) :
-       ant_str = "%03d" % (ant)
-       if tiles is not None :
-           ant_str = "%03d / %s" % (ant,tiles[ant])
-       ax = fig.add_subplot( 16, 8 , (ant+1) )
+
+   ax_title = fig.add_subplot( 1, 1, 1 )
+   ax_title.set_title( title, color=title_color, fontsize=1, y=1.05 )
+   ax_title.axis('off')
+   n_rows = max( 16, (n_ant+7)/8 )
+   for ant in range(0,n_ant) :
+       ant_str = ant_labels[ant]
+       ax = fig.add_subplot( n_rows, 8 , (ant+1) )
        
        ax.set(xlim=(0, 1), ylim=(0, 1), xticks=[], yticks=[], aspect=0.2) # 0.3
 
        if ant == 0 :
-           pyplot.text( 0.5, 1.5, title, fontsize=20, color=title_color )           
+           ax.text( 0.5, 1.5, title, fontsize=20, color=title_color )           
 
        mean_x_str = "%.3f" % (mean_x[ant])
        rms_x_str  = "%.3f" % (rms_x[ant])
@@ -1200,10 +1747,9 @@ def plotcal( calfile, caldata=None, nx=16, ny=8, outdir="images/", do_show=True,
        # to assess quality of calibration solutions we only consider channels known to be good.
        # if some channels (edges of coarse channels) are excluded we don't want to consider them :
        # so we check number of bad channels as (NaN-channels - wrong_channels) to exclude the channels we know are bad :
-       ant_good_channels = caldata.n_chan - wrong_channels
+       ant_good_channels = n_chan - wrong_channels
        color='black'       
-       if np.isnan(mean_x[ant]) or np.isnan(rms_x[ant]) or mean_mean_x>2 or mean_rms_x>1 or out_cnt_x[ant]<(ant_good_channels*0.75) or (out_nan_cnt_x[ant]-wrong_channels)>(0.25*ant_good_channels) or \
-          np.isnan(mean_y[ant]) or np.isnan(rms_y[ant]) or mean_mean_y>2 or mean_rms_y>1 or out_cnt_y[ant]<(ant_good_channels*0.75) or (out_nan_cnt_y[ant]-wrong_channels)>(0.25*ant_good_channels) :          
+       if bad[ant] :
           print "ANT%d is red becuase : mean>2 or rms>1 or is NaN or %d < %d or %d < %d OR %d > %d or %d > %d" % (ant,out_cnt_x[ant],(ant_good_channels*0.75),out_cnt_y[ant],(ant_good_channels*0.75),(out_nan_cnt_x[ant]-wrong_channels),(0.25*ant_good_channels),(out_nan_cnt_y[ant]-wrong_channels),(0.25*ant_good_channels))
           print "Values for X : %.2f , %.2f , %.2f,  %.2f , %d , %d" % (np.isnan(mean_x[ant]),np.isnan(rms_x[ant]),mean_mean_x,mean_rms_x,out_cnt_x[ant], (out_nan_cnt_x[ant]-wrong_channels))
           print "Values for Y : %.2f , %.2f , %.2f,  %.2f , %d , %d" % (np.isnan(mean_y[ant]),np.isnan(rms_y[ant]),mean_mean_y,mean_rms_y,out_cnt_y[ant], (out_nan_cnt_y[ant]-wrong_channels))
@@ -1211,7 +1757,7 @@ def plotcal( calfile, caldata=None, nx=16, ny=8, outdir="images/", do_show=True,
           color = 'red'
           
        
-       pyplot.text( 0., 0.1, info, fontsize=10, color=color )       
+       ax.text( 0., 0.1, info, fontsize=10, color=color )       
 
        mean_y_str = "%.3f" % (mean_y[ant])
        rms_y_str  = "%.3f" % (rms_y[ant])
@@ -1220,75 +1766,322 @@ def plotcal( calfile, caldata=None, nx=16, ny=8, outdir="images/", do_show=True,
            rms_y_str  = "NaN (too long)"
        info = "Y : %s +/- %s" % (mean_y_str,rms_y_str)
 
-       pyplot.text( 0., 0.45, info, fontsize=10, color=color )
+       ax.text( 0., 0.45, info, fontsize=10, color=color )
        desc = "%s / %d / %d" % (ant_str,min(out_cnt_x[ant],out_cnt_y[ant]),max(out_nan_cnt_x[ant],out_nan_cnt_y[ant]))
        
-       if out_cnt_x[ant] < ant_good_channels*0.75 or ( (out_nan_cnt_x[ant] - wrong_channels) > 0.25*ant_good_channels ) or out_cnt_y[ant]<ant_good_channels*0.75 or ( (out_nan_cnt_y[ant]-wrong_channels) > 0.25*ant_good_channels ) :
+       if bad_channels[ant] :
            print "ANT%d is red becuase : %d < %d or %d < %d OR %d > %d or %d > %d" % (ant,out_cnt_x[ant],(ant_good_channels*0.75),out_cnt_y[ant],(ant_good_channels*0.75),(out_nan_cnt_x[ant] - wrong_channels),(0.25*ant_good_channels),(out_nan_cnt_y[ant] - wrong_channels),(0.25*ant_good_channels))           
            color = 'red'
            
-       pyplot.text( 0.1, 0.8, desc, fontsize=8, fontweight='bold', color=color )
+       ax.text( 0.1, 0.8, desc, fontsize=8, fontweight='bold', color=color )
  
    fig.tight_layout(pad=0)
 
 
-#   fig, axs = pyplot.subplots( 16, 8, figsize=(20, 10))
-#   ant=0
-#   for ax in axs.flat:
-#      ax.set(xlim=(0, 1), ylim=(0, 1), xticks=[], yticks=[], aspect=1)
-#      ant_str = "%03d" % (ant)
-#      pyplot.text( 0.7, 0.6, ant_str )
-#      
-#      ant += 1
-#      x1, y1 = 0.3, 0.2
-#      x2, y2 = 0.8, 0.6
-#      ax.plot([x1, x2], [y1, y2], ".")
-#      
-#      print ant_str
-##      ax.annotate("",
-##                xy=(x1, y1), xycoords='data',
-##                xytext=(x2, y2), textcoords='data',
-##                arrowprops=dict(arrowstyle="->",
-##                                color="0.5",
-##                                shrinkA=5, shrinkB=5,
-##                                patchA=None,
-##                                patchB=None,
-##                                connectionstyle="angle3,angleA=90,angleB=0",
-##                                ),
-##               )
-#   
-#   fig.tight_layout(pad=0)
-
-   # pyplot.axis('off')
-#   for ant in range(0,caldata.n_ant) :
-#       ant_str = "%03d" % (ant)
-#       ax = fig.add_subplot( 16, 8 , (ant+1) )
-       
-       # https://matplotlib.org/gallery/userdemo/connectionstyle_demo.html#sphx-glr-gallery-userdemo-connectionstyle-demo-py
-#       ax.set(xlim=(0, 1), ylim=(0, 1), xticks=[], yticks=[], aspect=1)
-##       ax.set_xlim(0,1)
-##       ax.set_ylim(bottom=0,top=1)
-##       ax.axis('off')
-       
-#       pyplot.text( 0.7, 0.6, ant_str )
-#
-#       info = "%.4f +/- %.4f" % (mean_x[ant],rms_x[ant])
-#       pyplot.text( 0.1, 0.1, info, fontsize=5 )
-   
-   # pyplot.axis('off')    
-   # pyplot.gca().axes.get_xaxis().set_visible(False)
-   # pyplot.gca().axes.get_yaxis().set_visible(False)
+def draw_plot_page( fig, page ) :
+   """
+   draw a page prepared by plotcal (dictionary with type = gain or stats, pngfile and args of the drawing function)
+   """
+   if page['type'] == 'stats' :
+      draw_stats_page( fig, **page['args'] )
+   else :
+      draw_gain_page( fig, **page['args'] )
+
+
+def render_plot_page( page ) :
+   """
+   pool_map worker : draw a page prepared by plotcal and save it to page['pngfile'] with the Agg backend (no pyplot / display needed)
+   """
+   from matplotlib.figure import Figure
+   from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+   fig = Figure( figsize=(20,10) )
+   FigureCanvasAgg( fig )
+   draw_plot_page( fig, page )
+   fig.savefig( page['pngfile'] )
+   print "Saved file %s" % (page['pngfile'])
+   return page['pngfile']
+
+
+# headless - render all pages with Agg backend (no pyplot windows, no pauses), pages are rendered in parallel by n_workers processes
+# kinds    - list of gain plots to make ('amp' and/or 'phase'), default is phase if phase>0 otherwise amplitude
+# stats    - already calculated statistics of all intervals (CalStats), otherwise calculated with calc_mean_rms re-using the fit
+# refant   - plot solutions divided by this reference antenna (<0 - average antenna, see reference_antenna), statistics are of the original solutions
+# pages of all calibration intervals are prepared and rendered in one pass, png files of interval i get suffix _tNNNN if there is more than one interval
+def plotcal( calfile, caldata=None, nx=16, ny=8, outdir="images/", do_show=True, min_y=0, max_y=1, do_fit=0, metafits=None, plotall=True, phase=0, obsid=-1, block_image=False, wrong_channels=0,
+             headless=False, n_workers=1, kinds=None, stats=None, refant=None ) :
+   basename = os.path.splitext( os.path.basename(calfile) )[0]
+   if obsid <= 0 : 
+       obsid = int( file_obsid( calfile ) )
+   outdir = "%s/%s/" % (outdir,basename)   
+   mkdir_p( outdir )
    
-   pngfile = "%s/%s_stat_amp.png" % (outdir,basename)
-   if phase > 0 :
-       pngfile = "%s/%s_stat_phase.png" % (outdir,basename)
-   pyplot.savefig(pngfile)
-   print "Saved file %s" % (pngfile)
-   if do_show :
-       pyplot.show(block=block_image)
+   if metafits is None :
+       # next to the solutions file, either with the same name or named by obsid :
+       metafits = "%s.metafits" % (os.path.splitext(calfile)[0])
+       if not os.path.exists(metafits) :
+           metafits = os.path.join( os.path.dirname(calfile), "%d.metafits" % (obsid) )
+      
+   # tile table from the metafits file (parsed once and cached), or offline lookup by obsid if the file is not available :
+   tiles_table = None
+   if os.path.exists(metafits):
+      tiles_table = metafits_tiles.tile_table( metafits )
    else :
-       pyplot.pause(1)
+      tiles_table = metafits_tiles.lookup( obsid )
+      if tiles_table is None :
+         print "WARNING : metafits file %s not found and obsid %d not in local metafits cache -> tile names will not be shown" % (metafits,obsid)
+
+   tiles=None    
+   if tiles_table is not None :
+      out_tile_list="%s.tile_list" % (basename)
+      tiles = list_tile_name( tiles_table, out_tile_list )
+
+
+   if caldata is None :
+      caldata = fromfile( calfile )
+
+   calfit = None 
+   if do_fit > 0 :       
+      calfit = caldata.copy()   
+      print "Fitting polynomial to amplitudes of calibration solutions"
+      calfit.fit( amp_order=do_fit, n_workers=n_workers )
+
+   #  calc_statistics (re-using the fit) :
+   if stats is None :
+      stats = calc_mean_rms( calfile, do_fit=do_fit, do_phase=0, caldata=caldata, calfit=calfit )
+
+   title_suffix = ""
+   if refant is not None :
+      # the same reference for solutions and fit, the fit is our own copy -> divided in place :
+      reference = reference_antenna( caldata, refant )[:, np.newaxis]
+      caldata = np.divide( caldata, reference, out=np.empty_like( caldata ) )
+      if calfit is not None :
+         np.divide( calfit, reference, out=calfit )
+      title_suffix = " refant=%d" % (refant)
+      if refant < 0 :
+         title_suffix = " refant=average"
+
+   ant_labels = []
+   for ant in range(0,caldata.n_ant) :
+       ant_str = "%03d" % (ant)
+       if tiles is not None :
+           ant_str = "%03d / %s" % (ant,tiles[ant])
+       ant_labels.append( ant_str )
+
+   if kinds is None :
+      kinds = ['amp']
+      if phase > 0 :
+         kinds = ['phase']
+
+   # prepare all pages of all intervals, then draw them :
+   pages = []
+   for interval in range(0,caldata.n_int) :
+     interval_title = ""
+     if caldata.n_int > 1 :
+         interval_title = " interval %d" % (interval)
+
+     if plotall :   
+       images_per_page = nx*ny
+       n_pages = (caldata.n_ant + images_per_page - 1) / images_per_page
+       print "Drawing %d x %d = %d antennas per page (%d ants in %s%s)" % (nx,ny,images_per_page,caldata.n_ant,calfile,interval_title)
+
+       for kind in kinds :
+           (kind_min_y,kind_max_y) = (min_y,max_y)
+           if kind == 'phase' :
+               (kind_min_y,kind_max_y) = (-190.0,+190.0)
+           values = plot_values( caldata, kind, interval )
+           fit_values = None
+           if calfit is not None :
+               fit_values = plot_values( calfit, kind, interval )
+
+           for page in range(0,n_pages) :
+               page_ants = slice( page*images_per_page, min( (page+1)*images_per_page, caldata.n_ant ) )
+               pngfile = "%s/%s_%s.png" % (outdir,basename,kind)
+               if n_pages > 1 :
+                   pngfile = "%s/%s_%s_%.02d.png" % (outdir,basename,kind,page+1)
+               page_fit_values = None
+               if fit_values is not None :
+                   page_fit_values = fit_values[page_ants]
+               pages.append( { 'type' : 'gain', 'pngfile' : interval_filename( pngfile, interval, caldata.n_int ),
+                               'args' : { 'values' : values[page_ants], 'fit_values' : page_fit_values, 'ant_labels' : ant_labels[page_ants],
+                                          'nx' : nx, 'ny' : ny, 'min_y' : kind_min_y, 'max_y' : kind_max_y, 'kind' : kind,
+                                          'title' : calfile + interval_title + title_suffix + (" page %02d" % (page+1)) } } )
+
+     pngfile = "%s/%s_stat_amp.png" % (outdir,basename)
+     if phase > 0 :
+         pngfile = "%s/%s_stat_phase.png" % (outdir,basename)
+     pages.append( { 'type' : 'stats', 'pngfile' : interval_filename( pngfile, interval, caldata.n_int ),
+                     'args' : { 'stats' : interval_stats( stats, interval ), 'n_chan' : caldata.n_chan, 'ant_labels' : ant_labels, 'basename' : basename + interval_title, 'wrong_channels' : wrong_channels } } )
+
+   if headless :
+       pool_map( render_plot_page, pages, n_workers )
+       return stats
+
+   # interactive : pages one after another in the same pyplot figure
+   import matplotlib.pyplot as pyplot
+   fig  = pyplot.figure(0,figsize=(20,10))
+   for i in range(0,len(pages)) :
+       pyplot.clf()
+       draw_plot_page( fig, pages[i] )
+       pyplot.savefig( pages[i]['pngfile'] )
+       print "Saved file %s" % (pages[i]['pngfile'])
+
+       if i < len(pages)-1 :
+           if do_show :
+               pyplot.show(block=False)
+           pyplot.pause(1)
+       elif do_show :
+           pyplot.show(block=block_image)
+       else :
+           pyplot.pause(1)
+
+   return stats
       
+def run_action( calfile, options ) :
+   """
+   execute options.action on a single calibration file, returns statistics (CalStats) for calc_rms and plot actions, None otherwise
+   """
+   stats = None
+   if options.action == "dump" :     
+       dump_ao_calsolutions( calfile=calfile, options=options, ant=options.ant, do_phase=options.do_phase, do_fit=options.do_fit, do_reim=options.do_reim, out_basename_param=options.out_basename,  channels_str=options.channels_str )    
+   elif options.action == "calc_rms" or options.action == "rms" :
+       stats = calc_mean_rms( calfile, do_fit=options.do_fit, do_phase=options.do_phase, n_workers=options.n_workers, caldata=read_solutions( calfile, options ) )
+   elif options.action == "plot" :
+       kinds = None
+       if options.plot_kinds is not None :
+           kinds = options.plot_kinds.split(",")
+       stats = plotcal( calfile, caldata=read_solutions( calfile, options ), nx=options.nx, ny=options.ny, do_fit=options.do_fit, phase=options.do_phase, min_y=options.min_y, max_y=options.max_y, wrong_channels=options.wrong_channels, obsid=options.obsid,
+                        headless=options.headless, n_workers=options.n_workers, kinds=kinds, refant=options.refant ) 
+   elif options.action == "flag" :
+       # statistics of all intervals without stat files or plots :
+       caldata = read_solutions( calfile, options )
+       residuals = caldata
+       if options.do_fit > 0 :
+           calfit = caldata.copy()
+           calfit.fit( amp_order=options.do_fit, n_workers=options.n_workers )
+           residuals = caldata - calfit
+       stats = mean_rms_stats( residuals, do_phase=options.do_phase, interval=None )
+   elif options.action == "to_compact" :
+       outfile = options.outbasename
+       if outfile is None :
+           outfile = calfile.replace(".bin","") + ".aocz"
+       bin_to_compact( calfile, outfile, compression=options.compression )
+   elif options.action == "from_compact" :
+       outfile = options.outbasename
+       if outfile is None :
+           outfile = calfile.replace(".aocz","") + ".bin"
+       compact_to_bin( calfile, outfile )
+   elif options.split_by_n_channels > 0 :
+       # def split_bin_file( binfile, split_by_n_channels, outfilebase ):
+       split_bin_file( calfile, options.split_by_n_channels, options.outbasename, n_workers=options.n_workers )
+   elif options.average_n_channels > 0 :
+       # def average_channels( binfile, avg_n_channels, outfile ) :
+       average_channels( calfile, options.average_n_channels, options.outbasename, nan_policy=options.nan_policy )
+   else :   
+       print "ERROR : unknown action = %s" % (options.action)
+
+   if stats is not None and options.flag_list is not None :
+       ants = bad_antennas( stats, wrong_channels=options.wrong_channels )
+       print "Bad antennas : %s" % (ants)
+       write_flag_list( options.flag_list, [ flag_list_line( file_obsid( calfile, options.obsid ), ants ) ] )
+
+   return stats
+
+def file_obsid( calfile, obsid=-1 ) :
+   """
+   obsid if >0, otherwise obsid from the name of the solutions file (e.g. 1056386176_solutions.bin)
+   """
+   if obsid > 0 :
+      return obsid
+   return metafits_tiles.metafits_obsid( calfile )
+
+def read_solutions( calfile, options ) :
+   """
+   read calibration solutions in precision requested by --complex64 
+   """
+   dtype = np.complex128
+   if options.complex64 :
+      dtype = np.complex64
+   return fromfile( calfile, dtype=dtype )
+
+def batch_file_list( batch ) :
+   """
+   list of .bin files for --batch : @listfile (one file per line, # comments) or glob pattern(s) separated by commas
+   """
+   if batch.startswith("@") :
+      calfile_list = []
+      for line in open( batch[1:] ) :
+         line = line.strip()
+         if len(line) > 0 and line[0] != "#" :
+            calfile_list.append( line.split()[0] )
+      return calfile_list
+
+   calfile_list = []
+   for pattern in batch.split(",") :
+      if len(pattern) > 0 :
+         calfile_list.extend( sorted( glob.glob(pattern) ) )
+   return calfile_list
+
+def batch_file_options( calfile, options ) :
+   """
+   copy of options for a single file of a batch : output names get the file basename as prefix (so that files do not overwrite each other),
+   plots are always headless and every file is processed by a single process (the pool is over files)
+   """
+   file_options = copy.copy( options )
+   basename = os.path.basename( calfile ).replace(".bin","")
+   file_options.out_basename = "%s_%s" % (basename,options.out_basename)
+   if options.outbasename is not None :
+      file_options.outbasename = "%s_%s" % (basename,options.outbasename)
+   elif options.split_by_n_channels > 0 :
+      file_options.outbasename = "%s_split%d" % (calfile.replace(".bin",""),options.split_by_n_channels)
+   elif options.average_n_channels > 0 :
+      file_options.outbasename = "%s_avg%d" % (calfile.replace(".bin",""),options.average_n_channels)
+   if options.action in ["plot","flag"] or options.flag_list is not None :
+      # obsid of every file from its name (unless given by --obsid), files not named by obsid are reported as ERROR :
+      file_options.obsid = int( file_obsid( calfile, options.obsid ) )
+   file_options.flag_list = None # flag list of the whole batch is written at the end
+   file_options.headless = True
+   file_options.n_workers = 1
+   
+   return file_options
+
+def run_batch_file( args ) :
+   """
+   pool worker of the batch mode : args = (calfile, options), returns (calfile, status, list of summary statistics tuples
+   (one per calibration interval) or None, bad antennas or None)
+   """
+   (calfile, options) = args
+   try :
+      stats = run_action( calfile, batch_file_options( calfile, options ) )
+   except Exception as e :
+      print "ERROR : processing of file %s failed : %s" % (calfile,e)
+      return (calfile, "ERROR", None, None)
+
+   (summary,ants) = (None,None)
+   if stats is not None :
+      summary = [ tuple( [ getattr( interval_stats( stats, interval ), field ) for field in CALSTATS_SUMMARY ] ) for interval in range(0,len(stats.table)) ]
+      ants = bad_antennas( stats, wrong_channels=options.wrong_channels )
+   return (calfile, "OK", summary, ants)
+
+def write_batch_summary( results, outfile, action ) :
+   """
+   one line per file and calibration interval of the batch with status and summary statistics
+   (interval -1 and nan if the action does not calculate them)
+   """
+   out_f = open( outfile , "w" )
+   out_f.write( "# CALFILE ACTION STATUS INTERVAL %s\n" % (" ".join( [ field.upper() for field in CALSTATS_SUMMARY ] )) )
+   for (calfile, status, summary, ants) in results :
+      intervals = range(0,len(summary or []))
+      if summary is None :
+         (intervals, summary) = ([-1], [(0, np.nan, np.nan, np.nan, np.nan) * 2])
+
+      for (interval, interval_summary) in zip( intervals, summary ) :
+         (ok_cnt_x, mean_mean_x, rms_mean_x, mean_rms_x, rms_rms_x, ok_cnt_y, mean_mean_y, rms_mean_y, mean_rms_y, rms_rms_y) = interval_summary
+         out_f.write( "%s %s %s %d %d %.4f %.4f %.4f %.4f %d %.4f %.4f %.4f %.4f\n" % (calfile,action,status,interval,ok_cnt_x,mean_mean_x,rms_mean_x,mean_rms_x,rms_rms_x,ok_cnt_y,mean_mean_y,rms_mean_y,mean_rms_y,rms_rms_y) )
+   out_f.close()
+   print "Saved batch summary of %d files to %s" % (len(results),outfile)
+      
+
 
                      
 if __name__ == "__main__":                     
@@ -1322,8 +2115,12 @@ if __name__ == "__main__":
     parser.add_option('-p','--phase','--do_phase',dest="do_phase",default=0, help="Dump phase  [default %default , 0 - means dump amplitudes]",type="int")
     parser.add_option('-f','--do_fit','--fit',dest="do_fit",default=0, help="Do fitting  [default %default]",type="int")
     parser.add_option('-i','--do_reim','--reim',dest="do_reim",default=0, help="Save real/imaginary [default %default]",type="int")
-    parser.add_option('-e','--action','--execute',dest="action",default="dump", help="Execute action [default %default], dump - dumps to txtfiles (if no antenna specified or --ant=-1 -> dumps all), calc_rms, plot, merge")
+    parser.add_option('--dump_format',dest="dump_format",default="txt", help="Format of dumped solutions : txt - 4 text files per antenna, npz - single numpy .npz file with all antennas and polarisations [default %default]")
+    parser.add_option('-e','--action','--execute',dest="action",default="dump", help="Execute action [default %default], dump - dumps to txtfiles (if no antenna specified or --ant=-1 -> dumps all), calc_rms, plot, flag, merge, to_compact, from_compact")
     parser.add_option('--plot',dest="do_plot",action="store_true",default=False,help="Do plot in addition to other actions [default %default]")
+    parser.add_option('--headless',dest="headless",action="store_true",default=False,help="Render plots without display (Agg backend, no pauses), pages are rendered in parallel with --n_workers processes [default %default]")
+    parser.add_option('--plot_kinds',dest="plot_kinds",default=None,help="Comma separated list of gain plots to make (amp,phase) [default amp, or phase if --phase>0]")
+    parser.add_option('--refant',dest="refant",default=None,help="Plot solutions divided by reference antenna, negative means divide by the average antenna [default %default]",type="int")
     parser.add_option('--nx',dest="nx",default=16, help="Plot nx  [default %default]",type="int")
     parser.add_option('--ny',dest="ny",default=8,  help="Plot ny  [default %default]",type="int")
     parser.add_option('--min_y',dest="min_y",default=0, help="Min Y value  [default %default]",type="float")
@@ -1341,6 +2138,13 @@ if __name__ == "__main__":
     parser.add_option('--outname','--outbasename','--outfile',dest="outbasename",default=None,help="Output file name base [default %default]");
 # def average_channels( binfile, avg_n_channels, outfile ) :
     parser.add_option('--avg_n_channels','--average_channes','--avg_n',dest="average_n_channels",default=-1,help="Average N channels [default %default and <0 -> no averaging]",type="int");    
+    parser.add_option('--nan_policy',dest="nan_policy",default="propagate",help="NaN handling when averaging channels : propagate - average with a NaN is NaN, omit - NaNs are ignored [default %default]")
+    parser.add_option('-j','--n_workers',dest="n_workers",default=1,help="Number of worker processes used for fitting and statistics [default %default]",type="int")
+    parser.add_option('--complex64',dest="complex64",action="store_true",default=False,help="Keep solutions in memory in single precision (complex64) for calc_rms and plot [default %default]")
+    parser.add_option('--compression',dest="compression",default=None,help="Compression of compact files written by action to_compact : none, zlib or blosc [default %default]")
+    parser.add_option('--batch',dest="batch",default=None,help="Execute the action on many .bin files : glob pattern (e.g. \"*.bin\", comma separated list allowed) or @listfile with one file per line. Files are processed by --n_workers processes (plots are headless) [default %default]")
+    parser.add_option('--flag_list',dest="flag_list",default=None,help="Save antennas classified as bad (red in the statistics plot) to this file in the format of the obsid list of cal_transfer.sh / image_S300V3.sh (obsid ant1,ant2,... or obsid none), for actions calc_rms, plot and flag (default flag_list.txt) [default %default]")
+    parser.add_option('--batch_summary',dest="batch_summary",default="batch_summary.txt",help="Summary table with statistics of all files processed in batch mode [default %default]")
     
     (options,args)=parser.parse_args(sys.argv[1:])
     if options.average_n_channels > 0 :
@@ -1354,6 +2158,8 @@ if __name__ == "__main__":
     
     if options.merged_bin_file is not None :
         options.action = "merge"    
+    if options.action == "flag" and options.flag_list is None :
+        options.flag_list = "flag_list.txt"
 
     band      = COARSE_CHANNEL_WIDTH
     half_band = COARSE_CHANNEL_WIDTH / 2.00
@@ -1386,25 +2192,25 @@ if __name__ == "__main__":
     print "split_by_n_channels = %d" % (options.split_by_n_channels)
     print "average N channels  = %d" % (options.average_n_channels)
     print "out file basename   = %s" % (options.outbasename)
+    print "n_workers           = %d" % (options.n_workers)
+    print "batch               = %s (summary -> %s)" % (options.batch,options.batch_summary)
     print "#######################################################"
 
-    if options.action == "dump" :     
-        dump_ao_calsolutions( calfile=calfile, options=options, ant=options.ant, do_phase=options.do_phase, do_fit=options.do_fit, do_reim=options.do_reim, out_basename_param=options.out_basename,  channels_str=options.channels_str )    
-    elif options.action == "calc_rms" or options.action == "rms" :
-        (ok_cnt_x,mean_x,rms_x,out_cnt_x,out_nan_cnt_x,mean_mean_x,rms_mean_x,mean_rms_x,rms_rms_x,
-         ok_cnt_y,mean_y,rms_y,out_cnt_y,out_nan_cnt_y,mean_mean_y,rms_mean_y,mean_rms_y,rms_rms_y) = calc_mean_rms( calfile, do_fit=options.do_fit, do_phase=options.do_phase )         
-    elif options.action == "plot" :
-        plotcal( calfile, nx=options.nx, ny=options.ny, do_fit=options.do_fit, phase=options.do_phase, min_y=options.min_y, max_y=options.max_y, wrong_channels=options.wrong_channels, obsid=options.obsid ) 
+    if options.batch is not None :
+        # many files processed by a pool of n_workers processes (one file per process) :
+        batch_list = batch_file_list( options.batch )
+        print "Batch of %d files, action = %s" % (len(batch_list),options.action)
+        if options.action == "merge" :
+            print "ERROR : action merge is not supported in batch mode"
+        else :
+            results = pool_map( run_batch_file, [ (batch_calfile, options) for batch_calfile in batch_list ], options.n_workers )
+            write_batch_summary( results, options.batch_summary, options.action )
+            if options.flag_list is not None :
+                write_flag_list( options.flag_list, [ flag_list_line( file_obsid( result[0], options.obsid ), result[3] ) for result in results if result[3] is not None ] )
     elif options.action == "merge" and calfile_list is not None :
         merge_bin_files( calfile_list, options.merged_bin_file )       
-    elif options.split_by_n_channels > 0 :
-        # def split_bin_file( binfile, split_by_n_channels, outfilebase ):
-        split_bin_file( calfile, options.split_by_n_channels, options.outbasename )
-    elif options.average_n_channels > 0 :
-        # def average_channels( binfile, avg_n_channels, outfile ) :
-        average_channels( calfile, options.average_n_channels, options.outbasename )
-    else :   
-        print "ERROR : unknown action = %s" % (options.action)
+    else :
+        run_action( calfile, options )
         
         
 # test in /home/msok/Desktop/MWA/doc/ASVO/data/2013/201306/1056386176/Chris_Jordan_RTS/20180801/1050871872/rts/RTS_NATIVE/ :
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+"""
+Archive of calibration solutions : every ingested .bin file is stored as a compact file (aocal.write_compact,
+one block per antenna) named <obsid>.aocz in the archive directory, and an SQLite index (index.sqlite) keeps
+obsid, time range, channels and quality statistics (aocal.mean_rms_stats) of every calibration interval of every
+observation and antenna.
+
+Queries (antenna_timeseries) select observations from the index and read only the block of the requested
+antenna from each compact file.
+
+Usage :
+   aocal_archive.py ingest ARCHIVE_DIR "*_solutions.bin" [-j 8]
+   aocal_archive.py query ARCHIVE_DIR --ant 57 --pol XX --start 1104192016 --end 1135728017 --outfile tile57_xx.txt
+"""
+
+import sys, os, sqlite3, logging, warnings
+from optparse import OptionParser
+
+import numpy as np
+
+import aocal
+import metafits_tiles
+
+INDEX_FILE = "index.sqlite"
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS solutions (
+   obsid INTEGER, interval INTEGER,
+   calfile TEXT, calfile_mtime REAL, store_file TEXT,
+   time_start REAL, time_end REAL,
+   n_int INTEGER, n_ant INTEGER, n_chan INTEGER, n_pol INTEGER, channels TEXT,
+   ok_cnt_x INTEGER, mean_mean_x REAL, rms_mean_x REAL, mean_rms_x REAL, rms_rms_x REAL,
+   ok_cnt_y INTEGER, mean_mean_y REAL, rms_mean_y REAL, mean_rms_y REAL, rms_rms_y REAL,
+   PRIMARY KEY (obsid, interval)
+);
+CREATE TABLE IF NOT EXISTS antenna_stats (
+   obsid INTEGER, interval INTEGER, ant INTEGER,
+   cnt_x INTEGER, cnt_y INTEGER, nan_cnt_x INTEGER, nan_cnt_y INTEGER,
+   mean_x REAL, mean_y REAL, rms_x REAL, rms_y REAL,
+   PRIMARY KEY (obsid, interval, ant)
+);
+CREATE INDEX IF NOT EXISTS antenna_stats_ant ON antenna_stats (ant, obsid, interval);
+"""
+
+def calfile_obsid(calfile):
+    """
+    obsid from the name of the solutions file (e.g. 1056386176_solutions.bin or 1056386176.bin)
+    """
+    return int(metafits_tiles.metafits_obsid(calfile))
+
+
+def open_index(archive_dir):
+    if not os.path.isdir(archive_dir):
+        os.makedirs(archive_dir)
+    conn = sqlite3.connect(os.path.join(archive_dir, INDEX_FILE))
+    conn.executescript(INDEX_SCHEMA)
+    columns = [column[1] for column in conn.execute("PRAGMA table_info(antenna_stats)")]
+    if "interval" not in columns:
+        conn.close()
+        raise ValueError, "index %s has no per-interval statistics (written by an older version), ingest to a new archive directory" % os.path.join(archive_dir, INDEX_FILE)
+    return conn
+
+
+def store_solutions(args):
+    """
+    pool worker of ingest : args = (calfile, obsid, archive_dir, compression, do_fit),
+    returns (calfile, obsid, solutions rows, antenna_stats rows) with rows of all calibration intervals,
+    rows are None if the file could not be stored (the other files of the pool are still ingested)
+    """
+    try:
+        return archive_solutions(*args)
+    except Exception as e:
+        logging.warning("could not ingest %s : %s", args[0], e)
+        return (args[0], args[1], None, None)
+
+
+def archive_solutions(calfile, obsid, archive_dir, compression='zlib', do_fit=0):
+    """
+    write the compact file of calfile and calculate its statistics, returns (calfile, obsid, solutions rows, antenna_stats rows)
+    """
+    store_file = "%d.aocz" % obsid
+    caldata = aocal.fromfile(calfile)
+    aocal.write_compact(caldata, os.path.join(archive_dir, store_file), compression=compression)
+
+    residuals = caldata
+    if do_fit > 0:
+        calfit = caldata.copy()
+        calfit.fit(amp_order=do_fit)
+        residuals = caldata - calfit
+    stats = aocal.mean_rms_stats(residuals, interval=None)
+
+    channels = None
+    metafits = os.path.join(os.path.dirname(calfile), "%d.metafits" % obsid)
+    if os.path.exists(metafits):
+        channels = metafits_tiles.coarse_channels(metafits)
+
+    rows = []
+    ant_rows = []
+    for interval in range(caldata.n_int):
+        interval_stats = aocal.interval_stats(stats, interval)
+        rows.append((obsid, interval, os.path.abspath(calfile), os.path.getmtime(calfile), store_file,
+                     caldata.time_start, caldata.time_end, caldata.n_int, caldata.n_ant, caldata.n_chan, caldata.n_pol, channels) +
+                    tuple([float(getattr(interval_stats, name)) for name in aocal.CALSTATS_SUMMARY]))
+        ant_rows.extend([(obsid, interval) + tuple([value.item() for value in ant_stats]) for ant_stats in interval_stats.table])
+    return (calfile, obsid, rows, ant_rows)
+
+
+def ingest(archive_dir, calfiles, compression='zlib', do_fit=0, n_workers=1, force=False):
+    """
+    add solution files to the archive (files already ingested and not modified since are skipped unless force=True),
+    compact files are written by n_workers processes, the index is updated by the calling process.
+    Files which cannot be ingested (name without obsid, read errors) are skipped with a warning.
+
+    returns number of ingested files
+    """
+    conn = open_index(archive_dir)
+    known = dict(conn.execute("SELECT calfile, calfile_mtime FROM solutions").fetchall())
+
+    todo = []
+    failed = []
+    n_unchanged = 0
+    for calfile in calfiles:
+        try:
+            obsid = calfile_obsid(calfile)
+            mtime = os.path.getmtime(calfile)
+        except (ValueError, OSError) as e:
+            logging.warning("%s skipped : %s", calfile, e)
+            failed.append(calfile)
+            continue
+        if not force and known.get(os.path.abspath(calfile)) == mtime:
+            logging.info("%s already in archive -> skipped", calfile)
+            n_unchanged += 1
+            continue
+        todo.append((calfile, obsid, archive_dir, compression, do_fit))
+
+    results = aocal.pool_map(store_solutions, todo, n_workers)
+    n_ingested = 0
+    for (calfile, obsid, rows, ant_rows) in results:
+        if rows is None:
+            failed.append(calfile)
+            continue
+        n_ingested += 1
+        conn.execute("DELETE FROM solutions WHERE obsid=?", (obsid,))
+        conn.execute("DELETE FROM antenna_stats WHERE obsid=?", (obsid,))
+        conn.executemany("INSERT INTO solutions VALUES (%s)" % ",".join(["?"] * len(rows[0])), rows)
+        conn.executemany("INSERT INTO antenna_stats VALUES (%s)" % ",".join(["?"] * len(ant_rows[0])), ant_rows)
+    conn.commit()
+    conn.close()
+    failed_str = ""
+    if len(failed) > 0:
+        failed_str = " : " + ", ".join(failed)
+    print "Ingested %d files to archive %s (%d unchanged, %d skipped%s)" % (n_ingested, archive_dir, n_unchanged, len(failed), failed_str)
+
+    return n_ingested
+
+
+def select_solutions(archive_dir, start=None, end=None, all_intervals=False):
+    """
+    index rows (as dictionaries) of observations with start <= obsid <= end (GPS seconds), ordered by obsid,
+    all_intervals=False gives one row per observation (statistics of its first interval), otherwise ordered by (obsid, interval)
+    """
+    conn = open_index(archive_dir)
+    conn.row_factory = sqlite3.Row
+    query = "SELECT * FROM solutions WHERE 1"
+    if not all_intervals:
+        query += " AND interval = 0"
+    params = []
+    if start is not None:
+        query += " AND obsid >= ?"
+        params.append(start)
+    if end is not None:
+        query += " AND obsid <= ?"
+        params.append(end)
+    rows = [dict(row) for row in conn.execute(query + " ORDER BY obsid, interval", params)]
+    conn.close()
+    return rows
+
+
+def antenna_timeseries(archive_dir, ant, pol='XX', chan_start=0, chan_end=None, start=None, end=None):
+    """
+    solutions of a single antenna and polarisation over time
+
+    returns (obsids, times, gains) with one row per calibration interval of every observation with
+    start <= obsid <= end : times are the interval centres (obsid + offset if the file has no time range)
+    and gains the complex solutions of channels chan_start - chan_end (exclusive).
+    All selected observations must have the same number of channels.
+    """
+    pol_idx = aocal.POL_NAMES.index(pol.upper())
+    rows = select_solutions(archive_dir, start, end)
+
+    obsids = []
+    times = []
+    gains = []
+    n_chan = None
+    for row in rows:
+        if n_chan is None:
+            n_chan = row['n_chan']
+        elif row['n_chan'] != n_chan:
+            raise ValueError, "observation %d has %d channels, previous had %d (select a time range with the same channels)" % (row['obsid'], row['n_chan'], n_chan)
+        if ant < 0 or ant >= row['n_ant']:
+            raise ValueError, "antenna %d out of range, observation %d has %d antennas" % (ant, row['obsid'], row['n_ant'])
+
+        caldata = aocal.read_compact(os.path.join(archive_dir, row['store_file']), ants=[ant])
+        gains.append(np.asarray(caldata)[:, 0, chan_start:chan_end, pol_idx])
+
+        n_int = row['n_int']
+        (time_start, time_end) = (row['time_start'], row['time_end'])
+        if time_end <= time_start:
+            (time_start, time_end) = (row['obsid'], row['obsid'])
+        times.extend(time_start + (np.arange(n_int) + 0.5) * (time_end - time_start) / n_int)
+        obsids.extend([row['obsid']] * n_int)
+
+    if len(gains) == 0:
+        return (np.array([], dtype=int), np.array([]), np.zeros((0, 0), dtype=np.complex64))
+    return (np.array(obsids), np.array(times), np.concatenate(gains))
+
+
+def antenna_stats(archive_dir, ant, start=None, end=None):
+    """
+    per-interval statistics (antenna_stats table) of a single antenna in all observations, ordered by (obsid, interval)
+    """
+    conn = open_index(archive_dir)
+    conn.row_factory = sqlite3.Row
+    query = "SELECT * FROM antenna_stats WHERE ant = ?"
+    params = [ant]
+    if start is not None:
+        query += " AND obsid >= ?"
+        params.append(start)
+    if end is not None:
+        query += " AND obsid <= ?"
+        params.append(end)
+    rows = [dict(row) for row in conn.execute(query + " ORDER BY obsid, interval", params)]
+    conn.close()
+    return rows
+
+
+if __name__ == "__main__":
+    usage = "Usage: %prog ingest ARCHIVE_DIR FILES [options]\n"
+    usage += "       %prog query ARCHIVE_DIR --ant ANT [options]\n"
+    usage += "\tArchive of calibration solutions with per-antenna queries\n"
+    usage += "\tFILES : .bin files, glob patterns or @listfile\n"
+    parser = OptionParser(usage=usage, version=1.00)
+    parser.add_option('--compression', dest="compression", default="zlib", help="Compression of stored solutions : none, zlib or blosc [default %default]")
+    parser.add_option('-f', '--do_fit', '--fit', dest="do_fit", default=0, help="Statistics of residuals from polynomial fit of this order (0 - statistics of amplitudes) [default %default]", type="int")
+    parser.add_option('-j', '--n_workers', dest="n_workers", default=1, help="Number of worker processes for ingest [default %default]", type="int")
+    parser.add_option('--force', dest="force", action="store_true", default=False, help="Re-ingest files already in the archive [default %default]")
+    parser.add_option('-a', '--ant', dest="ant", default=0, help="Antenna index for query [default %default]", type="int")
+    parser.add_option('-p', '--pol', dest="pol", default="XX", help="Polarisation for query [default %default]")
+    parser.add_option('--chan_start', dest="chan_start", default=0, help="First channel for query [default %default]", type="int")
+    parser.add_option('--chan_end', dest="chan_end", default=None, help="Last channel for query (exclusive) [default all]", type="int")
+    parser.add_option('--start', dest="start", default=None, help="Start of queried period (GPS seconds, compared with obsid) [default %default]", type="int")
+    parser.add_option('--end', dest="end", default=None, help="End of queried period (GPS seconds, compared with obsid) [default %default]", type="int")
+    parser.add_option('-o', '--outfile', dest="outfile", default=None, help="Output file of query : text file with mean amplitude and phase over the channel range, or all channels if name ends with .npz [default ANT_POL.txt]")
+    (options, args) = parser.parse_args(sys.argv[1:])
+
+    if len(args) < 2:
+        parser.print_help()
+        sys.exit(-1)
+    (command, archive_dir) = args[0:2]
+
+    if command == "ingest":
+        calfiles = []
+        for spec in args[2:]:
+            calfiles.extend(aocal.batch_file_list(spec))
+        ingest(archive_dir, calfiles, compression=options.compression, do_fit=options.do_fit, n_workers=options.n_workers, force=options.force)
+    elif command == "query":
+        (obsids, times, gains) = antenna_timeseries(archive_dir, options.ant, pol=options.pol, chan_start=options.chan_start, chan_end=options.chan_end, start=options.start, end=options.end)
+        outfile = options.outfile
+        if outfile is None:
+            outfile = "ant%03d_%s.txt" % (options.ant, options.pol.lower())
+        if outfile.endswith(".npz"):
+            np.savez(outfile, obsid=obsids, time=times, gains=gains)
+        else:
+            with warnings.catch_warnings():
+                # intervals with all channels flagged -> NaN
+                warnings.simplefilter("ignore", RuntimeWarning)
+                mean_amp = np.nanmean(np.abs(gains), axis=1)
+                mean_phase = np.angle(np.nanmean(gains, axis=1), deg=True)
+            aocal.write_columns(outfile, [obsids, times, mean_amp, mean_phase], "%d %.2f %.6f %.4f")
+        print "Saved %d intervals of antenna %d %s to %s" % (len(times), options.ant, options.pol, outfile)
+    else:
+        print "ERROR : unknown command = %s (use ingest or query)" % (command)
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks of aocal operations on synthetic data (runs offline, no input files needed).
+
+Synthetic MWAOCAL files (smooth bandpass with phase ramp and noise, NaN-flagged edge channels of every
+coarse channel and one flagged antenna) and RTS DI_JonesMatrices node files with their metafits are
+generated from a fixed random seed. Every operation runs in a fresh python process, its set-up (e.g. reading
+the input of tofile or fit) is done before the timed call and the reported peak memory (op_peak_mb) is the
+peak resident memory during the timed call above the memory used right before it. Results are written as JSON :
+
+   aocal_bench.py --cases 128x768x1,256x3072x10 --repeat 3 --outfile bench.json
+   aocal_bench.py --outfile new.json --compare bench.json
+
+Start-up cost matters for thousands of short per-obsid tasks : --check_imports times the import of the aocal
+modules in fresh interpreters and fails if it exceeds the budget or loads matplotlib / fits modules :
+
+   aocal_bench.py --check_imports --import_budget 0.3
+"""
+
+import sys, os, time, json, resource, subprocess, tempfile, shutil, platform
+from optparse import OptionParser
+
+import numpy as np
+
+import aocal
+import metafits_tiles
+
+OPERATIONS = ["fromfile", "tofile", "fit", "calc_mean_rms", "average_channels", "merge_bin_files", "split_bin_file", "rtsfile"]
+
+# n_ant x n_chan x n_int
+DEFAULT_CASES = "128x768x1,128x3072x1,256x768x10,256x3072x1,128x768x60"
+
+N_COARSE = 24
+SEED = 20180921
+
+# modules which must import fast (heavy dependencies are imported by the functions using them) :
+IMPORT_MODULES = ["aocal", "metafits_tiles", "aocal_plot", "aocal_inventory", "aocal_archive"]
+HEAVY_MODULES = ["matplotlib", "pylab", "pyfits", "astropy"]
+# budget [s] for importing a module (including numpy) in a fresh interpreter :
+IMPORT_BUDGET = 0.30
+
+
+def parse_cases(cases_str):
+    cases = []
+    for case in cases_str.split(","):
+        (n_ant, n_chan, n_int) = [int(value) for value in case.lower().split("x")]
+        cases.append((n_ant, n_chan, n_int))
+    return cases
+
+
+def synthetic_interval(rng, n_ant, n_chan, flagged_ant=5):
+    """
+    one calibration interval (n_ant, n_chan, 4) : smooth amplitudes, phase ramps, noise and NaN edge channels
+    """
+    x = np.linspace(-1, 1, n_chan)
+    amp = (1.2 - 0.3 * x ** 2)[np.newaxis, :] * rng.uniform(0.8, 1.2, (n_ant, 1))
+    phase = rng.uniform(-np.pi, np.pi, (n_ant, 1)) + rng.uniform(-20, 20, (n_ant, 1)) * x[np.newaxis, :]
+    gains = (amp * np.exp(1j * phase))[:, :, np.newaxis] * np.array([1.0, 0.01, 0.01, 1.1])[np.newaxis, np.newaxis, :]
+    gains = gains + 0.05 * (rng.standard_normal(gains.shape) + 1j * rng.standard_normal(gains.shape))
+
+    # edge channels of every coarse channel (1/16 of the fine channels on each side) :
+    fine_per_coarse = max(n_chan // N_COARSE, 1)
+    edge = max(fine_per_coarse // 16, 1)
+    fine = np.arange(n_chan) % fine_per_coarse
+    gains[:, (fine < edge) | (fine >= fine_per_coarse - edge), :] = np.nan
+    if flagged_ant < n_ant:
+        gains[flagged_ant] = np.nan
+    return gains
+
+
+def make_bin(filename, n_ant, n_chan, n_int):
+    """
+    synthetic MWAOCAL file, written one interval at a time
+    """
+    rng = np.random.RandomState(SEED)
+    with aocal.AOCalWriter(filename, n_ant=n_ant, n_chan=n_chan, time_start=0.0) as writer:
+        for interval in xrange(n_int):
+            writer.write(synthetic_interval(rng, n_ant, n_chan), time_end=(interval + 1) * 8.0)
+
+
+def make_rts(rts_dir, n_ant):
+    """
+    synthetic metafits (TILEDATA) and RTS DI_JonesMatrices node files (one per coarse channel)
+    """
+    fits = metafits_tiles.fits_module()
+    rng = np.random.RandomState(SEED)
+    antennas = rng.permutation(n_ant)
+    ant = np.repeat(antennas, 2)
+    n_inputs = len(ant)
+    columns = [fits.Column(name='Input', format='I', array=np.arange(n_inputs)),
+               fits.Column(name='Antenna', format='I', array=ant),
+               fits.Column(name='Tile', format='I', array=1000 + ant),
+               fits.Column(name='TileName', format='8A', array=["Tile%03d" % (a + 11) for a in ant]),
+               fits.Column(name='Pol', format='A', array=["Y", "X"] * n_ant),
+               fits.Column(name='Rx', format='I', array=ant // 8 + 1),
+               fits.Column(name='Slot', format='I', array=ant % 8 + 1),
+               fits.Column(name='Flag', format='I', array=np.zeros(n_inputs, dtype=int)),
+               fits.Column(name='Flavors', format='10A', array=["RG6_90"] * n_inputs)]
+    primary = fits.PrimaryHDU()
+    primary.header['CHANNELS'] = ",".join([str(channel) for channel in range(57, 57 + N_COARSE)])
+    table = fits.BinTableHDU.from_columns(columns)
+    table.header['EXTNAME'] = 'TILEDATA'
+    metafits = os.path.join(rts_dir, "1000000000.metafits")
+    fits.HDUList([primary, table]).writeto(metafits)
+
+    for node in range(1, N_COARSE + 1):
+        values = rng.standard_normal((n_ant + 1, 8))
+        with open(os.path.join(rts_dir, "DI_JonesMatrices_node%03d.dat" % node), "w") as rts_file:
+            rts_file.write("%.6f\n" % 1.5)
+            rts_file.write("\n".join([", ".join(["%+.6f" % value for value in row]) for row in values]) + "\n")
+    return metafits
+
+
+def rss_mb(field="VmRSS"):
+    """
+    current (VmRSS) or peak (VmHWM) resident memory of this process [MB]
+    """
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024.0
+    return np.nan
+
+
+def start_measurement():
+    """
+    reset the peak resident memory of this process (VmHWM, linux >= 4.0) and start timing,
+    returns (start time, resident memory [MB] right before the timed call)
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except IOError:
+        # peak is then since the start of the process (includes the set-up)
+        pass
+    base_rss = rss_mb()
+    return (time.time(), base_rss)
+
+
+def clear_tile_cache(workdir):
+    """
+    forget tile tables parsed by previous repeats of rtsfile (memory and disk cache)
+    """
+    metafits_tiles.memory_cache.clear()
+    cache_file = metafits_tiles.cache_file("1000000000", workdir)
+    if os.path.exists(cache_file):
+        os.remove(cache_file)
+
+
+def run_operation(op, binfile, workdir, n_workers=1):
+    """
+    set up and time a single operation (called in the child process),
+    returns (seconds, processed bytes, peak resident memory of the timed call above the memory before it [MB])
+    """
+    nbytes = os.path.getsize(binfile)
+    if op == "fromfile":
+        (t0, base_rss) = start_measurement()
+        caldata = aocal.fromfile(binfile)
+        caldata.sum()
+    elif op == "tofile":
+        caldata = aocal.fromfile(binfile)
+        (t0, base_rss) = start_measurement()
+        caldata.tofile(os.path.join(workdir, "tofile.bin"))
+    elif op == "fit":
+        caldata = aocal.fromfile(binfile)
+        (t0, base_rss) = start_measurement()
+        caldata.fit(n_workers=n_workers)
+    elif op == "calc_mean_rms":
+        (t0, base_rss) = start_measurement()
+        aocal.calc_mean_rms(binfile, do_fit=0, outfile=os.path.join(workdir, "stat.txt"), n_workers=n_workers)
+    elif op == "average_channels":
+        (t0, base_rss) = start_measurement()
+        aocal.average_channels(binfile, 4, os.path.join(workdir, "avg4.bin"))
+    elif op == "split_bin_file":
+        (t0, base_rss) = start_measurement()
+        aocal.split_bin_file(binfile, aocal.read_header(binfile)[0].channelCount // 4, os.path.join(workdir, "split"), n_workers=n_workers)
+    elif op == "merge_bin_files":
+        parts = sorted([os.path.join(workdir, name) for name in os.listdir(workdir) if name.startswith("part_")])
+        if len(parts) == 0:
+            aocal.split_bin_file(binfile, aocal.read_header(binfile)[0].channelCount // 4, os.path.join(workdir, "part"))
+            parts = sorted([os.path.join(workdir, name) for name in os.listdir(workdir) if name.startswith("part_")])
+        (t0, base_rss) = start_measurement()
+        aocal.merge_bin_files(parts, os.path.join(workdir, "merged.bin"))
+    elif op == "rtsfile":
+        # rtsfile takes the coarse channel from "node" in the path -> relative file names :
+        os.chdir(os.path.join(workdir, "rts"))
+        metafits_tiles.CACHE_DIR = workdir  # do not leave synthetic tile tables in the user's cache
+        metafits_tiles.fits_module()  # one-time import is not part of the operation
+        clear_tile_cache(workdir)  # every repeat includes parsing of the metafits
+        (t0, base_rss) = start_measurement()
+        caldata = aocal.rtsfile("1000000000.metafits", "DI_JonesMatrices_node[0-9]*.dat")
+        nbytes = caldata.nbytes
+    else:
+        raise ValueError, "unknown operation %s" % op
+    seconds = time.time() - t0
+    return (seconds, nbytes, rss_mb("VmHWM") - base_rss)
+
+
+def run_child(spec):
+    """
+    child process : run the operation spec['repeat'] times and print JSON result as the last line
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")  # operations print a lot
+    base_rss = rss_mb()
+    seconds = []
+    op_peaks = []
+    for i in range(spec["repeat"]):
+        (dt, nbytes, op_peak) = run_operation(spec["op"], spec["binfile"], spec["workdir"], spec["n_workers"])
+        seconds.append(dt)
+        op_peaks.append(op_peak)
+    sys.stdout = stdout
+
+    result = dict(spec)
+    del result["binfile"], result["workdir"]
+    result["seconds"] = min(seconds)
+    result["seconds_all"] = seconds
+    result["mb_per_s"] = nbytes / 1e6 / min(seconds) if min(seconds) > 0 else None
+    result["base_rss_mb"] = base_rss
+    # peak of the whole child process (interpreter, set-up and all repeats) and of the timed call only
+    # (maximum over repeats, memory freed by a repeat stays resident and is reused by the next one) :
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    result["op_peak_mb"] = max(op_peaks)
+    print json.dumps(result)
+
+
+def run_benchmarks(cases, ops, repeat=1, n_workers=1, workdir=None, keep=False):
+    """
+    generate synthetic data for every case and run all operations (each in a separate process), returns list of results
+    """
+    tmp_dir = tempfile.mkdtemp(prefix="aocal_bench_", dir=workdir)
+    results = []
+    try:
+        for (n_ant, n_chan, n_int) in cases:
+            case_dir = os.path.join(tmp_dir, "%dx%dx%d" % (n_ant, n_chan, n_int))
+            os.makedirs(os.path.join(case_dir, "rts"))
+            binfile = os.path.join(case_dir, "synthetic.bin")
+            make_bin(binfile, n_ant, n_chan, n_int)
+            if "rtsfile" in ops:
+                make_rts(os.path.join(case_dir, "rts"), n_ant)
+
+            for op in ops:
+                spec = {"op": op, "n_ant": n_ant, "n_chan": n_chan, "n_int": n_int, "repeat": repeat, "n_workers": n_workers,
+                        "binfile": binfile, "workdir": case_dir}
+                output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child", json.dumps(spec)])
+                result = json.loads(output.strip().split("\n")[-1])
+                results.append(result)
+                print "%-18s %4d x %5d x %3d : %8.4f s , %9.1f MB/s , peak RSS = %7.1f MB (operation %7.1f MB)" % (op, n_ant, n_chan, n_int, result["seconds"], result["mb_per_s"] or 0, result["peak_rss_mb"], result["op_peak_mb"])
+    finally:
+        if not keep:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        else:
+            print "Synthetic data kept in %s" % tmp_dir
+    return results
+
+
+def import_time(module, repeat=3):
+    """
+    time [s] to import module in a fresh python process (minimum of repeat runs) and the HEAVY_MODULES it loaded
+    """
+    code = "import sys, time, json; t0 = time.time(); import %s; print json.dumps([time.time() - t0, [m for m in %r if m in sys.modules]])" % (module, HEAVY_MODULES)
+    times = []
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)))
+        (seconds, heavy) = json.loads(output.strip().split("\n")[-1])
+        times.append(seconds)
+    return (min(times), heavy)
+
+
+def check_imports(budget=IMPORT_BUDGET, repeat=3):
+    """
+    import time of every module in IMPORT_MODULES, returns (ok, {module: seconds}) where ok is False
+    if any import takes longer than budget or loads one of HEAVY_MODULES
+    """
+    ok = True
+    seconds = {}
+    for module in IMPORT_MODULES:
+        (seconds[module], heavy) = import_time(module, repeat)
+        status = "OK"
+        if seconds[module] > budget or len(heavy) > 0:
+            status = "FAILED"
+            ok = False
+        print "import %-16s : %6.3f s (budget %.3f s) , heavy modules loaded = %s -> %s" % (module, seconds[module], budget, heavy, status)
+    return (ok, seconds)
+
+
+def compare(results, reference_file):
+    """
+    print ratio of time and peak memory of results with respect to a previous run
+    """
+    reference = {}
+    for result in json.load(open(reference_file))["results"]:
+        reference[(result["op"], result["n_ant"], result["n_chan"], result["n_int"])] = result
+
+    print "# OP N_ANT N_CHAN N_INT TIME/REF PEAK_RSS/REF OP_PEAK/REF"
+    for result in results:
+        key = (result["op"], result["n_ant"], result["n_chan"], result["n_int"])
+        if key in reference:
+            ref = reference[key]
+            # op_peak_mb is not in results of older versions :
+            op_peak_ratio = np.nan
+            if ref.get("op_peak_mb", 0) > 0:
+                op_peak_ratio = result["op_peak_mb"] / ref["op_peak_mb"]
+            print "%-18s %4d %5d %3d %6.2f %6.2f %6.2f" % (key + (result["seconds"] / ref["seconds"], result["peak_rss_mb"] / ref["peak_rss_mb"], op_peak_ratio))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--child":
+        run_child(json.loads(sys.argv[2]))
+        sys.exit(0)
+
+    usage = "Usage: %prog [options]\n"
+    usage += "\tTimes aocal operations on synthetic calibration solutions and saves results as JSON\n"
+    parser = OptionParser(usage=usage, version=1.00)
+    parser.add_option('--cases', dest="cases", default=DEFAULT_CASES, help="Comma separated list of N_ANTxN_CHANxN_INT [default %default]")
+    parser.add_option('--ops', dest="ops", default=",".join(OPERATIONS), help="Comma separated list of operations [default %default]")
+    parser.add_option('-r', '--repeat', dest="repeat", default=3, help="Repetitions of every operation (minimum time is reported) [default %default]", type="int")
+    parser.add_option('-j', '--n_workers', dest="n_workers", default=1, help="Number of worker processes for fit and calc_mean_rms [default %default]", type="int")
+    parser.add_option('--workdir', dest="workdir", default=None, help="Directory for synthetic files [default system temporary directory]")
+    parser.add_option('--keep', dest="keep", action="store_true", default=False, help="Keep synthetic files [default %default]")
+    parser.add_option('-o', '--outfile', dest="outfile", default="aocal_bench.json", help="Output JSON file [default %default]")
+    parser.add_option('--compare', dest="compare", default=None, help="JSON file of a previous run to compare with [default %default]")
+    parser.add_option('--check_imports', dest="check_imports", action="store_true", default=False, help="Only check import times of the aocal modules against --import_budget (exit status 1 if exceeded) [default %default]")
+    parser.add_option('--import_budget', dest="import_budget", default=IMPORT_BUDGET, help="Import time budget per module [s] [default %default]", type="float")
+    (options, args) = parser.parse_args(sys.argv[1:])
+
+    if options.check_imports:
+        (ok, seconds) = check_imports(options.import_budget, options.repeat)
+        sys.exit(0 if ok else 1)
+
+    ops = options.ops.split(",")
+    for op in ops:
+        if op not in OPERATIONS:
+            print "ERROR : unknown operation %s (use %s)" % (op, ",".join(OPERATIONS))
+            sys.exit(-1)
+
+    results = run_benchmarks(parse_cases(options.cases), ops, repeat=options.repeat, n_workers=options.n_workers, workdir=options.workdir, keep=options.keep)
+    meta = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "host": platform.node(), "python": platform.python_version(),
+            "numpy": np.__version__, "seed": SEED, "repeat": options.repeat, "n_workers": options.n_workers,
+            "import_seconds": check_imports(options.import_budget, options.repeat)[1]}
+    with open(options.outfile, "w") as out_file:
+        json.dump({"meta": meta, "results": results}, out_file, indent=1, sort_keys=True)
+    print "Saved %d results to %s" % (len(results), options.outfile)
+
+    if options.compare is not None:
+        compare(results, options.compare)
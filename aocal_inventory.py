@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""
+Inventory of calibration solution files from their headers only : every file is checked by reading the
+48-byte MWAOCAL header (HEADER_INTRO, fileType, structureType) and comparing the file size with the size
+declared by the header, so that thousands of files can be triaged without reading the solutions.
+Compact files (aocal.write_compact) are recognised by their own intro and checked against their block sizes.
+
+Optionally a few (interval, antenna) blocks of every file are sampled and files in which all sampled
+solutions are NaN are reported as ALL_NAN.
+
+Directories are scanned by a pool of threads (the work is I/O bound) :
+   aocal_inventory.py /data/solutions -p "*_solutions.bin" -j 32 --sample 4 -o inventory.txt
+"""
+
+import sys, os, struct, fnmatch, logging
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
+
+import numpy as np
+
+import aocal
+
+# status of a scanned file :
+STATUS_OK = "OK"
+STATUS_APPENDING = "APPENDING"      # data after the declared intervals (interval being written by AOCalWriter)
+STATUS_TRUNCATED = "TRUNCATED"      # file smaller than declared by the header
+STATUS_BAD_HEADER = "BAD_HEADER"    # not a MWAOCAL file or unknown fileType / structureType
+STATUS_ALL_NAN = "ALL_NAN"          # all sampled solutions are NaN
+STATUS_ERROR = "ERROR"              # file could not be read
+
+INVENTORY_COLUMNS = ["file", "status", "format", "n_int", "n_ant", "n_chan", "n_pol", "time_start", "time_end", "size", "expected_size"]
+
+
+def find_files(top, pattern="*.bin"):
+    """
+    files matching pattern in directory tree top (or [top] if top is a file)
+    """
+    if not os.path.isdir(top):
+        return [top]
+    files = []
+    for (dirpath, dirnames, filenames) in os.walk(top):
+        dirnames.sort()
+        for filename in sorted(fnmatch.filter(filenames, pattern)):
+            files.append(os.path.join(dirpath, filename))
+    return files
+
+
+def read_file_header(f, size):
+    """
+    (format, header, expected_size, data_offset) of an open solution file of size bytes,
+    header is None if the file does not start with a valid MWAOCAL or compact header
+    """
+    intro = f.read(len(aocal.COMPACT_INTRO))
+    f.seek(0, os.SEEK_SET)
+    fmt = "bin"
+    offset = 0
+    if intro == aocal.COMPACT_INTRO:
+        fmt = "compact"
+        if size < aocal.COMPACT_HEADER_SIZE + aocal.HEADER_SIZE:
+            return (fmt, None, 0, 0)
+        (intro, version, codec) = struct.unpack(aocal.COMPACT_HEADER_FORMAT, f.read(aocal.COMPACT_HEADER_SIZE))
+        if version != aocal.COMPACT_VERSION:
+            return (fmt, None, 0, 0)
+        offset = aocal.COMPACT_HEADER_SIZE
+
+    if size < offset + aocal.HEADER_SIZE:
+        return (fmt, None, 0, 0)
+    header = aocal.Header._make(struct.unpack(aocal.HEADER_FORMAT, f.read(aocal.HEADER_SIZE)))
+    if header.intro != aocal.HEADER_INTRO or header.fileType != 0 or header.structureType != 0:
+        return (fmt, None, 0, 0)
+
+    data_offset = offset + aocal.HEADER_SIZE
+    if fmt == "compact":
+        sizes_size = 8 * header.antennaCount
+        if size < data_offset + sizes_size:
+            return (fmt, header, data_offset + sizes_size, data_offset)
+        block_sizes = np.fromfile(f, dtype=np.uint64, count=header.antennaCount)
+        return (fmt, header, data_offset + sizes_size + int(block_sizes.sum()), data_offset)
+
+    count = header.intervalCount * header.antennaCount * header.channelCount * header.polarizationCount
+    return (fmt, header, data_offset + count * np.dtype(np.complex128).itemsize, data_offset)
+
+
+def sample_all_nan(filename, fmt, header, data_offset, n_samples):
+    """
+    True if all solutions in n_samples (interval, antenna) blocks spread evenly over the file are NaN
+    """
+    n_blocks = header.intervalCount * header.antennaCount
+    if n_blocks == 0:
+        return False
+    blocks = np.unique(np.linspace(0, n_blocks - 1, min(n_samples, n_blocks)).astype(int))
+
+    if fmt == "compact":
+        ants = sorted(set(blocks % header.antennaCount))
+        data = aocal.read_compact(filename, ants=ants)
+        return bool(np.isnan(data).all())
+
+    block_count = header.channelCount * header.polarizationCount
+    with open(filename, "rb") as f:
+        for block in blocks:
+            f.seek(data_offset + int(block) * block_count * np.dtype(np.complex128).itemsize, os.SEEK_SET)
+            if not np.isnan(np.fromfile(f, dtype=np.complex128, count=block_count)).all():
+                return False
+    return True
+
+
+def scan_file(args):
+    """
+    pool worker of scan : args = (filename, n_samples), returns the inventory row (tuple in INVENTORY_COLUMNS order)
+    """
+    (filename, n_samples) = args
+    try:
+        size = os.path.getsize(filename)
+        with open(filename, "rb") as f:
+            (fmt, header, expected_size, data_offset) = read_file_header(f, size)
+        if header is None:
+            return (filename, STATUS_BAD_HEADER, fmt, 0, 0, 0, 0, 0.0, 0.0, size, 0)
+
+        status = STATUS_OK
+        if size < expected_size:
+            status = STATUS_TRUNCATED
+        elif size > expected_size:
+            status = STATUS_APPENDING
+        if status != STATUS_TRUNCATED and n_samples > 0 and sample_all_nan(filename, fmt, header, data_offset, n_samples):
+            status = STATUS_ALL_NAN
+    except (IOError, OSError, ValueError, AssertionError, struct.error) as e:
+        logging.warning("could not read %s : %s", filename, e)
+        return (filename, STATUS_ERROR, "", 0, 0, 0, 0, 0.0, 0.0, 0, 0)
+
+    return (filename, status, fmt, header.intervalCount, header.antennaCount, header.channelCount, header.polarizationCount,
+            header.timeStart, header.timeEnd, size, expected_size)
+
+
+def scan(paths, pattern="*.bin", n_workers=16, n_samples=0):
+    """
+    inventory rows of all files matching pattern in the directory trees (or files) paths,
+    files are checked by n_workers threads
+    """
+    files = []
+    for path in paths:
+        files.extend(find_files(path, pattern))
+
+    tasks = [(filename, n_samples) for filename in files]
+    if n_workers <= 1 or len(tasks) <= 1:
+        return map(scan_file, tasks)
+    pool = ThreadPool(min(n_workers, len(tasks)))
+    try:
+        rows = pool.map(scan_file, tasks, chunksize=16)
+    finally:
+        pool.close()
+        pool.join()
+    return rows
+
+
+def write_inventory(rows, outfile):
+    out_f = open(outfile, "w")
+    out_f.write("# %s\n" % (" ".join([column.upper() for column in INVENTORY_COLUMNS])))
+    for row in rows:
+        out_f.write("%s %s %s %d %d %d %d %.2f %.2f %d %d\n" % row)
+    out_f.close()
+
+
+def status_counts(rows):
+    counts = {}
+    for row in rows:
+        counts[row[1]] = counts.get(row[1], 0) + 1
+    return counts
+
+
+if __name__ == "__main__":
+    usage = "Usage: %prog DIR_OR_FILE [DIR_OR_FILE ...] [options]\n"
+    usage += "\tHeader-only inventory of calibration solution files\n"
+    parser = OptionParser(usage=usage, version=1.00)
+    parser.add_option('-p', '--pattern', dest="pattern", default="*.bin", help="File name pattern [default %default]")
+    parser.add_option('-j', '--n_workers', dest="n_workers", default=16, help="Number of threads [default %default]", type="int")
+    parser.add_option('-s', '--sample', dest="n_samples", default=0, help="Number of (interval, antenna) blocks sampled for all-NaN check, 0 - no check [default %default]", type="int")
+    parser.add_option('-o', '--outfile', dest="outfile", default="inventory.txt", help="Output table [default %default]")
+    parser.add_option('--bad_only', dest="bad_only", action="store_true", default=False, help="Only list files with status other than OK [default %default]")
+    (options, args) = parser.parse_args(sys.argv[1:])
+
+    if len(args) < 1:
+        parser.print_help()
+        sys.exit(-1)
+
+    rows = scan(args, pattern=options.pattern, n_workers=options.n_workers, n_samples=options.n_samples)
+    if options.bad_only:
+        rows = [row for row in rows if row[1] != STATUS_OK]
+    write_inventory(rows, options.outfile)
+
+    counts = status_counts(rows)
+    print "Saved inventory of %d files to %s : %s" % (len(rows), options.outfile, ", ".join(["%s = %d" % (status, counts[status]) for status in sorted(counts.keys())]))
@@ -4,46 +4,35 @@ import os, logging
 from optparse import OptionParser #NB zeus does not have argparse!
 
 import numpy as np
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.gridspec as gridspec
-import pylab
-from astropy.io import fits
 
 #from mwapy import aocal
 
 import aocal
+import metafits_tiles
 
 def get_tile_flavors(metafits):
     """
     return tile flavours ordered in AO order
     """
-    hdus = fits.open(metafits)
     # This mirrors what cotter does (see metafitsfile.cpp MetaFitsFile::ReadTiles
-    inputs = hdus[1].data
-    tiles = inputs[inputs['pol'] == 'X']
-    sort_ant = tiles['antenna'].argsort()
-    return tiles['Flavors'][sort_ant]
+    tiles = metafits_tiles.ao_order(metafits_tiles.tile_table(metafits))
+    return tiles['flavor']
 
 def get_receiver_slot_order(metafits):
     """
     returns a dictionary of dictionaries which will give an AO ordinal index to each receiver and slot
     """
     # get tile metadata table in AO order (discard Y polarisations)
-    hdus = fits.open(metafits)
-    inputs = hdus[1].data
-    tiles = inputs[inputs['pol'] == 'X']
-    sort_ant = tiles['antenna'].argsort()
-    tiles = tiles[sort_ant]
+    tiles = metafits_tiles.ao_order(metafits_tiles.tile_table(metafits))
 
-    receivers = set(tiles['Rx'])
+    receivers = set(tiles['rx'])
     rec_slot_dict = {}
     for receiver in sorted(receivers):
         rec_slot_dict[receiver] = {}
-        rec_slots = set(tiles[tiles['Rx'] == receiver]['Slot'])
+        rec_slots = set(tiles[tiles['rx'] == receiver]['slot'])
         for slot in sorted(rec_slots):
             # tiles with this rec, slot
-            ant = tiles[(tiles['Rx'] == receiver) & (tiles['Slot'] == slot)]['antenna']
+            ant = tiles[(tiles['rx'] == receiver) & (tiles['slot'] == slot)]['antenna']
             if not len(ant) == 1:
                 print ant
                 raise RuntimeError, "Rx %d Slot %d does not map to a single antenna" % (receiver, slot)
@@ -62,19 +51,19 @@ POLS = {0: "XX", 1: "XY", 2: "YX", 3: "YY"}
 POL_COLOR = {"XX": "#0000FF", "XY": "#AAAAFF", "YX": "#FFAAAA", "YY": "#FF0000"}
 POL_ZORDER = {"XX": 3, "XY": 1, "YX": 2, "YY": 4}
 
-def nanaverage(a, axis=None, weights=None):
-    """
-    weighted average treating NaN as zero
-    """
-    if weights is None:
-        weights = np.ones(a.shape)
-    return np.nansum(a*weights, axis=axis)/np.nansum(weights, axis=axis)
-
-def plot(ao, plot_filename, refant=None, n_rows=8, plot_title="", amp_max=None, format="png", outdir=None, ants_per_line=8, marker=',', markersize=2, verbose=0, metafits=None):
+def plot(ao, plot_filename, refant=None, n_rows=8, plot_title="", amp_max=None, format="png", outdir=None, ants_per_line=8, marker=',', markersize=2, verbose=0, metafits=None, copy=True):
     """
     plot aocal
+
+    copy=False : ao is divided by the reference antenna in place (no copy of the solutions)
     """
 
+    # matplotlib is only needed for plotting (not when aocal_plot is imported for the tile order functions) :
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.gridspec as gridspec
+    import pylab
+
     if verbose == 1:
         logging.basicConfig(level=logging.INFO)
     elif verbose > 1:
@@ -83,20 +72,17 @@ def plot(ao, plot_filename, refant=None, n_rows=8, plot_title="", amp_max=None,
     n_cols = ao.n_ant//n_rows
     gs = gridspec.GridSpec(n_rows, n_cols)
     gs.update(hspace=0.0, wspace=0.0)
-    ao_amp = np.abs(ao)
     if refant is not None:
         if refant < 0:
             logging.info("using average as reference antenna")
-            ant_avg = nanaverage(ao, axis=1, weights=ao_amp**-2)#correct phase
-            ant_avg /= np.abs(ant_avg) # normalised
-            print nanaverage(ao_amp, axis=1, weights=ao_amp**-2)
-            ant_avg *= nanaverage(ao_amp, axis=1, weights=ao_amp**-2) #standard scalar avg for amp
-            ao = ao / ant_avg[:, np.newaxis, :, :]
             plot_title += " refant=average"
         else:
             logging.info("using antenna %d as reference antenna", refant)
-            ao = ao / ao[:, refant, :, :][:, np.newaxis, :, :]
             plot_title += " refant=%d" % refant
+        out = None
+        if not copy:
+            out = ao
+        ao = aocal.divide_by_refant(ao, refant, out=out)
     else:
         logging.info("no reference antenna")
 
@@ -200,4 +186,4 @@ if __name__ == '__main__':
         parser.error("incorrect number of arguments")
 
     ao = aocal.fromfile(args[0])
-    plot(ao, os.path.splitext(args[0])[0]+opts.suffix, opts.refant, plot_title = opts.plot_title, outdir=opts.outdir, format=opts.format, amp_max=opts.amp_max, marker=opts.marker, markersize=opts.markersize, verbose=opts.verbose, metafits=opts.metafits)
+    plot(ao, os.path.splitext(args[0])[0]+opts.suffix, opts.refant, plot_title = opts.plot_title, outdir=opts.outdir, format=opts.format, amp_max=opts.amp_max, marker=opts.marker, markersize=opts.markersize, verbose=opts.verbose, metafits=opts.metafits, copy=False)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""
+Tile table of an MWA metafits file (TILEDATA extension) parsed once into a compact numpy structured array.
+
+The table has one row per tile (X polarisation input) in metafits order, so that table['antenna'] is the
+same antenna map the RTS readers used to get from TILEDATA['Antenna'][::2]. Use ao_order() to get the rows
+in AO (antenna index) order.
+
+Parsed tables are cached in memory (key = path, invalidated by mtime) and on disk as <obsid>.tiles.npz
+in the cache directory (METAFITS_TILES_CACHE environment variable or ~/.cache/metafits_tiles), so batch
+jobs open every metafits only once. lookup() finds the table of an obsid without network access
+(local metafits files in the directories listed in METAFITS_PATH, or the disk cache).
+The fits module is only imported when a metafits file has to be parsed (see fits_module).
+"""
+
+import os, logging
+import numpy as np
+
+# astropy.io.fits or pyfits, imported by fits_module() on first use (the import takes several hundred ms) :
+fits = None
+
+TILE_DTYPE = np.dtype([("input", np.int32), ("antenna", np.int32), ("tile", np.int32), ("tile_name", "S16"),
+                       ("flag", np.int32), ("rx", np.int32), ("slot", np.int32), ("flavor", "S16")])
+
+# TILEDATA column name for each field of TILE_DTYPE :
+TILE_COLUMNS = [("input", "Input"), ("antenna", "Antenna"), ("tile", "Tile"), ("tile_name", "TileName"),
+                ("flag", "Flag"), ("rx", "Rx"), ("slot", "Slot"), ("flavor", "Flavors")]
+
+CACHE_DIR = os.environ.get("METAFITS_TILES_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "metafits_tiles"))
+
+# path -> (mtime, table)
+memory_cache = {}
+
+
+def fits_module():
+    """
+    astropy.io.fits (or pyfits if astropy is not installed), imported on first use
+    """
+    global fits
+    if fits is None:
+        try:
+            import astropy.io.fits as fits_import
+        except ImportError:
+            import pyfits as fits_import
+        fits = fits_import
+    return fits
+
+
+def metafits_obsid(metafits):
+    """
+    obsid of a metafits file taken from its name (e.g. 1056386176.metafits or 1056386176_metafits_ppds.fits)
+    """
+    return os.path.basename(metafits).split(".")[0].split("_")[0]
+
+
+def read_tile_table(metafits):
+    """
+    parse the TILEDATA table of a metafits file, returns a TILE_DTYPE array with the X polarisation rows in metafits order
+    """
+    hdus = fits_module().open(metafits)
+    try:
+        inputs = hdus["TILEDATA"].data
+        names = [name.lower() for name in inputs.columns.names]
+        pols = np.char.strip(np.asarray(inputs.field(names.index("pol"))).astype(str))
+        x_rows = np.nonzero(pols == "X")[0]
+
+        table = np.zeros(len(x_rows), dtype=TILE_DTYPE)
+        for field, column in TILE_COLUMNS:
+            if column.lower() in names:
+                table[field] = np.asarray(inputs.field(names.index(column.lower())))[x_rows]
+            else:
+                logging.debug("column %s not in %s", column, metafits)
+    finally:
+        hdus.close()
+
+    return table
+
+
+def cache_file(obsid, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    return os.path.join(cache_dir, "%s.tiles.npz" % obsid)
+
+
+def load_cached(obsid, mtime=None, cache_dir=None):
+    """
+    tile table of obsid from the disk cache (None if missing, or stale when the metafits mtime is given)
+    """
+    filename = cache_file(obsid, cache_dir)
+    if not os.path.exists(filename):
+        return None
+    try:
+        npz = np.load(filename)
+        table = npz["table"]
+        cached_mtime = float(npz["mtime"])
+        npz.close()
+    except (IOError, ValueError, KeyError) as e:
+        logging.warning("could not read tile table cache %s : %s", filename, e)
+        return None
+    if mtime is not None and cached_mtime != mtime:
+        return None
+    return table.astype(TILE_DTYPE)
+
+
+def save_cached(obsid, table, mtime, cache_dir=None):
+    filename = cache_file(obsid, cache_dir)
+    try:
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        # write to a temporary file first so that concurrent batch jobs never see a partial cache file
+        tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        with open(tmp_filename, "wb") as f:
+            np.savez(f, table=table, mtime=mtime)
+        os.rename(tmp_filename, filename)
+    except (IOError, OSError) as e:
+        logging.warning("could not write tile table cache %s : %s", filename, e)
+
+
+def tile_table(metafits, cache_dir=None, use_disk_cache=True):
+    """
+    cached read_tile_table : returns the tile table of a metafits file (X polarisation rows in metafits order)
+    """
+    path = os.path.abspath(metafits)
+    mtime = os.path.getmtime(path)
+
+    cached = memory_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    obsid = metafits_obsid(path)
+    table = None
+    if use_disk_cache:
+        table = load_cached(obsid, mtime, cache_dir)
+    if table is None:
+        logging.debug("parsing tile table of %s", metafits)
+        table = read_tile_table(path)
+        if use_disk_cache:
+            save_cached(obsid, table, mtime, cache_dir)
+
+    memory_cache[path] = (mtime, table)
+    return table
+
+
+def lookup(obsid, search_path=None, cache_dir=None):
+    """
+    offline lookup of the tile table of an obsid : <obsid>.metafits in the current directory or in the
+    directories of search_path (default METAFITS_PATH environment variable), otherwise the disk cache.
+    Returns None if the obsid is not known locally.
+    """
+    if search_path is None:
+        search_path = os.environ.get("METAFITS_PATH", "")
+    dirs = ["."] + [d for d in search_path.split(os.pathsep) if len(d) > 0]
+    for d in dirs:
+        for name in ("%s.metafits" % obsid, "%s_metafits_ppds.fits" % obsid):
+            metafits = os.path.join(d, name)
+            if os.path.exists(metafits):
+                return tile_table(metafits, cache_dir=cache_dir)
+
+    return load_cached(obsid, cache_dir=cache_dir)
+
+
+def ao_order(table):
+    """
+    tile table rows in AO order (sorted by antenna index)
+    """
+    return table[np.argsort(table["antenna"], kind="mergesort")]
+
+
+def coarse_channels(metafits):
+    """
+    CHANNELS keyword of the metafits primary header (comma separated list of coarse channels), None if not present
+    """
+    header = fits_module().getheader(metafits, 0)
+    if "CHANNELS" not in header:
+        return None
+    return str(header["CHANNELS"])
@@ -0,0 +1,49 @@
+"""
+batch mode of aocal.py on solution files in a subdirectory (named <obsid>_solutions.bin or without obsid)
+"""
+
+import os, sys, shutil, tempfile, subprocess, unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import aocal
+
+AOCAL_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "aocal.py")
+
+
+class TestBatchPlot(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.workdir, "data"))
+        ao = aocal.ones(n_interval=1, n_antennas=8, n_channel=32)
+        ao *= (1.0 + 0.01 * np.random.RandomState(1).randn(*ao.shape))
+        ao.tofile(os.path.join(self.workdir, "data", "1056386176_solutions.bin"))
+        ao.tofile(os.path.join(self.workdir, "data", "solutions_a.bin"))
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_batch_plot(self):
+        env = dict(os.environ, MPLBACKEND="Agg")
+        subprocess.check_call([sys.executable, "-W", "ignore", AOCAL_SCRIPT, "--batch", "data/*_solutions.bin", "-e", "plot", "--nx", "4", "--ny", "2"],
+                              cwd=self.workdir, env=env)
+
+        lines = open(os.path.join(self.workdir, "batch_summary.txt")).readlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[1].split()[:3], ["data/1056386176_solutions.bin", "plot", "OK"])
+        outdir = os.path.join(self.workdir, "images", "1056386176_solutions")
+        self.assertTrue(os.path.exists(os.path.join(outdir, "1056386176_solutions_amp.png")))
+        self.assertTrue(os.path.exists(os.path.join(outdir, "1056386176_solutions_stat_amp.png")))
+
+    def test_batch_without_obsid(self):
+        # actions which do not use the obsid also work on files not named by obsid :
+        for action in ["dump", "calc_rms"]:
+            subprocess.check_call([sys.executable, "-W", "ignore", AOCAL_SCRIPT, "--batch", "data/solutions_a.bin", "-e", action],
+                                  cwd=self.workdir)
+            lines = open(os.path.join(self.workdir, "batch_summary.txt")).readlines()
+            self.assertEqual(lines[1].split()[:3], ["data/solutions_a.bin", action, "OK"])
+
+
+if __name__ == "__main__":
+    unittest.main()
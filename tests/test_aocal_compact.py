@@ -0,0 +1,55 @@
+"""
+round trip of calibration solutions through the compact format (aocal.write_compact / read_compact)
+"""
+
+import os, sys, shutil, tempfile, unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import aocal
+
+
+class TestCompact(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(1)
+        shape = (2, 8, 32, 4)
+        # values representable in complex64 (precision of the compact format) -> bit-identical round trip
+        data = (rng.randn(*shape) + 1j * rng.randn(*shape)).astype(np.complex64).astype(np.complex128)
+        data[:, 5] = np.nan
+        self.ao = aocal.AOCal(data, time_start=1056386176.0, time_end=1056386288.0)
+        self.binfile = os.path.join(self.workdir, "solutions.bin")
+        self.ao.tofile(self.binfile)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def round_trip(self, compression):
+        compact_file = os.path.join(self.workdir, "solutions_%s.aocz" % compression)
+        outfile = os.path.join(self.workdir, "solutions_%s.bin" % compression)
+        aocal.bin_to_compact(self.binfile, compact_file, compression=compression)
+        self.assertTrue(aocal.is_compact(compact_file))
+        aocal.compact_to_bin(compact_file, outfile)
+
+        self.assertEqual(aocal.read_header(outfile)[0], aocal.read_header(self.binfile)[0])
+        self.assertEqual(open(outfile, "rb").read(), open(self.binfile, "rb").read())
+
+        ants = [6, 0, 5]
+        subset = aocal.read_compact(compact_file, ants=ants)
+        self.assertEqual(subset.shape, (2, 3, 32, 4))
+        np.testing.assert_array_equal(np.asarray(subset), np.asarray(self.ao)[:, ants].astype(np.complex64))
+
+    def test_round_trip_uncompressed(self):
+        self.round_trip(None)
+
+    def test_round_trip_zlib(self):
+        self.round_trip("zlib")
+
+    @unittest.skipIf(aocal.blosc is None, "python-blosc not installed")
+    def test_round_trip_blosc(self):
+        self.round_trip("blosc")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+"""
+incremental writing of calibration solutions with aocal.AOCalWriter
+"""
+
+import os, sys, shutil, tempfile, unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import aocal
+
+N_ANT = 8
+N_CHAN = 32
+
+
+class TestAOCalWriter(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.binfile = os.path.join(self.workdir, "solutions.bin")
+        rng = np.random.RandomState(1)
+        shape = (4, N_ANT, N_CHAN, 4)
+        self.data = rng.randn(*shape) + 1j * rng.randn(*shape)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_append(self):
+        n_int = self.data.shape[0] - 1
+        with aocal.AOCalWriter(self.binfile, n_ant=N_ANT, n_chan=N_CHAN, time_start=10.0) as writer:
+            for interval in range(n_int):
+                writer.write(self.data[interval], time_end=10.0 + 8.0 * (interval + 1))
+        self.assertEqual(aocal.fromfile(self.binfile).shape[0], n_int)
+
+        with aocal.AOCalWriter(self.binfile, append=True) as writer:
+            writer.write(self.data[n_int], time_end=10.0 + 8.0 * (n_int + 1))
+
+        ao = aocal.fromfile(self.binfile)
+        self.assertEqual(ao.shape, self.data.shape)
+        np.testing.assert_array_equal(np.asarray(ao), self.data)
+        self.assertEqual((ao.time_start, ao.time_end), (10.0, 10.0 + 8.0 * self.data.shape[0]))
+
+    def test_partial_interval(self):
+        with aocal.AOCalWriter(self.binfile, n_ant=N_ANT, n_chan=N_CHAN) as writer:
+            writer.write(self.data[0:2])
+        # interval being written (only part of it on disk) :
+        with open(self.binfile, "ab") as cal_file:
+            cal_file.write(self.data[2, 0:N_ANT // 2].tobytes())
+
+        self.assertRaises(AssertionError, aocal.fromfile, self.binfile)
+        ao = aocal.fromfile(self.binfile, allow_partial=True)
+        np.testing.assert_array_equal(np.asarray(ao), self.data[0:2])
+
+        # appending drops the partial interval :
+        with aocal.AOCalWriter(self.binfile, append=True) as writer:
+            writer.write(self.data[2])
+        np.testing.assert_array_equal(np.asarray(aocal.fromfile(self.binfile)), self.data[0:3])
+
+    def test_truncated(self):
+        aocal.AOCal(self.data).tofile(self.binfile)
+        with open(self.binfile, "r+b") as cal_file:
+            cal_file.truncate(os.path.getsize(self.binfile) - 16)
+        # intervals declared by the header are missing -> rejected also with allow_partial=True
+        self.assertRaises(AssertionError, aocal.fromfile, self.binfile)
+        self.assertRaises(AssertionError, aocal.fromfile, self.binfile, allow_partial=True)
+
+
+if __name__ == "__main__":
+    unittest.main()